@@ -0,0 +1,17 @@
+"""Benchmarks of campari's hot paths, run with airspeed velocity (asv).
+
+The bench_*.py modules time, and measure the peak memory of, the PSF
+builders, the grid builders, generateGuess, get_weights, prep_data_for_fit,
+the lsqr solve, the covariance, and run_one_object end to end. The other
+modules are scripts that can be run on their own, e.g.
+python benchmarks/import_time.py.
+
+The benchmarks need the same environment and config as the tests (set
+SNPIT_CONFIG). Benchmarks whose data is missing are skipped. To benchmark
+the commit that is checked out, and keep the results:
+
+    asv run --python=same --set-commit-hash $(git rev-parse HEAD)
+
+Then asv compare <commit> <commit> lists what got slower or bigger, and asv
+publish; asv preview plots every benchmark across the commits that were run.
+"""
@@ -0,0 +1,51 @@
+"""Benchmarks of the model grid builders, the initial guess and the
+weights.
+"""
+
+from campari.AllASPFuncs import (
+    generateGuess,
+    get_weights,
+    make_adaptive_grid,
+    make_contour_grid,
+    make_regular_grid,
+)
+
+from .common import SNDEC, SNRA, cutout_wcs, cutouts, galaxy_image
+
+
+class GridBuilders:
+    """The three grid builders, on a galaxy in the middle of the cutout."""
+    params = (["regular", "adaptive", "contour"], [11, 19, 25])
+    param_names = ["grid_type", "size"]
+
+    def setup(self, grid_type, size):
+        self.wcs = cutout_wcs()
+        self.image = galaxy_image(size)
+
+    def time_grid(self, grid_type, size):
+        if grid_type == "regular":
+            make_regular_grid(SNRA, SNDEC, self.wcs, size=size, spacing=0.75,
+                              subsize=size)
+        elif grid_type == "adaptive":
+            make_adaptive_grid(SNRA, SNDEC, self.wcs, image=self.image,
+                               percentiles=[45, 90], subsize=size)
+        else:
+            make_contour_grid(self.image, self.wcs)
+
+
+class GuessAndWeights:
+    """generateGuess and get_weights on the cutouts of an object."""
+    params = ([11, 19, 25], [10, 40])
+    param_names = ["size", "num_images"]
+
+    def setup(self, size, num_images):
+        self.images = cutouts(size, num_images)
+        self.ra_grid, self.dec_grid = \
+            make_regular_grid(SNRA, SNDEC, self.images[0].get_wcs(),
+                              size=size, spacing=0.75, subsize=size)
+
+    def time_generateGuess(self, size, num_images):
+        generateGuess(self.images, self.ra_grid, self.dec_grid)
+
+    def time_get_weights(self, size, num_images):
+        get_weights(self.images, SNRA, SNDEC)
@@ -0,0 +1,57 @@
+"""Benchmarks of building the model PSFs, the bulk of a fit's time."""
+
+import galsim
+
+from campari.psf import construct_psf_background, construct_psf_source
+
+from .common import BAND, cutout_wcs, grid_points
+
+
+class ConstructPSFBackground:
+    """One background model column per grid point, for a cutout."""
+    params = ([9, 36, 144], [11, 19, 25])
+    param_names = ["grid_points", "size"]
+    timeout = 600
+
+    def setup(self, num_points, size):
+        self.wcs = cutout_wcs()
+        self.ra, self.dec = grid_points(self.wcs, size, num_points)
+        # The PSF construct_psf_background builds when it is not given one.
+        self.psf = galsim.roman.getPSF(1, BAND, pupil_bin=8,
+                                       wcs=self.wcs.get_galsim_wcs())
+
+    def time_construct_psf_background(self, num_points, size):
+        construct_psf_background(self.ra, self.dec, self.wcs, 2044, 2044,
+                                 size, psf=self.psf, band=BAND)
+
+    def peakmem_construct_psf_background(self, num_points, size):
+        construct_psf_background(self.ra, self.dec, self.wcs, 2044, 2044,
+                                 size, psf=self.psf, band=BAND)
+
+
+class ConstructPSFSource:
+    """The supernova model of one detection image, with and without the
+    photon ops. The snappl PSF object is built in setup, as the batch
+    runner's workers keep it from one object to the next.
+    """
+    params = ([False, True], [11, 25])
+    param_names = ["photOps", "size"]
+    timeout = 600
+
+    def setup(self, photOps, size):
+        self.sed = galsim.SED(galsim.LookupTable([1000, 26000], [1, 1],
+                                                 interpolant="linear"),
+                              wave_type="Angstrom", flux_type="fphotons")
+        self.draw(photOps, size)
+
+    def draw(self, photOps, size):
+        return construct_psf_source(x=2044, y=2044, pointing=43623, SCA=7,
+                                    stampsize=size, x_center=2044.2,
+                                    y_center=2043.9, sed=self.sed, flux=1,
+                                    photOps=photOps)
+
+    def time_construct_psf_source(self, photOps, size):
+        self.draw(photOps, size)
+
+    def peakmem_construct_psf_source(self, photOps, size):
+        self.draw(photOps, size)
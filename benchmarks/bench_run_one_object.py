@@ -0,0 +1,58 @@
+"""End to end benchmark of run_one_object.
+
+It fits the supernova of the regression test, on the images in the config's
+roman_path. To run it without the OpenUniverse 2024 data, make a synthetic
+tree with python -m campari.synthetic, point roman_path, sn_path,
+sims_sed_library, galsim.tds_file and simdex_url of the config at it, and
+set CAMPARI_BENCHMARK_ID to one of its supernovae.
+"""
+
+import os
+import pathlib
+
+import numpy as np
+
+from campari.AllASPFuncs import run_one_object
+from campari.RomanASP import airy_psf
+
+from .common import BAND
+
+
+class RunOneObject:
+    params = (["contour", "regular"], [2, 6])
+    param_names = ["grid_type", "num_total_images"]
+    timeout = 1800
+    repeat = 1
+    number = 1
+
+    def setup(self, grid_type, num_total_images):
+        from snpit_utils.config import Config
+        config = Config.get()
+        roman_path = config.value("photometry.campari.paths.roman_path")
+        if not (pathlib.Path(roman_path) / "RomanTDS" /
+                "Roman_TDS_obseq_11_6_23_radec.fits").exists():
+            raise NotImplementedError(f"No OpenUniverse data in {roman_path}.")
+        self.ID = int(os.environ.get("CAMPARI_BENCHMARK_ID", 40120913))
+        # The settings of the regression test.
+        self.kwargs = {
+            "object_type": "SN", "num_total_images": num_total_images,
+            "num_detect_images": num_total_images // 2,
+            "roman_path": roman_path,
+            "sn_path": config.value("photometry.campari.paths.sn_path"),
+            "size": 19, "band": BAND, "fetch_SED": False,
+            "use_real_images": True, "use_roman": True,
+            "subtract_background": True, "make_initial_guess": True,
+            "initial_flux_guess": 3000, "weighting": True, "method": "lsqr",
+            "grid_type": grid_type, "pixel": False, "source_phot_ops": False,
+            "lc_start": -np.inf, "lc_end": np.inf, "do_xshift": False,
+            "bg_gal_flux": None, "do_rotation": False,
+            "airy": airy_psf(BAND), "mismatch_seds": False,
+            "deltafcn_profile": False, "noise": 0, "check_perfection": False,
+            "avoid_non_linearity": False, "sim_gal_ra_offset": 0,
+            "sim_gal_dec_offset": 0, "spacing": 0.75, "percentiles": []}
+
+    def time_run_one_object(self, grid_type, num_total_images):
+        run_one_object(self.ID, **self.kwargs)
+
+    def peakmem_run_one_object(self, grid_type, num_total_images):
+        run_one_object(self.ID, **self.kwargs)
@@ -0,0 +1,63 @@
+"""Benchmarks of putting the fit together and solving it: prep_data_for_fit,
+the lsqr solve and the covariance, done the way run_one_object does them.
+"""
+
+import numpy as np
+from numpy.linalg import LinAlgError
+
+from campari.AllASPFuncs import get_weights
+from campari.solver import prep_data_for_fit, solve_lsqr
+
+from .common import SNDEC, SNRA, cutouts
+from .float32_refinement import build_problem
+
+
+class PrepDataForFit:
+    params = ([11, 19, 25], [10, 40])
+    param_names = ["size", "num_images"]
+
+    def setup(self, size, num_images):
+        self.images = cutouts(size, num_images)
+        rng = np.random.default_rng(42)
+        self.sn_matrix = [rng.random(size**2) for _ in range(num_images // 2)]
+        self.wgt_matrix = get_weights(self.images, SNRA, SNDEC)
+
+    def time_prep_data_for_fit(self, size, num_images):
+        prep_data_for_fit(self.images, self.sn_matrix, self.wgt_matrix)
+
+    def peakmem_prep_data_for_fit(self, size, num_images):
+        prep_data_for_fit(self.images, self.sn_matrix, self.wgt_matrix)
+
+
+class Solve:
+    """A host galaxy grid and one supernova column per detection image, as
+    in benchmarks/float32_refinement.py. The problems are kept small: the
+    covariance, like run_one_object's, makes a dense diagonal matrix of the
+    weights, whose size is quadratic in the number of pixels.
+    """
+    params = ([11, 19], [10, 20])
+    param_names = ["size", "num_images"]
+    timeout = 600
+
+    def setup(self, size, num_images):
+        self.psf_matrix, self.wgt_matrix, self.images = \
+            build_problem(size, num_images, num_images // 2, 1.5, np.float64)
+        self.weighted_psf_matrix = self.psf_matrix * \
+            self.wgt_matrix.reshape(-1, 1)
+
+    def time_solve_lsqr(self, size, num_images):
+        solve_lsqr(self.weighted_psf_matrix, self.images * self.wgt_matrix)
+
+    def covariance(self):
+        inv_cov = self.psf_matrix.T @ np.diag(self.wgt_matrix) @ \
+            self.psf_matrix
+        try:
+            return np.linalg.inv(inv_cov)
+        except LinAlgError:
+            return np.linalg.pinv(inv_cov)
+
+    def time_covariance(self, size, num_images):
+        self.covariance()
+
+    def peakmem_covariance(self, size, num_images):
+        self.covariance()
@@ -0,0 +1,62 @@
+"""The inputs the benchmarks share, made from the test data and the images
+the tests use.
+"""
+
+import pathlib
+
+import numpy as np
+
+TESTDATA = pathlib.Path(__file__).parents[1] / "campari" / "tests" / "testdata"
+
+# The supernova and image of test_get_weights.
+SNRA, SNDEC = 7.34465537, -44.91932581
+POINTING, SCA, BAND = 111, 13, "Y106"
+
+
+def cutout_wcs():
+    """The snappl WCS of the cutout the tests use."""
+    import snappl.wcs
+    wcs_data = np.load(TESTDATA / "wcs_dict.npz", allow_pickle=True)
+    wcs_dict = {key: wcs_data[key].item() for key in wcs_data.files}
+    return snappl.wcs.AstropyWCS.from_header(wcs_dict)
+
+
+def galaxy_image(size, peak=1000, background=10):
+    """A round galaxy in the middle of a size x size image, for the grid
+    builders.
+    """
+    yy, xx = np.mgrid[0:size, 0:size]
+    r2 = (xx - (size - 1) / 2)**2 + (yy - (size - 1) / 2)**2
+    return peak * np.exp(-r2 / (2 * (size / 6)**2)) + background
+
+
+def grid_points(wcs, size, num_points):
+    """The RA and Dec of about num_points points on a regular grid over a
+    size x size cutout.
+    """
+    side = max(int(round(np.sqrt(num_points))), 1)
+    x = np.linspace(1, size - 2, side)
+    xx, yy = np.meshgrid(x, x)
+    ra, dec = wcs.pixel_to_world(xx.ravel(), yy.ravel())
+    return np.array(ra), np.array(dec)
+
+
+def cutouts(size, num_images):
+    """num_images cutouts, size x size pixels, around the supernova.
+
+    They are all cut from the one image the tests use, which is enough to
+    time what is done with them. Raises NotImplementedError, which makes asv
+    skip the benchmark, if the image is not in photometry.campari.paths.
+    roman_path.
+    """
+    from snappl.image import OpenUniverse2024FITSImage
+    from snpit_utils.config import Config
+    roman_path = Config.get().value("photometry.campari.paths.roman_path")
+    imagepath = pathlib.Path(
+        f"{roman_path}/RomanTDS/images/simple_model/{BAND}/{POINTING}/"
+        f"Roman_TDS_simple_model_{BAND}_{POINTING}_{SCA}.fits.gz")
+    if not imagepath.exists():
+        raise NotImplementedError(f"{imagepath} not found.")
+    image = OpenUniverse2024FITSImage(str(imagepath), None, SCA)
+    cutout = image.get_ra_dec_cutout(SNRA, SNDEC, size)
+    return [cutout] * num_images
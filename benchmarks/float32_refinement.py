@@ -0,0 +1,139 @@
+"""Compare the float32 design matrix mode against the default float64 one.
+
+A synthetic scene (a regular grid of Gaussian PSFs for the host, plus one
+SN column per detection image) is built in the same layout run_one_object
+uses, and solved the way run_one_object solves it in each mode. Every mode is
+run in its own subprocess so that the peak RSS reported is its own.
+
+Usage:
+    python benchmarks/float32_refinement.py --size 25 --num-images 40
+"""
+
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+import scipy.sparse as sp
+
+from campari.solver import chunked_normal_matrix, lsqr_with_refinement
+
+MODES = ("float64", "float32")
+
+
+def gaussian_psf(dx, dy, sigma=1.5):
+    return np.exp(-(dx**2 + dy**2) / (2 * sigma**2)) / (2 * np.pi * sigma**2)
+
+
+def build_problem(size, num_images, num_detect, spacing, dtype, seed=42):
+    """Build the design matrix, weights and images for a synthetic scene."""
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:size, 0:size]
+    centre = (size - 1) / 2
+    grid_1d = np.arange(centre - size / 3, centre + size / 3, spacing)
+    grid_x, grid_y = [g.ravel() for g in np.meshgrid(grid_1d, grid_1d)]
+    num_grid = grid_x.size
+    num_rows = num_images * size**2
+
+    psf_matrix = np.zeros((num_rows, num_grid + num_images), dtype=dtype)
+    for i in range(num_images):
+        rows = slice(i * size**2, (i + 1) * size**2)
+        shift_x, shift_y = rng.random(2) * 0.5
+        psf_matrix[rows, :num_grid] = \
+            gaussian_psf(xx.ravel()[:, None] - grid_x - shift_x,
+                         yy.ravel()[:, None] - grid_y - shift_y)
+        if i >= num_images - num_detect:
+            psf_matrix[rows, num_grid + i] = \
+                gaussian_psf(xx - centre - 0.2, yy - centre - 0.1).ravel()
+
+    truth = np.concatenate([rng.random(num_grid) * 100,
+                            np.zeros(num_images - num_detect),
+                            rng.random(num_detect) * 3000])
+    images = psf_matrix.astype(np.float64) @ truth + \
+        rng.normal(size=num_rows)
+    distance = np.hypot(xx - centre, yy - centre).ravel()
+    wgt = np.where(distance > size / 3, 0, np.exp(-distance**2 / 1000))
+    wgt_matrix = np.tile(wgt, num_images)
+
+    return psf_matrix, wgt_matrix.astype(dtype), images.astype(dtype)
+
+
+def run_mode(mode, size, num_images, num_detect, spacing):
+    dtype = np.float32 if mode == "float32" else np.float64
+    t0 = time.perf_counter()
+    psf_matrix, wgt_matrix, images = build_problem(size, num_images,
+                                                   num_detect, spacing, dtype)
+    t1 = time.perf_counter()
+    if mode == "float32":
+        X, itn = lsqr_with_refinement(psf_matrix, wgt_matrix, images)
+        t2 = time.perf_counter()
+        inv_cov = chunked_normal_matrix(psf_matrix,
+                                        wgt_matrix.astype(np.float64))
+    else:
+        weighted_psf_matrix = psf_matrix * wgt_matrix.reshape(-1, 1)
+        X, _, itn = sp.linalg.lsqr(weighted_psf_matrix, images * wgt_matrix,
+                                   atol=1e-12, btol=1e-12, iter_lim=300000,
+                                   conlim=1e10)[:3]
+        t2 = time.perf_counter()
+        inv_cov = psf_matrix.T @ np.diag(wgt_matrix) @ psf_matrix
+    sigma_flux = np.sqrt(np.diag(np.linalg.pinv(inv_cov))[-num_detect:])
+    t3 = time.perf_counter()
+
+    return {"mode": mode,
+            "matrix_shape": list(psf_matrix.shape),
+            "matrix_mb": psf_matrix.nbytes / 2**20,
+            "build_s": t1 - t0,
+            "solve_s": t2 - t1,
+            "covariance_s": t3 - t2,
+            "iterations": int(itn),
+            # ru_maxrss is in kilobytes on Linux.
+            "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            / 1024,
+            "flux": X[-num_detect:].tolist(),
+            "sigma_flux": sigma_flux.tolist()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--size", type=int, default=25)
+    parser.add_argument("--num-images", type=int, default=40)
+    parser.add_argument("--num-detect", type=int, default=20)
+    parser.add_argument("--spacing", type=float, default=1.5)
+    parser.add_argument("--mode", choices=MODES,
+                        help="Run a single mode in this process and print "
+                             "its result as JSON.")
+    args = parser.parse_args()
+    problem = [str(args.size), str(args.num_images), str(args.num_detect),
+               str(args.spacing)]
+
+    if args.mode is not None:
+        print(json.dumps(run_mode(args.mode, args.size, args.num_images,
+                                  args.num_detect, args.spacing)))
+        return
+
+    results = {}
+    for mode in MODES:
+        out = subprocess.run([sys.executable, __file__, "--mode", mode,
+                              "--size", problem[0], "--num-images", problem[1],
+                              "--num-detect", problem[2],
+                              "--spacing", problem[3]],
+                             check=True, capture_output=True, text=True)
+        results[mode] = json.loads(out.stdout.strip().splitlines()[-1])
+
+    reference = np.array(results["float64"]["flux"])
+    for mode, result in results.items():
+        rel = np.abs(np.array(result["flux"]) / reference - 1)
+        print(f"{mode:>8}: matrix {result['matrix_mb']:8.1f} MB, "
+              f"peak RSS {result['max_rss_mb']:8.1f} MB, "
+              f"build {result['build_s']:6.2f} s, "
+              f"solve {result['solve_s']:6.2f} s "
+              f"({result['iterations']} iterations), "
+              f"covariance {result['covariance_s']:6.2f} s, "
+              f"max flux rel. diff {np.max(rel):.2e}")
+
+
+if __name__ == "__main__":
+    main()
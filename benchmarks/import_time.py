@@ -0,0 +1,82 @@
+"""Measure how long importing the campari entry point takes.
+
+Each import is timed in a fresh interpreter with python -X importtime, and
+the packages that take the longest are listed. The script exits with an
+error if the median import takes longer than the budget, so it can be run in
+CI.
+
+Usage:
+    python benchmarks/import_time.py --module campari.RomanASP --budget 3
+"""
+
+import argparse
+import collections
+import statistics
+import subprocess
+import sys
+
+# Packages that only some of campari needs, and that importing the entry
+# point should not import.
+DEFERRED = ("matplotlib", "h5py", "requests", "roman_imsim",
+            "scipy.interpolate", "scipy.optimize", "snappl.image",
+            "snappl.psf")
+
+
+def measure_import(module):
+    """Import module in a fresh interpreter.
+
+    Returns:
+    seconds: float, the cumulative import time of module.
+    packages: dict, the cumulative import time of each package, in
+              seconds, wherever it was first imported from.
+    loaded: list of the DEFERRED modules that were imported.
+    """
+    code = ("import sys, " + module + "; print(','.join(m for m in "
+            + repr(DEFERRED) + " if m in sys.modules))")
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                         check=True, capture_output=True, text=True)
+    seconds = 0
+    packages = collections.Counter()
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        name = name.strip()
+        if "." not in name:
+            packages[name] = int(cumulative) / 1e6
+        if name == module:
+            seconds = int(cumulative) / 1e6
+    loaded = [m for m in out.stdout.strip().split(",") if m]
+    return seconds, packages, loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--module", default="campari.RomanASP")
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=3.0,
+                        help="Seconds the median import may take.")
+    parser.add_argument("--top", type=int, default=10,
+                        help="How many of the slowest packages to list.")
+    args = parser.parse_args()
+
+    runs = [measure_import(args.module) for _ in range(args.repeats)]
+    median = statistics.median(run[0] for run in runs)
+    packages = runs[-1][1]
+    print(f"import {args.module}: median {median:.2f} s over "
+          f"{args.repeats} runs, budget {args.budget:.2f} s")
+    for name, seconds in packages.most_common(args.top):
+        print(f"{name:>20}: {seconds:6.2f} s")
+
+    failed = False
+    if runs[-1][2]:
+        print(f"Imported modules that should be deferred: {runs[-1][2]}")
+        failed = True
+    if median > args.budget:
+        print("Over budget.")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
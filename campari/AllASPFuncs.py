@@ -1,37 +1,115 @@
 # Standard Library
-import os
+import collections
 import pathlib
+import tempfile
 import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 # Common Library
 import astropy.table as tb
-import galsim
-import h5py
 import numpy as np
-import pandas as pd
-import requests
 import scipy.sparse as sp
-from astropy import units as u
-from astropy.coordinates import SkyCoord
-from astropy.io import fits
-from astropy.table import QTable, Table
 from astropy.utils.exceptions import AstropyWarning
 from erfa import ErfaWarning
-from galsim import roman
-from matplotlib import pyplot as plt
 from numpy.linalg import LinAlgError
-from roman_imsim.utils import roman_utils
-from scipy.interpolate import RegularGridInterpolator
 
 # SN-PIT
-import snappl
-from snappl.image import OpenUniverse2024FITSImage
 from snpit_utils.config import Config
 from snpit_utils.logger import SNLogger as Lager
-from snappl.psf import PSF
 
 # Campari
+from campari.catalog import (  # noqa: F401
+    build_lightcurve,
+    build_lightcurve_sim,
+    calc_mag_and_err,
+    extract_sn_from_parquet_file_and_write_to_csv,
+    extract_star_from_parquet_file_and_write_to_csv,
+    find_parquet,
+    findAllExposures,
+    get_galsim_SED,
+    get_galsim_SED_list,
+    get_object_info,
+    get_SN_SED,
+    get_star_SED,
+    open_parquet,
+    radec2point,
+    save_lightcurve,
+)
+from campari.psf import _aperture_stats
+from campari.psf import (  # noqa: F401
+    construct_epoch_model,
+    construct_psf_background,
+    construct_psf_kernel,
+    construct_psf_source,
+    get_psf_object,
+    get_roman_utils,
+    getPSF_Image,
+    install_aperture_cache,
+)
+from campari.instrument import (
+    count,
+    note,
+    recording,
+    stage,
+    start_recording,
+    stop_recording,
+)
 from campari.simulation import simulate_images
+from campari.solver import (  # noqa: F401
+    allocate_design_matrix,
+    batch_solve,
+    build_fft_design_operator,
+    chunked_design_operator,
+    chunked_normal_matrix,
+    column_norms,
+    COST_MODEL_TERMS,
+    default_chunk_rows,
+    DEFAULT_COST_MODEL,
+    estimate_cost,
+    factor_design_matrix,
+    fine_lattice_offset,
+    fit_cost_model,
+    jackknife_epoch_fluxes,
+    load_normal_state,
+    lsqr_flux_stopping,
+    lsqr_with_refinement,
+    new_normal_state,
+    normal_matrix_from_operator,
+    prep_data_for_fit,
+    psf_only_photometry,
+    regular_grid_geometry,
+    residual_bootstrap_images,
+    save_normal_state,
+    save_warm_start,
+    sky_design_operator,
+    sky_indicator_block,
+    sky_normal_matrix,
+    solve_epoch_against_host,
+    solve_factored,
+    solve_lsqr,
+    solve_normal_state,
+    two_stage_fit,
+    update_normal_state,
+    warm_start_guess,
+    warm_start_path,
+)
+
+# The plotting functions are in campari.plotting, which imports matplotlib.
+# They can still be imported from here, but only import it when asked for.
+_PLOTTING = ("plot_lc", "plot_images", "plot_image_and_grid")
+
+
+def __getattr__(name):
+    if name in _PLOTTING:
+        from campari import plotting
+        return getattr(plotting, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+class NoNewExposures(Exception):
+    """Raised when an incremental fit has no exposures that are not already
+    in its saved state. There is nothing to do, which is not a failure."""
+
 
 # This supresses a warning because the Open Universe Simulations dates are not
 # FITS compliant.
@@ -271,318 +349,99 @@ def generateGuess(imlist, ra_grid, dec_grid):
     return all_vals/len(wcslist)
 
 
-def construct_psf_background(ra, dec, wcs, x_loc, y_loc, stampsize,
-                             psf=None, pixel=False,
-                             util_ref=None, band=None):
+def map_in_order(function, kwargs_list, workers=1, executor="thread"):
+    """Call function(**kwargs) for each kwargs in kwargs_list, in a pool of
+    threads or processes, and yield the results in the order of kwargs_list.
 
-    """Constructs the background model around a certain image (x,y) location
-    and a given array of RA and DECs.
     Inputs:
-    ra, dec: arrays of floats, RA and DEC values for the grid
-    wcs: the wcs of the image, if the image is a cutout, this MUST be the wcs
-        of the cutout. A snappl.wcs.BaseWCS object.
-    x_loc, y_loc: floats,the pixel location of the image in the FULL image,
-        i.e. x y location in the SCA.
-    stampsize: int, the size of the stamp being used
-    band: str, the bandpass being used
-    psf: Here you can provide a PSF to use, if you don't provide one, you must
-        provide a util_ref, and this function will calculate the Roman PSF
-        instead.
-    pixel: bool, If True, use a pixel tophat function to convolve the PSF with,
-        otherwise use a delta function. Does not seem to hugely affect results.
-    util_ref: A roman_imsim.utils.roman_utils object, which is used to
-        calculate the PSF. If you provide this, you don't need to provide a PSF
-        and the Roman PSF will be calculated. Note
-        that this needs to be for the correct SCA/Pointing combination.
-
-    Returns:
-    A numpy array of the PSFs at each grid point, with the shape
-    (stampsize*stampsize, npoints)
+    function: the function to call. For a process pool it, its arguments and
+              its results must be picklable.
+    kwargs_list: list of dicts of keyword arguments.
+    workers: int, size of the pool. With 1, the calls are made here, one at
+             a time.
+    executor: str, "thread" or "process".
+
+    Yields:
+    The result of each call.
     """
+    if executor not in ("thread", "process"):
+        raise ValueError(f"executor must be thread or process, not "
+                         f"{executor}.")
+    if workers <= 1:
+        for kwargs in kwargs_list:
+            yield function(**kwargs)
+        return
+
+    pool_class = ThreadPoolExecutor if executor == "thread" \
+        else ProcessPoolExecutor
+    with pool_class(max_workers=workers) as pool:
+        futures = collections.deque(pool.submit(function, **kwargs)
+                                    for kwargs in kwargs_list)
+        # Drop each result as it is handed out, so that they do not all have
+        # to be held in memory at once.
+        while futures:
+            yield futures.popleft().result()
 
-    assert util_ref is not None or psf is not None, "you must provide at \
-        least util_ref or psf"
-    assert util_ref is not None or band is not None, "you must provide at \
-        least util_ref or band"
 
-    # This is the WCS galsim uses to draw the PSF.
-    galsim_wcs = wcs.get_galsim_wcs()
-    x, y = wcs.world_to_pixel(ra, dec)
-
-    # With plus ones here I recover the values pre-refactor!
-
-    if psf is None:
-        # How different are these two methods? TODO XXX
-        pupil_bin = 8
-        # psf = util_ref.getPSF(x_loc, y_loc, pupil_bin=pupil_bin)
-        psf = galsim.roman.getPSF(1, band, pupil_bin=pupil_bin, wcs=galsim_wcs)
+def gaussian(x, A, mu, sigma):
+    """See name of function. :D"""
+    return A*np.exp(-(x-mu)**2/(2*sigma**2))
 
-    bpass = roman.getBandpasses()[band]
 
-    psfs = np.zeros((stampsize * stampsize, np.size(x)))
+# Whole SCA images are only cached if asked for (see get_sca_image), as each
+# one takes a couple of hundred MB.
+_sca_images = collections.OrderedDict()
+_sca_image_stats = {"hits": 0, "misses": 0}
 
-    sed = galsim.SED(galsim.LookupTable([100, 2600], [1, 1],
-                     interpolant="linear"),
-                     wave_type="nm", flux_type="fphotons")
 
-    if pixel:
-        point = galsim.Pixel(0.1)*sed
-    else:
-        point = galsim.DeltaFunction()
-        point *= sed
-
-    point = point.withFlux(1, bpass)
-    oversampling_factor = 1
-    convolvedpsf = galsim.Convolve(point, psf)
-    stamp = galsim.Image(stampsize*oversampling_factor,
-                         stampsize*oversampling_factor, wcs=galsim_wcs)
-    # Loop over the grid points, draw a PSF at each one, and append to a list.
-    for a, ij in enumerate(zip(x.flatten(), y.flatten())):
-        if a % 50 == 0:
-            Lager.debug(f"Drawing PSF {a} of {np.size(x)}")
-        i, j = ij
-        psfs[:, a] = convolvedpsf.drawImage(bpass, method="no_pixel",
-                                            center=galsim.PositionD(i, j),
-                                            use_true_center=True, image=stamp,
-                                            wcs=galsim_wcs).array.flatten()
-
-    return psfs
-
-
-def findAllExposures(snid, ra, dec, peak, start, end, band, maxbg=24,
-                     maxdet=24, return_list=False, stampsize=25,
-                     roman_path=None, pointing_list=None, SCA_list=None,
-                     truth="simple_model", lc_start=-np.inf, lc_end=np.inf):
-    """ This function finds all the exposures that contain a given supernova,
-    and returns a list of them. Utilizes Rob's awesome database method to
-    find the exposures. Humongous speed up thanks to this.
+def get_sca_image(imagepath, SCA, cache_size=0):
+    """Read a whole SCA image, keeping the cache_size most recently used ones
+    in memory, so that objects that share exposures only read them once.
 
     Inputs:
-    snid: the ID of the supernova
-    ra, dec: the RA and DEC of the supernova (TODO: Is this necessary if we're
-            passing the ID?)
-    peak: the peak of the supernova
-    start, end: the start and end of the observing window
-    maxbg: the maximum number of background images to consider
-    maxdet: the maximum number of detected images to consider
-    return_list: whether to return the exposures as a list or not
-    stampsize: the size of the stamp to use
-    roman_path: the path to the Roman data
-    pointing_list: If this is passed in, only consider these pointings
-    SCA_list: If this is passed in, only consider these SCAs
-    truth: If "truth" use truth images, if "simple_model" use simple model
-            images.
-    band: the band to consider
-    lc_start, lc_end: the start and end of the light curve window, in terms of
-                      time, in days, away from the peak.
-    """
+    imagepath: str, the path to the image file.
+    SCA: int, the SCA of the image.
+    cache_size: int, how many images to keep. With 0, nothing is kept.
 
-    f = fits.open(roman_path +
-                  "/RomanTDS/Roman_TDS_obseq_11_6_23_radec.fits")[1]
-    f = f.data
-
-    explist = tb.Table(names=("Pointing", "SCA", "BAND", "zeropoint", "RA",
-                              "DEC", "date", "true mag", "true flux",
-                              "realized flux"),
-                       dtype=("i8", "i4", "str", "f8", "f8", "f8", "f8",
-                              "f8", "f8", "f8"))
-
-    # Rob's database method! :D
-
-    server_url = "https://roman-desc-simdex.lbl.gov"
-    req = requests.Session()
-    result = req.post(f"{server_url}/findromanimages/containing=({ra},{dec})")
-    if result.status_code != 200:
-        raise RuntimeError(f"Got status code {result.status_code}\n"
-                           "{result.text}")
-
-    res = pd.DataFrame(result.json())[["filter", "pointing", "sca", "mjd"]]
-    res.rename(columns={"mjd": "date", "pointing": "Pointing", "sca": "SCA"},
-               inplace=True)
-
-    res = res.loc[res["filter"] == band]
-    det = res.loc[(res["date"] >= start) & (res["date"] <= end)].copy()
-    det["offpeak_time"] = det["date"] - peak
-    det = det.sort_values("offpeak_time")
-    if lc_start != -np.inf or lc_end != np.inf:
-        det = det.loc[(det["offpeak_time"] >= lc_start) &
-                      (det["offpeak_time"] <= lc_end)]
-    if isinstance(maxdet, int):
-        det = det.iloc[:maxdet]
-    det["DETECTED"] = True
-
-    if pointing_list is not None:
-        det = det.loc[det["Pointing"].isin(pointing_list)]
-
-    bg = res.loc[(res["date"] < start) | (res["date"] > end)].copy()
-    bg["offpeak_time"] = bg["date"] - peak
-    if lc_start != -np.inf or lc_end != np.inf:
-        bg = bg.loc[(bg["offpeak_time"] >= lc_start) &
-                    (bg["offpeak_time"] <= lc_end)]
-    if isinstance(maxbg, int):
-        bg = bg.iloc[:maxbg]
-    bg["DETECTED"] = False
-
-    # combine these two dataframes
-    all_images = pd.concat([det, bg])
-    all_images["zeropoint"] = np.nan
-
-    # Now we need to loop through the images and get the information we need
-    zpts = []
-    true_mag = []
-    true_fluxes = []
-    realized_fluxes = []
-    for index, row in all_images.iterrows():
-        cat = pd.read_csv(roman_path+f"/RomanTDS/truth/{band}/{row.Pointing}/"
-                          f"Roman_TDS_index_{band}_{row.Pointing}"
-                          f"_{row.SCA}.txt", sep=r"\s+", skiprows=1,
-                          names=["object_id", "ra", "dec", "x", "y",
-                                 "realized_flux", "flux", "mag", "obj_type"])
-        cat_star = cat.loc[cat["obj_type"] == "star"]
-        logflux = -2.5*np.log10(cat_star["flux"])
-        mag = cat_star["mag"]
-        zpt = np.mean(mag - logflux)
-        zpts.append(zpt)
-
-        if row.DETECTED:
-            try:
-                true_mag.append(cat.loc[cat["object_id"] == snid]
-                                .mag.values[0])
-                true_fluxes.append(cat.loc[cat["object_id"] == snid]
-                                   .flux.values[0])
-                realized_fluxes.append(cat.loc[cat["object_id"] == snid]
-                                       .realized_flux.values[0])
-
-            except Exception:
-                Lager.error(f"No truth file found for \
-                             {row.Pointing, row.SCA}")
-                true_mag.append(np.nan)
-                true_fluxes.append(np.nan)
-                realized_fluxes.append(np.nan)
-                continue
-
-        else:
-            true_mag.append(np.nan)
-            true_fluxes.append(np.nan)
-            realized_fluxes.append(np.nan)
-    all_images["zeropoint"] = zpts
-    all_images["true mag"] = true_mag
-    all_images["true flux"] = true_fluxes
-    all_images["realized flux"] = realized_fluxes
-    all_images["BAND"] = band
-
-    explist = Table.from_pandas(all_images)
-    explist.sort(["DETECTED", "SCA"])
-    Lager.info("\n" + str(explist))
-
-    if return_list:
-        return explist
-
-
-def find_parquet(ID, path, obj_type="SN"):
-    """Find the parquet file that contains a given supernova ID."""
-
-    files = os.listdir(path)
-    file_prefix = {"SN": "snana", "star": "pointsource"}
-    files = [f for f in files if file_prefix[obj_type] in f]
-    files = [f for f in files if ".parquet" in f]
-    files = [f for f in files if "flux" not in f]
-
-    for f in files:
-        pqfile = int(f.split("_")[1].split(".")[0])
-        df = open_parquet(pqfile, path, obj_type=obj_type)
-        # The issue is SN parquet files store their IDs as ints and star
-        # parquet files as strings.
-        # Should I convert the entire array or is there a smarter way to do
-        # this?
-        if ID in df.id.values or str(ID) in df.id.values:
-            return pqfile
-
-
-def open_parquet(parq, path, obj_type="SN", engine="fastparquet"):
-    """Convenience function to open a parquet file given its number."""
-    file_prefix = {"SN": "snana", "star": "pointsource"}
-    base_name = "{:s}_{}.parquet".format(file_prefix[obj_type], parq)
-    file_path = os.path.join(path, base_name)
-    Lager.debug(f"Opening parquet file: {file_path}")
-    df = pd.read_parquet(file_path, engine=engine)
-    return df
-
-
-def radec2point(RA, DEC, filt, path, start=None, end=None):
-    """This function takes in RA and DEC and returns the pointing and SCA with
-    center closest to desired RA/DEC
+    Returns:
+    image: snappl.image.OpenUniverse2024FITSImage object.
+    imagedata: 2D numpy array, the image data.
     """
-    f = fits.open(path+"/RomanTDS/Roman_TDS_obseq_11_6_23_radec.fits")[1]
-    f = f.data
-
-    allRA = f["RA"]
-    allDEC = f["DEC"]
-
-    pointing_sca_coords = SkyCoord(allRA*u.deg, allDEC*u.deg, frame="icrs")
-    search_coord = SkyCoord(RA*u.deg, DEC*u.deg, frame="icrs")
-    dist = pointing_sca_coords.separation(search_coord).arcsec
+    key = (imagepath, SCA)
+    if key in _sca_images:
+        _sca_image_stats["hits"] += 1
+        _sca_images.move_to_end(key)
+        return _sca_images[key]
+
+    _sca_image_stats["misses"] += 1
+    from snappl.image import OpenUniverse2024FITSImage
+    image = OpenUniverse2024FITSImage(imagepath, None, SCA)
+    imagedata, errordata, flags = image.get_data(which="all")
+    if cache_size > 0:
+        _sca_images[key] = image, imagedata
+        while len(_sca_images) > cache_size:
+            _sca_images.popitem(last=False)
+    return image, imagedata
+
+
+def cache_stats():
+    """The hits and misses of the caches this process keeps from one object
+    to the next.
 
-    dist[np.where(f["filter"] != filt)] = np.inf
-    reshaped_array = dist.flatten()
-    # Find the indices of the minimum values along the flattened slices
-    min_indices = np.argmin(reshaped_array, axis=0)
-    # Convert the flat indices back to 2D coordinates
-    rows, cols = np.unravel_index(min_indices, dist.shape[:2])
-
-    # The plus 1 is because the SCA numbering starts at 1
-    return rows, cols + 1
-
-
-def construct_psf_source(x, y, pointing, SCA, stampsize=25, x_center=None,
-                         y_center=None, sed=None, flux=1, photOps=True):
-    """Constructs the PSF around the point source (x,y) location, allowing for
-        some offset from the center.
-    Inputs:
-    x, y: ints, pixel coordinates where the cutout is centered in the SCA
-    pointing, SCA: ints, the pointing and SCA of the image
-    stampsize = int, size of cutout image used
-    x_center and y_center: floats, x and y location of the object in the SCA.
-    sed: galsim.sed.SED object, the SED of the source
-    flux: float, If you are using this function to build a model grid point,
-        this should be 1. If you are using this function to build a model of
-        a source, this should be the flux of the source.
-    Outputs:
-    psf_image: numpy array of floats of size stampsize**2, the image
-                of the PSF at the (x,y) location.
+    Returns:
+    dict, for each cache, a dict with its number of hits and misses.
     """
-    if not isinstance(x, int) or not isinstance(y, int):
-        raise TypeError(f"x and y must be integers, not {type(x), type(y)}")
-    Lager.debug(f"ARGS IN PSF SOURCE: \n x, y: {x, y} \n" +
-                f" Pointing, SCA: {pointing, SCA} \n" +
-                f" stamp size: {stampsize} \n" +
-                f" x_center, y_center: {x_center, y_center} \n" +
-                f" sed: {sed} \n" +
-                f" flux: {flux}")
-
-    assert sed is not None, "You must provide an SED for the source"
-
-    if not photOps:
-        # While I want to do this sometimes, it is very rare that you actually
-        # want to do this. Thus if it was accidentally on while doing a normal
-        # run, I'd want to know.
-        Lager.warning("NOT USING PHOTON OPS IN PSF SOURCE")
-
-    psf_object = PSF.get_psf_object("ou24PSF_slow", pointing=pointing, sca=SCA,
-                                    size=stampsize, include_photonOps=photOps)
-    psf_image = psf_object.get_stamp(x0=x, y0=y, x=x_center, y=y_center,
-                                     flux=1., seed=None)
-
-    return psf_image.flatten()
-
-
-def gaussian(x, A, mu, sigma):
-    """See name of function. :D"""
-    return A*np.exp(-(x-mu)**2/(2*sigma**2))
+    stats = {"sca_images": dict(_sca_image_stats),
+             "apertures": dict(_aperture_stats)}
+    for cached in [open_parquet, get_roman_utils, get_psf_object]:
+        info = cached.cache_info()
+        stats[cached.__name__] = {"hits": info.hits, "misses": info.misses}
+    return stats
 
 
 def constructImages(exposures, ra, dec, size=7, subtract_background=True,
-                    roman_path=None, truth="simple_model"):
+                    roman_path=None, truth="simple_model",
+                    image_cache_size=0):
 
     """Constructs the array of Roman images in the format required for the
     linear algebra operations.
@@ -593,6 +452,8 @@ def constructImages(exposures, ra, dec, size=7, subtract_background=True,
     subtract_background: If False, the background level is fit as a free
         parameter in the forward modelling. Otherwise, we subtract it here.
     roman_path: the path to the Roman data
+    image_cache_size: int, number of whole SCA images to keep in memory for
+                      the next objects, see get_sca_image.
 
     Returns:
     cutout_image_list: list of snappl.image.Image objects, cutouts on the
@@ -618,8 +479,8 @@ def constructImages(exposures, ra, dec, size=7, subtract_background=True,
         imagepath = roman_path + (f"/RomanTDS/images/{truth}/{band}/{pointing}"
                                   f"/Roman_TDS_{truth}_{band}_{pointing}_"
                                   f"{SCA}.fits.gz")
-        image = OpenUniverse2024FITSImage(imagepath, None, SCA)
-        imagedata, errordata, flags = image.get_data(which="all")
+        image, imagedata = get_sca_image(imagepath, SCA,
+                                         cache_size=image_cache_size)
         image_cutout = image.get_ra_dec_cutout(ra, dec, size)
 
         if truth == "truth":
@@ -656,6 +517,8 @@ def constructImages(exposures, ra, dec, size=7, subtract_background=True,
         bgflux.append(bg)  # This currently isn't returned, but might be a good
         # thing to put in output? TODO
 
+        # The cutout may share its data with the (cached) SCA image.
+        image_cutout._data = image_cutout._data.copy()
         image_cutout._data -= bg
         Lager.debug(f"Subtracted a background level of {bg}")
 
@@ -693,55 +556,10 @@ def calculate_background_level(im):
     return bg
 
 
-def getPSF_Image(self, stamp_size, x=None, y=None, x_center=None,
-                 y_center=None, pupil_bin=8, sed=None, oversampling_factor=1,
-                 include_photonOps=False, n_phot=1e6, pixel=False, flux=1):
-
-    if pixel:
-        point = galsim.Pixel(1)*sed
-        Lager.debug("Building a Pixel shaped PSF source")
-    else:
-        point = galsim.DeltaFunction()*sed
-
-    # Note the +1s in galsim.PositionD below; galsim uses 1-indexed pixel positions,
-    # whereas snappl uses 0-indexed pixel positions
-    x_center += 1
-    y_center += 1
-    x += 1
-    y += 1
-
-    point = point.withFlux(flux, self.bpass)
-    local_wcs = self.getLocalWCS(x, y)
-    wcs = galsim.JacobianWCS(dudx=local_wcs.dudx/oversampling_factor,
-                             dudy=local_wcs.dudy/oversampling_factor,
-                             dvdx=local_wcs.dvdx/oversampling_factor,
-                             dvdy=local_wcs.dvdy/oversampling_factor)
-    stamp = galsim.Image(stamp_size*oversampling_factor,
-                         stamp_size*oversampling_factor, wcs=wcs)
-
-    if not include_photonOps:
-        Lager.debug(f'in getPSF_Image: {self.bpass}, {x_center}, {y_center}')
-
-        psf = galsim.Convolve(point, self.getPSF(x, y, pupil_bin))
-        return psf.drawImage(self.bpass, image=stamp, wcs=wcs,
-                             method="no_pixel",
-                             center=galsim.PositionD(x_center, y_center),
-                             use_true_center=True)
-
-    photon_ops = [self.getPSF(x, y, pupil_bin)] + self.photon_ops
-    Lager.debug(f"Using {n_phot:e} photons in getPSF_Image")
-    result = point.drawImage(self.bpass, wcs=wcs, method="phot",
-                             photon_ops=photon_ops, rng=self.rng,
-                             n_photons=int(n_phot), maxN=int(n_phot),
-                             poisson_flux=False,
-                             center=galsim.PositionD(x_center, y_center),
-                             use_true_center=True, image=stamp)
-    return result
-
-
 def fetchImages(num_total_images, num_detect_images, ID, sn_path, band, size,
                 subtract_background, roman_path, object_type,
-                lc_start=-np.inf, lc_end=np.inf):
+                lc_start=-np.inf, lc_end=np.inf, skip_exposures=None,
+                image_cache_size=0):
     """This function gets the list of exposures to be used for the analysis.
 
     Inputs:
@@ -758,6 +576,11 @@ def fetchImages(num_total_images, num_detect_images, ID, sn_path, band, size,
     roman_path: str, the path to the Roman data
     obj_type: str, the type of object to be used (SN or star)
     lc_start, lc_end: ints, MJD bounds on where to fetch images.
+    skip_exposures: set of (Pointing, SCA) tuples or None. These exposures
+                    are dropped before any images are read, e.g. because
+                    they are already in an incremental state. If they are
+                    all the exposures, NoNewExposures is raised.
+    image_cache_size: int, passed on to constructImages.
 
     Returns:
     snra, sndec: floats, the RA and DEC of the supernova, a single float is
@@ -794,53 +617,25 @@ def fetchImages(num_total_images, num_detect_images, ID, sn_path, band, size,
         raise ValueError(f"Not Enough Exposures. \
             Found {len(exposures)} out of {num_total_images} requested")
 
+    if skip_exposures:
+        new = [(row["Pointing"], row["SCA"]) not in skip_exposures
+               for row in exposures]
+        exposures = exposures[new]
+        Lager.debug(f"Skipping {len(new) - len(exposures)} exposures, "
+                    f"{len(exposures)} new.")
+        if len(exposures) == 0:
+            raise NoNewExposures("No new exposures found, the saved state "
+                                 "is up to date.")
+
     cutout_image_list, image_list =\
         constructImages(exposures, ra, dec, size=size,
                         subtract_background=subtract_background,
-                        roman_path=roman_path)
+                        roman_path=roman_path,
+                        image_cache_size=image_cache_size)
 
     return snra, sndec, ra, dec, exposures, cutout_image_list, image_list
 
 
-def get_object_info(ID, parq, band, snpath, roman_path, obj_type):
-
-    """Fetch some info about an object given its ID.
-    Inputs:
-    ID: the ID of the object
-    parq: the parquet file containing the object
-    band: the band to consider
-    date: whether to return the start end and peak dates of the object
-    snpath: the path to the supernova data
-    roman_path: the path to the Roman data
-    host: whether to return the host RA and DEC
-
-    Returns:
-    ra, dec: the RA and DEC of the object
-    pointing, sca: the pointing and SCA of the object
-    start, end, peak: the start, end, and peak dates of the object
-    """
-
-    df = open_parquet(parq, snpath, obj_type=obj_type)
-    if obj_type == "star":
-        ID = str(ID)
-
-    df = df.loc[df.id == ID]
-    ra, dec = df.ra.values[0], df.dec.values[0]
-
-    if obj_type == "SN":
-        start = df.start_mjd.values
-        end = df.end_mjd.values
-        peak = df.peak_mjd.values
-    else:
-        start = [0]
-        end = [np.inf]
-        peak = [0]
-
-    pointing, sca = radec2point(ra, dec, band, roman_path)
-
-    return ra, dec, pointing, sca, start, end, peak
-
-
 def get_weights(images, snra, sndec, gaussian_var=1000, cutoff=4):
     """This function calculates the weights for each pixel in the cutout
         images.
@@ -972,229 +767,6 @@ def makeGrid(grid_type, images, ra, dec, percentiles=[],
     return ra_grid, dec_grid
 
 
-def plot_lc(filepath, return_data=False):
-    fluxdata = pd.read_csv(filepath, comment="#", delimiter=" ")
-    truth_mag = fluxdata["SIM_true_mag"]
-    mag = fluxdata["mag"]
-    sigma_mag = fluxdata["mag_err"]
-
-    plt.figure(figsize=(10, 10))
-    plt.subplot(2, 1, 1)
-
-    dates = fluxdata["MJD"]
-
-    plt.scatter(dates, truth_mag, color="k", label="Truth")
-    plt.errorbar(dates, mag, yerr=sigma_mag,  color="purple", label="Model",
-                 fmt="o")
-
-    plt.ylim(np.max(truth_mag) + 0.2, np.min(truth_mag) - 0.2)
-    plt.ylabel("Magnitude (Uncalibrated)")
-
-    residuals = mag - truth_mag
-    bias = np.mean(residuals)
-    bias *= 1000
-    bias = np.round(bias, 3)
-    scatter = np.std(residuals)
-    scatter *= 1000
-    scatter = np.round(scatter, 3)
-    props = dict(boxstyle="round", facecolor="wheat", alpha=0.8)
-    textstr = "Overall Bias: " + str(bias) + " mmag \n" + \
-        "Overall Scatter: " + str(scatter) + " mmag"
-    plt.text(np.percentile(dates, 60), np.mean(truth_mag), textstr,
-             fontsize=14, verticalalignment="top", bbox=props)
-    plt.legend()
-
-    plt.subplot(2, 1, 2)
-    plt.errorbar(dates, residuals, yerr=sigma_mag, fmt="o", color="k")
-    plt.axhline(0, ls="--", color="k")
-    plt.ylabel("Mag Residuals (Model - Truth)")
-
-    plt.ylabel("Mag Residuals (Model - Truth)")
-    plt.xlabel("MJD")
-    plt.ylim(np.min(residuals) - 0.1, np.max(residuals) + 0.1)
-
-    plt.axhline(0.005, color="r", ls="--")
-    plt.axhline(-0.005, color="r", ls="--", label="5 mmag photometry")
-
-    plt.axhline(0.02, color="b", ls="--")
-    plt.axhline(-0.02, color="b", ls="--", label="20 mmag photometry")
-    plt.legend()
-
-    if return_data:
-        return mag.values, dates.values, \
-            sigma_mag.values, truth_mag.values, bias, scatter
-
-
-def plot_images(fileroot, size=11):
-
-    imgdata = np.load("./results/images/"+str(fileroot)+"_images.npy")
-    num_total_images = imgdata.shape[1]//size**2
-    images = imgdata[0]
-    sumimages = imgdata[1]
-
-    fluxdata = pd.read_csv("./results/lightcurves/"+str(fileroot)+"_lc.csv")
-
-    snra, sndec = fluxdata["sn_ra"][0], fluxdata["sn_dec"][0]
-    galra, galdec = fluxdata["host_ra"][0], fluxdata["host_dec"][0]
-
-    hdul = fits.open("./results/images/"+str(fileroot)+"_wcs.fits")
-    cutout_wcs_list = []
-    for i, savedwcs in enumerate(hdul):
-        if i == 0:
-            continue
-        newwcs = snappl.AstropyWCS.from_header(savedwcs.header)
-        cutout_wcs_list.append(newwcs)
-
-    ra_grid, dec_grid, gridvals = np.load("./results/images/"
-                                          + str(fileroot)+"_grid.npy")
-
-    plt.figure(figsize=(15, 3*num_total_images))
-
-    for i, wcs in enumerate(cutout_wcs_list):
-
-        extent = [-0.5, size-0.5, -0.5, size-0.5]
-        xx, yy = cutout_wcs_list[i].world_to_pixel(ra_grid, dec_grid)
-        object_x, object_y = wcs.world_to_pixel(snra, sndec)
-        galx, galy = wcs.world_to_pixel(galra, galdec)
-
-        plt.subplot(len(cutout_wcs_list), 4, 4*i+1)
-        vmin = np.mean(gridvals) - np.std(gridvals)
-        vmax = np.mean(gridvals) + np.std(gridvals)
-        plt.scatter(xx, yy, s=1, c="k", vmin=vmin, vmax=vmax)
-        plt.title("True Image")
-        plt.scatter(object_x, object_y, c="r", s=8, marker="*")
-        plt.scatter(galx, galy, c="b", s=8, marker="*")
-        imshow = plt.imshow(images[i*size**2:
-                            (i+1)*size**2].reshape(size, size),
-                            origin="lower", extent=extent)
-        plt.colorbar(fraction=0.046, pad=0.04)
-
-        ############################################
-
-        plt.subplot(len(cutout_wcs_list), 4, 4*i+2)
-        plt.title("Model")
-
-        im1 = sumimages[i*size**2:(i+1)*size**2].reshape(size, size)
-        xx, yy = cutout_wcs_list[i].world_to_pixel(ra_grid, dec_grid)
-
-        vmin = imshow.get_clim()[0]
-        vmax = imshow.get_clim()[1]
-
-        plt.imshow(im1, extent=extent, origin="lower", vmin=vmin, vmax=vmax)
-        plt.colorbar(fraction=0.046, pad=0.04)
-
-        ############################################
-        plt.subplot(len(cutout_wcs_list), 4, 4*i+3)
-        plt.title("Residuals")
-        vmin = np.mean(gridvals) - np.std(gridvals)
-        vmax = np.mean(gridvals) + np.std(gridvals)
-        plt.scatter(xx, yy, s=1, c=gridvals,  vmin=vmin, vmax=vmax)
-        res = images - sumimages
-        current_res = res[i*size**2:(i+1)*size**2].reshape(size, size)
-        plt.imshow(current_res, extent=extent, origin="lower", cmap="seismic",
-                   vmin=-100, vmax=100)
-        plt.colorbar(fraction=0.046, pad=0.14)
-
-    plt.subplots_adjust(wspace=0.4, hspace=0.3)
-
-
-def get_galsim_SED(SNID, date, sn_path, fetch_SED, obj_type="SN"):
-    """Return the appropriate SED for the object on the day. Since SN SEDs
-    are time dependent but stars are not, we need to handle them differently.
-
-    Inputs:
-    SNID: the ID of the object
-    date: the date of the observation
-    sn_path: the path to the supernova data
-    fetch_SED: If true, fetch true SED from the database, otherwise return a
-                flat SED.
-    obj_type: the type of object (SN or star)
-
-    Internal Variables:
-    lam: the wavelength of the SED in Angstrom
-    flambda: the flux of the SED units in erg/s/cm^2/Angstrom
-
-    Returns:
-    sed: galsim.SED object
-    """
-    if fetch_SED:
-        if obj_type == "SN":
-            lam, flambda = get_SN_SED(SNID, date, sn_path)
-        if obj_type == "star":
-            lam, flambda = get_star_SED(SNID, sn_path)
-    else:
-        lam, flambda = [1000, 26000], [1, 1]
-
-    sed = galsim.SED(galsim.LookupTable(lam, flambda, interpolant="linear"),
-                     wave_type="Angstrom", flux_type="fphotons")
-
-    return sed
-
-
-def get_star_SED(SNID, sn_path):
-    """Return the appropriate SED for the star.
-    Inputs:
-    SNID: the ID of the object
-    sn_path: the path to the supernova data
-
-    Returns:
-    lam: the wavelength of the SED in Angstrom (numpy  array of floats)
-    flambda: the flux of the SED units in erg/s/cm^2/Angstrom
-             (numpy array of floats)
-    """
-    filenum = find_parquet(SNID, sn_path, obj_type="star")
-    pqfile = open_parquet(filenum, sn_path, obj_type="star")
-    file_name = pqfile[pqfile["id"] == str(SNID)]["sed_filepath"].values[0]
-    # SED needs to move out to snappl
-    fullpath = pathlib.Path(Config.get().value("photometry.campari." +
-                            "paths.sims_sed_library")) / file_name
-    sed_table = pd.read_csv(fullpath,  compression="gzip", sep=r"\s+",
-                            comment="#")
-    lam = sed_table.iloc[:, 0]
-    flambda = sed_table.iloc[:, 1]
-    return np.array(lam), np.array(flambda)
-
-
-def get_SN_SED(SNID, date, sn_path):
-    """Return the appropriate SED for the supernova on the given day.
-
-    Inputs:
-    SNID: the ID of the object
-    date: the date of the observation
-    sn_path: the path to the supernova data
-
-    Returns:
-    lam: the wavelength of the SED in Angstrom
-    flambda: the flux of the SED units in erg/s/cm^2/Angstrom
-    """
-    filenum = find_parquet(SNID, sn_path, obj_type="SN")
-    file_name = "snana" + "_" + str(filenum) + ".hdf5"
-    fullpath = os.path.join(sn_path, file_name)
-    # Setting locking=False on the next line becasue it seems that you can't
-    #   open an h5py file unless you have write access to... something.
-    #   Not sure what.  The directory where it exists?  We won't
-    #   always have that.  It's scary to set locking to false, because it
-    #   subverts all kinds of safety stuff that hdf5 does.  However,
-    #   because these files were created once in this case, it's not actually
-    #   scary, and we expect them to be static.  Locking only matters if you
-    #   think somebody else might change the file
-    #   while you're in the middle of reading bits of it.
-    sed_table = h5py.File(fullpath, "r", locking=False)
-    sed_table = sed_table[str(SNID)]
-    flambda = sed_table["flambda"]
-    lam = sed_table["lambda"]
-    mjd = sed_table["mjd"]
-    bestindex = np.argmin(np.abs(np.array(mjd) - date))
-    max_days_cutoff = 10
-    closest_days_away = np.min(np.abs(np.array(mjd) - date))
-
-    if closest_days_away > max_days_cutoff:
-        Lager.warning(f"WARNING: No SED data within {max_days_cutoff} days of "
-                      + "date. \n The closest SED is " + closest_days_away +
-                      " days away.")
-    return np.array(lam), np.array(flambda[bestindex])
-
-
 def make_contour_grid(image, wcs, numlevels=None, percentiles=[0, 90, 98, 100],
                       subsize=4):
     """Construct a "contour grid" which allocates model grid points to model
@@ -1267,6 +839,7 @@ def make_contour_grid(image, wcs, numlevels=None, percentiles=[0, 90, 98, 100],
 
     Lager.debug(f"Using levels: {levels} in make_contour_grid")
 
+    from scipy.interpolate import RegularGridInterpolator
     interp = RegularGridInterpolator((x, y), image, method="linear",
                                      bounds_error=False, fill_value=None)
 
@@ -1308,150 +881,6 @@ def make_contour_grid(image, wcs, numlevels=None, percentiles=[0, 90, 98, 100],
     return ra_grid, dec_grid
 
 
-def calc_mag_and_err(flux, sigma_flux, band, zp=None):
-    """This function calculates the magnitude and magnitude error from the
-       flux.
-
-    flux: float or array of floats, the flux
-    sigma_flux: float or array of floats, the flux error
-    band: str, the bandpass of the images used
-    zp: float, the zeropoint of the bandpass. If None, use the galsim-
-                calculated value.
-
-    Returns:
-    mag: float or array of floats, the AB magnitude
-    magerr: float or array of floats, the magnitude error
-    zp: float, the zeropoint of the bandpass
-    """
-
-    exptime = {"F184": 901.175,
-               "J129": 302.275,
-               "H158": 302.275,
-               "K213": 901.175,
-               "R062": 161.025,
-               "Y106": 302.275,
-               "Z087": 101.7}
-
-    area_eff = roman.collecting_area
-    zp = roman.getBandpasses()[band].zeropoint if zp is None else zp
-    mag = -2.5 * np.log10(flux) + 2.5*np.log10(exptime[band]*area_eff) + zp
-    magerr = (2.5 / np.log(10) * (sigma_flux / flux))
-    magerr[flux < 0] = np.nan
-    return mag, magerr, zp
-
-
-def build_lightcurve(ID, exposures, sn_path, confusion_metric, flux,
-                     use_roman, band, object_type, sigma_flux):
-
-    """This code builds a lightcurve datatable from the output of the SMP
-       algorithm.
-
-    Input:
-    ID (int): supernova ID
-    exposures (table): table of exposures used in the SMP algorithm
-    sn_path (str): path to supernova data
-    confusion_metric (float): the confusion metric derived in the SMP algorithm
-    num_detect_images (int): number of detection images in the lightcurve
-    X (array): the output of the SMP algorithm
-    use_roman (bool): whether or not the lightcurve was built using Roman PSF
-    band (str): the bandpass of the images used
-
-    Returns:
-    lc: a QTable containing the lightcurve data
-    """
-
-    detections = exposures[np.where(exposures["DETECTED"])]
-    parq_file = find_parquet(ID, path=sn_path, obj_type=object_type)
-    df = open_parquet(parq_file, path=sn_path, obj_type=object_type)
-
-    mag, magerr, zp = calc_mag_and_err(flux, sigma_flux, band)
-    sim_sigma_flux = 0  # These are truth values!
-    sim_realized_mag, _, _ = calc_mag_and_err(detections["realized flux"],
-                                              sim_sigma_flux, band)
-    sim_true_mag, _, _ = calc_mag_and_err(detections["true flux"],
-                                          sim_sigma_flux, band)
-    if object_type == "SN":
-        df_object_row = df.loc[df.id == ID]
-    if object_type == "star":
-        df_object_row = df.loc[df.id == str(ID)]
-
-    if object_type == "SN":
-        meta_dict = {"confusion_metric": confusion_metric,
-                     "host_sep": df_object_row["host_sn_sep"].values[0],
-                     "host_mag_g": df_object_row["host_mag_g"].values[0],
-                     "obj_ra": df_object_row["ra"].values[0],
-                     "obj_dec": df_object_row["dec"].values[0],
-                     "host_ra": df_object_row["host_ra"].values[0],
-                     "host_dec": df_object_row["host_dec"].values[0]}
-    else:
-        meta_dict = {"ra": df_object_row["ra"].values[0],
-                     "dec": df_object_row["dec"].values[0]}
-
-    data_dict = {"MJD": detections["date"], "flux": flux,
-                 "flux_error": sigma_flux, "mag": mag,
-                 "mag_err": magerr,
-                 "band": np.full(np.size(mag), band),
-                 "zeropoint": np.full(np.size(mag), zp),
-                 "SIM_realized_flux": detections["realized flux"],
-                 "SIM_true_flux": detections["true flux"],
-                 "SIM_realized_mag": sim_realized_mag,
-                 "SIM_true_mag": sim_true_mag}
-    units = {"MJD": u.d, "SIM_realized_flux": "",  "flux": "",
-             "flux_error": "", "SIM_realized_mag": "",
-             "SIM_true_flux": "", "SIM_true_mag": ""}
-
-    return QTable(data=data_dict, meta=meta_dict, units=units)
-
-
-def build_lightcurve_sim(supernova, flux, sigma_flux):
-    """This code builds a lightcurve datatable from the output of the SMP
-        algorithm if the user simulated their own lightcurve.
-
-    Inputs
-    supernova (array): the true lightcurve
-    num_detect_images (int): number of detection images in the lightcurve
-    X (array): the output of the SMP algorithm
-
-    Returns
-    lc: a QTable containing the lightcurve data
-    """
-    sim_MJD = np.arange(0, np.size(supernova), 1)
-    data_dict = {"MJD": sim_MJD, "flux": flux,
-                 "flux_error": sigma_flux, "SIM_flux": supernova}
-    meta_dict = {}
-    units = {"MJD": u.d, "SIM_flux": "",  "flux": "", "flux_error": ""}
-    return QTable(data=data_dict, meta=meta_dict, units=units)
-
-
-def save_lightcurve(lc, identifier, band, psftype, output_path=None,
-                    overwrite=True):
-    """This function parses settings in the SMP algorithm and saves the
-    lightcurve to an ecsv file with an appropriate name.
-    Input:
-    lc: the lightcurve data
-    identifier (str): the supernova ID or "simulated"
-    band (str): the bandpass of the images used
-    psftype (str): "romanpsf" or "analyticpsf"
-    output_path (str): the path to save the lightcurve to.  Defaults to
-      config value phtometry.campari.paths.output_dir
-
-    Returns:
-    None, saves the lightcurve to a ecsv file.
-    The file name is:
-    <output_path>/identifier_band_psftype_lc.ecsv
-    """
-
-    output_path = Config.get().value("photometry.campari.paths.output_dir") \
-        if output_path is None else output_path
-    output_path = pathlib.Path(output_path)
-    output_path.mkdir(exist_ok=True, parents=True)
-
-    lc_file = output_path / f"{identifier}_{band}_{psftype}_lc.ecsv"
-
-    Lager.info(f"Saving lightcurve to {lc_file}")
-    lc.write(lc_file, format="ascii.ecsv", overwrite=overwrite)
-
-
 def banner(text):
     length = len(text) + 8
     message = "\n" + "#" * length + "\n"+"#   " + text + "   # \n" + "#" \
@@ -1459,176 +888,145 @@ def banner(text):
     Lager.debug(message)
 
 
-def get_galsim_SED_list(ID, exposures, fetch_SED, object_type, sn_path):
-    sedlist = []
-    """
-    Return the appropriate SED for the object for each observation.
-    If you are getting truth SEDs, this function calls get_SED on each exposure
-    of the object. Then, get_SED calls get_SN_SED or get_star_SED depending on
-    the object type.
-    If you are not getting truth SEDs, this function returns a flat SED for
-    each exposure.
+def plan_object(ID, num_total_images, num_detect_images, sn_path, band, size,
+                subtract_background, roman_path, object_type, grid_type,
+                percentiles=[], lc_start=-np.inf, lc_end=np.inf,
+                cost_model=None, **modes):
+    """Work out the size of the fit of an object without fitting it: find
+    its exposures and build its background grid, as run_one_object would,
+    and estimate its memory and run time with estimate_cost.
 
     Inputs:
-    ID: the ID of the object
-    exposures: the exposure table returned by fetchImages.
-    fetch_SED: If true, get the SED from truth tables.
-               If false, return a flat SED for each expsoure.
-    object_type: the type of object (SN or star)
-    sn_path: the path to the supernova data
+    ID ... lc_end: as for fetchImages and makeGrid.
+    cost_model: passed on to estimate_cost.
+    modes: the solver modes passed on to estimate_cost (use_fft_operator,
+           out_of_core, use_float32, two_stage).
 
     Returns:
-    sedlist: list of galsim SED objects, length equal to the number of
-             detection images.
+    dict with the ID, the number of images, detection images and grid
+    points, the (pointing, SCA) of each exposure, the estimate from
+    estimate_cost, and memory_bytes_out_of_core,
+    the memory the fit would need with out_of_core.
     """
-    for date in exposures["date"][exposures["DETECTED"]]:
-        sed = get_galsim_SED(ID, date, sn_path, obj_type=object_type,
-                             fetch_SED=fetch_SED)
-        sedlist.append(sed)
-
-    return sedlist
+    _, _, ra, dec, exposures, cutout_image_list, _ = \
+        fetchImages(num_total_images, num_detect_images, ID, sn_path, band,
+                    size, subtract_background, roman_path, object_type,
+                    lc_start=lc_start, lc_end=lc_end)
+    num_grid = 0
+    if grid_type != "none":
+        ra_grid, _ = makeGrid(grid_type, cutout_image_list, ra, dec,
+                              percentiles=percentiles)
+        num_grid = np.size(ra_grid)
+
+    num_total_images = len(exposures)
+    plan = {"ID": ID, "num_total_images": num_total_images,
+            "num_detect_images": int(np.sum(exposures["DETECTED"])),
+            "num_grid": num_grid,
+            "exposures": [[int(pointing), int(SCA)] for pointing, SCA in
+                          zip(exposures["Pointing"], exposures["SCA"])]}
+    plan.update(estimate_cost(num_total_images, num_grid, size,
+                              subtract_background, cost_model=cost_model,
+                              **modes))
+    plan["memory_bytes_out_of_core"] = \
+        estimate_cost(num_total_images, num_grid, size, subtract_background,
+                      out_of_core=True)["memory_bytes"]
+    return plan
+
+
+def _construct_epoch_model_counted(**kwargs):
+    """construct_epoch_model, in a worker process of the epoch pool.
 
+    Returns:
+    the models of construct_epoch_model, and the counters (e.g. psf_draws)
+    added while building them, which the recording of the parent process does
+    not see.
+    """
+    start_recording()
+    try:
+        models = construct_epoch_model(**kwargs)
+    finally:
+        counters = stop_recording()["counters"]
+    return models, counters
 
-def prep_data_for_fit(images, sn_matrix, wgt_matrix):
-    """This function takes the data from the images and puts it into the form
-    such that we can analytically solve for the best fit using linear algebra.
 
-    n = total number of images
-    s = image size (so the image is s x s)
-    d = number of detection images
+def assemble_epoch_models(epoch_kwargs, psf_matrix, size, out_of_core=False,
+                          subtract_background=True, epoch_workers=1,
+                          epoch_executor="thread"):
+    """Build the model of each image with construct_epoch_model, in a pool
+    (see map_in_order), and put them together as they come in. All of this
+    is the psfs stage.
 
     Inputs:
-    images: list of snappl Image objects. List of length n objects.
-    sn_matrix: list of np arrays of SN models. List of length d of sxs arrays.
-    wgt_matrix: list of np arrays of weights. List of length n of sxs arrays.
-
-    Outputs:
-    images: 1D array of image data. Length n*s^2
-    err: 1D array of error data. Length n*s^2
-    sn_matrix: A 2D array of SN models, with the SN models placed in the
-                correct rows and columns, see comment below. Shape (n*s^2, n)
-    wgt_matrix: 1D array of weights. Length n*s^2
-    """
-    Lager.debug("Prep data for fit")
-    size_sq = images[0].image_shape[0]**2
-    tot_num = len(images)
-    det_num = len(sn_matrix)
-
-    # Flatten into 1D arrays
-    err = np.concatenate([im.noise.flatten() for im in images])
-    image_data = np.concatenate([im.data.flatten() for im in images])
-
-    # The final design matrix for our fit should have dimensions:
-    # (total number of pixels in all images, number of model components)
-    # Then, the first s^2 rows of the matrix correspond to the first image,
-    # the next s^2 rows to the second image, etc.,  where s is the size of the
-    # image. For the SN model, the flux in each image is ostensibly different.
-    # Therefore we need a unique flux for each image, and we don't want the
-    # flux of the supernova in one image to affect the flux in another image.
-    # Therefore, we need to place the supernova model in the correct image
-    # (i.e. the correct rows of the design matrix) and zero out all of the
-    # others. We'll do this by initializing a matrix of zeros, and then filling
-    # in the SN model in the correct place in the loop below:
-
-    psf_zeros = np.zeros((np.size(image_data), tot_num))
-    for i in range(det_num):
-        sn_index = tot_num - det_num + i  # We only want to edit SN columns.
-        psf_zeros[
-            (sn_index) * size_sq:  # Fill in rows s^2 * image number...
-            (sn_index + 1) * size_sq,  # ... to s^2 * (image number + 1) ...
-            sn_index] = sn_matrix[i]  # ...in the correct column.
-    sn_matrix = np.vstack(psf_zeros)
-    wgt_matrix = np.array(wgt_matrix)
-    wgt_matrix = np.hstack(wgt_matrix)
-
-    return image_data, err, sn_matrix, wgt_matrix
-
-
-def extract_sn_from_parquet_file_and_write_to_csv(parquet_file, sn_path,
-                                                  output_path,
-                                                  mag_limits=None):
-    """Convenience function for getting a list of SN IDs that obey some
-    conditions from a parquet file. This is not used anywhere in the main
-    algorithm.
+    epoch_kwargs: list of dicts, the arguments of construct_epoch_model for
+                  each image.
+    psf_matrix: with out_of_core, the design matrix on disk (see
+                allocate_design_matrix), which the grid, sky and SN columns
+                of each image are written into. Otherwise an empty list,
+                which the grid columns of each image are appended to.
+    size: int, the size of the cutouts.
+    out_of_core, subtract_background: as in run_one_object.
+    epoch_workers, epoch_executor: passed on to map_in_order. With a process
+                                   pool, the counters the workers add are
+                                   added to the recording of this process,
+                                   their stage times and memory are not.
 
-    Inputs:
-    parquet_file: the path to the parquet file
-    sn_path: the path to the supernova data
-    mag_limits: a tuple of (min_mag, max_mag) to filter the SNe by
-                peak magnitude. If None, no filtering is done.
-
-    Output:
-    Saves a csv file of the SN_IDs of supernovae from the parquet file that
-    pass mag cuts. If none are found, raise a ValueError.
+    Returns:
+    psf_matrix: see above.
+    sn_matrix: list of the SN PSFs of the images with detections.
+    psf_kernels, kernel_starts, kernel_min: for the FFT operator, the PSF
+                                            kernel of each image, where it
+                                            starts, and the offset of the
+                                            kernels (None without it).
     """
-    # Get the supernova IDs from the parquet file
-    df = open_parquet(parquet_file, sn_path, obj_type="SN")
-    if mag_limits is not None:
-        min_mag, max_mag = mag_limits
-        # This can't always be just g band I think. TODO
-        df = df[(df["peak_mag_g"] >= min_mag) & (df["peak_mag_g"] <= max_mag)]
-    SN_ID = df.id.values
-    SN_ID = SN_ID[np.log10(SN_ID) < 8]  # The 9 digit SN_ID SNe are weird for
-    # some reason. They only seem to have 1 or 2 images ever. TODO
-    SN_ID = np.array(SN_ID, dtype=int)
-    Lager.info(f"Found {np.size(SN_ID)} supernovae in the given range.")
-    if np.size(SN_ID) == 0:
-        raise ValueError("No supernovae found in the given range.")
-
-    pd.DataFrame(SN_ID).to_csv(output_path, index=False, header=False)
-    Lager.info(f"Saved to {output_path}")
-
-
-def extract_star_from_parquet_file_and_write_to_csv(parquet_file, sn_path,
-                                                    output_path,
-                                                    ra=None,
-                                                    dec=None,
-                                                    radius=None):
-    """Convenience function for getting a list of star IDs
-    from a parquet file. The stars can be cone-searched for by passing a
-    central coordinate and a radius.
-    This is not used anywhere in the main algorithm.
+    num_total_images = len(epoch_kwargs)
+    num_grid_columns = np.size(epoch_kwargs[0]["ra_grid"]) if epoch_kwargs \
+        else 0
+    num_bg_columns = num_grid_columns
+    if not subtract_background:
+        num_bg_columns += num_total_images
+    sn_matrix = []
+    psf_kernels = []
+    kernel_starts = []
+    kernel_min = None
+    # map_in_order is a generator, the models are only built as they are
+    # taken from it, so all of that has to be in the stage.
+    merge_counters = epoch_executor == "process" and epoch_workers > 1 \
+        and recording()
+    with stage("psfs"):
+        epoch_models = map_in_order(
+            _construct_epoch_model_counted if merge_counters
+            else construct_epoch_model, epoch_kwargs, workers=epoch_workers,
+            executor=epoch_executor)
+        for i, models in enumerate(epoch_models):
+            if merge_counters:
+                models, counters = models
+                for name, n in counters.items():
+                    count(name, n)
+            background_model_array, psf_source_array, kernel, kernel_min, \
+                start = models
+            Lager.debug("Constructed model for image " + str(i))
+            if kernel is not None:
+                psf_kernels.append(kernel)
+                kernel_starts.append(start)
+
+            # Add the array of the model points to the matrix of all
+            # components of the model. In memory, the sky columns (if using)
+            # are added all at once in run_one_object.
+            if out_of_core:
+                image_rows = slice(i * size**2, (i + 1) * size**2)
+                psf_matrix[image_rows, :num_grid_columns] = \
+                    background_model_array
+                if not subtract_background:
+                    psf_matrix[image_rows, num_grid_columns + i] = 1
+            else:
+                psf_matrix.append(background_model_array)
 
-    Inputs:
-    parquet_file: int,  the number label of the parquet file to use.
-    sn_path: str, the path to the supernova data
-    ra: float, the central RA of the region to search in
-    dec: float, the central Dec of the region to search in
-    radius: float, the radius over which cone search is performed. Can have
-                    any angular astropy.unit attached to it. If no unit is
-                    included, the function will produce a warning and then
-                    automatically assume you meant degrees.
-    If no ra, dec, and radius are passed, no cone search
-    is performed and the IDs of the entire parquet file are returned.
-    If one or two of the above arguments is passed but not all three, the
-    cone search is not performed.
-
-    Output:
-    Saves a csv file to output_path of the IDs of stars from the parquet
-    file that pass location cuts. If none are found, raise a ValueError.
-    """
-    if not hasattr(radius, "unit") and radius is not None:
-        Lager.warning("extract_star_from_parquet_file_and_write_to_csv " +
-                      "a radius argument with no units. Assuming degrees.")
-        radius *= u.deg
-
-    df = open_parquet(parquet_file, sn_path, obj_type="star")
-    df = df[df["object_type"] == "star"]
-
-    if radius is not None and (ra is not None and dec is not None):
-        center_coord = SkyCoord(ra*u.deg, dec*u.deg)
-        df_coords = SkyCoord(ra=df["ra"].values*u.deg,
-                             dec=df["dec"].values*u.deg)
-        sep = center_coord.separation(df_coords)
-        df = df[sep < radius]
-
-    star_ID = df.id.values
-    star_ID = np.array(star_ID, dtype=int)
-    Lager.info(f"Found {np.size(star_ID)} stars in the given range.")
-    if np.size(star_ID) == 0:
-        raise ValueError("No stars found in the given range.")
-    pd.DataFrame(star_ID).to_csv(output_path, index=False, header=False)
-    Lager.info(f"Saved to {output_path}")
+            if psf_source_array is not None:
+                sn_matrix.append(psf_source_array)
+                if out_of_core:
+                    psf_matrix[image_rows, num_bg_columns + i] = \
+                        psf_source_array
+    return psf_matrix, sn_matrix, psf_kernels, kernel_starts, kernel_min
 
 
 def run_one_object(ID, object_type, num_total_images, num_detect_images,
@@ -1640,16 +1038,73 @@ def run_one_object(ID, object_type, num_total_images, num_detect_images,
                    mismatch_seds, deltafcn_profile, noise, check_perfection,
                    avoid_non_linearity, sim_gal_ra_offset, sim_gal_dec_offset,
                    spacing, percentiles,
-                   draw_method_for_non_roman_psf="no_pixel"):
+                   draw_method_for_non_roman_psf="no_pixel",
+                   use_fft_operator=False, out_of_core=False,
+                   scratch_dir=None, use_float32=False, two_stage=False,
+                   state_dir=None, cache_dir=None, precondition=False,
+                   flux_rtol=None, design=None, epoch_workers=1,
+                   epoch_executor="thread", image_cache_size=0,
+                   closed_form=False):
     Lager.debug(f"ID: {ID}")
+    # If design is a dict, the in-memory design matrix, weights and pixel
+    # values are put in it, so they can be reused with factor_design_matrix
+    # and friends without rebuilding the PSFs.
+    if design is not None and (use_fft_operator or out_of_core):
+        raise ValueError("design can only be returned for an in-memory "
+                         "design matrix.")
+    # The design matrix, weights and images are stored in this dtype. The
+    # solution itself is always refined in double precision.
+    dtype = np.float32 if use_float32 else np.float64
+    # With no grid and no sky to fit the epochs are independent, and if
+    # asked for, the fluxes are solved in closed form instead of with lsqr.
+    if closed_form and not (
+            grid_type == "none" and subtract_background and method == "lsqr"
+            and design is None and cache_dir is None and state_dir is None
+            and not (use_fft_operator or out_of_core or use_float32 or
+                     two_stage)):
+        raise ValueError("closed_form needs grid_type none, "
+                         "subtract_background and method lsqr, and can not "
+                         "be used with another solver mode (use_fft_operator,"
+                         " out_of_core, use_float32, two_stage, incremental, "
+                         "warm_start or design).")
     psf_matrix = []
-    sn_matrix = []
+    # The sparse sky columns, if they are kept out of the dense design
+    # matrix, see sky_design_operator.
+    sky_block = None
 
     # This is a catch for when I'm doing my own simulated WCSs
     util_ref = None
 
     percentiles = []
-    roman_bandpasses = galsim.roman.getBandpasses()
+
+    # In incremental mode the normal equations of the exposures already fit
+    # are kept in state_dir, and only new exposures are read and modelled.
+    incremental = state_dir is not None
+    state = None
+    skip_exposures = None
+    if incremental:
+        if not use_real_images or use_fft_operator or two_stage:
+            raise ValueError("Incremental updates need real images, and "
+                             "can not be used with use_fft_operator or "
+                             "two_stage.")
+        state_file = pathlib.Path(state_dir) / f"{ID}_{band}_state.npz"
+        # state_version 2 keeps QR factors, not normal matrices. Older states
+        # do not match these settings and are refit from scratch.
+        settings = {"size": size, "subtract_background": subtract_background,
+                    "weighting": weighting, "grid_type": grid_type,
+                    "state_version": 2}
+        if state_file.exists():
+            state, old_exposures, ra_grid, dec_grid, old_settings = \
+                load_normal_state(state_file)
+            if old_settings != settings:
+                Lager.warning(f"{state_file} was made with {old_settings}, "
+                              f"not {settings}. Refitting from scratch.")
+                state = None
+            else:
+                skip_exposures = set(zip(old_exposures["Pointing"].tolist(),
+                                         old_exposures["SCA"].tolist()))
+                Lager.debug(f"Loaded state with {state['num_images']} "
+                            "images.")
 
     if use_real_images:
         # Find SN Info, find exposures containing it,
@@ -1657,16 +1112,22 @@ def run_one_object(ID, object_type, num_total_images, num_detect_images,
         # TODO: Calculate peak MJD outside of the function
 
         # images, err,
-        snra, sndec, ra, dec, \
-            exposures, cutout_image_list, image_list = \
-            fetchImages(num_total_images, num_detect_images, ID,
-                        sn_path, band, size, subtract_background,
-                        roman_path, object_type, lc_start=lc_start,
-                        lc_end=lc_end)
+        with stage("images"):
+            snra, sndec, ra, dec, \
+                exposures, cutout_image_list, image_list = \
+                fetchImages(num_total_images, num_detect_images, ID,
+                            sn_path, band, size, subtract_background,
+                            roman_path, object_type, lc_start=lc_start,
+                            lc_end=lc_end, skip_exposures=skip_exposures,
+                            image_cache_size=image_cache_size)
         num_total_images = len(exposures)
         num_detect_images = len(exposures[exposures["DETECTED"]])
         Lager.debug(f"Updating image numbers to {num_total_images}" +
                     f" and {num_detect_images}")
+        # The exposures modelled in this run. In incremental mode exposures
+        # becomes the whole history below, for the lightcurve, but the
+        # images, model, weights and cutout WCSs are only of these.
+        new_exposures = exposures
 
     else:
         # Simulate the images of the SN and galaxy.
@@ -1683,16 +1144,21 @@ def run_one_object(ID, object_type, num_total_images, num_detect_images,
                             mismatch_seds=mismatch_seds)
         object_type = "SN"
         err = np.ones_like(images)
+        new_exposures = None
 
-    sedlist = get_galsim_SED_list(ID, exposures, fetch_SED, object_type,
-                                  sn_path)
+    with stage("seds"):
+        sedlist = get_galsim_SED_list(ID, exposures, fetch_SED, object_type,
+                                      sn_path)
 
     # Build the background grid
-    if not grid_type == "none":
+    if state is not None:
+        Lager.debug("Using the background grid of the incremental state.")
+    elif not grid_type == "none":
         if object_type == "star":
             Lager.warning("For fitting stars, you probably dont want a grid.")
-        ra_grid, dec_grid = makeGrid(grid_type, cutout_image_list, ra, dec,
-                                     percentiles=percentiles)
+        with stage("grid"):
+            ra_grid, dec_grid = makeGrid(grid_type, cutout_image_list, ra,
+                                         dec, percentiles=percentiles)
     else:
         ra_grid = np.array([])
         dec_grid = np.array([])
@@ -1703,8 +1169,9 @@ def run_one_object(ID, object_type, num_total_images, num_detect_images,
     # make sense.
     num_nondetect_images = num_total_images - num_detect_images
     if make_initial_guess and num_nondetect_images != 0:
-        x0test = generateGuess(cutout_image_list[:num_nondetect_images],
-                               ra_grid, dec_grid)
+        with stage("guess"):
+            x0test = generateGuess(cutout_image_list[:num_nondetect_images],
+                                   ra_grid, dec_grid)
         x0_vals_for_sne = np.full(num_total_images, initial_flux_guess)
         x0test = np.concatenate([x0test, x0_vals_for_sne], axis=0)
         Lager.debug(f"setting initial guess to {initial_flux_guess}")
@@ -1741,132 +1208,195 @@ def run_one_object(ID, object_type, num_total_images, num_detect_images,
         confusion_metric = 0
         Lager.debug("Confusion Metric not calculated")
 
-    # Build the backgrounds loop
-    # TODO: Zip all the things you index [i] on directly and loop over
-    # them.
-    for i in range(num_total_images):
-        # Passing in None for the PSF means we use the Roman PSF.
-        drawing_psf = None if use_roman else airy
-
-        whole_sca_wcs = image_list[i].get_wcs()
-        object_x, object_y = whole_sca_wcs.world_to_pixel(ra, dec)
-
-        # Build the model for the background using the correct psf and the
-        # grid we made in the previous section.
+    if use_fft_operator:
+        if grid_type != "regular":
+            raise ValueError("use_fft_operator requires grid_type regular, "
+                             f"not {grid_type}.")
+        _, grid_spacing, oversample, grid_width = \
+            regular_grid_geometry(ra_grid, dec_grid,
+                                  cutout_image_list[0].get_wcs())
+        Lager.debug(f"FFT background operator: {grid_width}x{grid_width} "
+                    f"grid, spacing {grid_spacing}, oversampling "
+                    f"{oversample}")
+
+    if use_float32 and use_fft_operator:
+        raise ValueError("use_float32 and use_fft_operator can not be used "
+                         "together, the FFT operator does not build a design "
+                         "matrix.")
+    if two_stage and use_fft_operator:
+        raise ValueError("two_stage and use_fft_operator can not be used "
+                         "together, the FFT operator does not build a design "
+                         "matrix.")
+
+    if out_of_core:
+        if use_fft_operator:
+            raise ValueError("out_of_core and use_fft_operator can not be "
+                             "used together, the FFT operator does not "
+                             "build a design matrix.")
+        # Stream each image's block of the design matrix to disk as it is
+        # built, rather than holding the whole thing in memory.
+        num_grid_columns = np.size(ra_grid)
+        num_bg_columns = num_grid_columns
+        if not subtract_background:
+            num_bg_columns += num_total_images
+        scratch = tempfile.TemporaryDirectory(dir=scratch_dir)
+        psf_matrix = allocate_design_matrix(scratch.name,
+                                            (num_total_images * size**2,
+                                             num_bg_columns + num_total_images),
+                                            dtype=dtype)
 
+    # Build the backgrounds loop
+    # Passing in None for the PSF means we use the Roman PSF.
+    drawing_psf = None if use_roman else airy
+    tds_file = None
+    if use_real_images:
         # TODO: Put this in snappl
+        tds_file = pathlib.Path(Config.get().value
+                                ("photometry.campari.galsim.tds_file"))
+    Lager.debug(f"ra_grid {ra_grid[:5]}")
+    Lager.debug(f"dec_grid {dec_grid[:5]}")
+
+    # The images are independent, so their models can be built in parallel,
+    # they are put together in order below.
+    epoch_kwargs = []
+    for i in range(num_total_images):
         if use_real_images:
-            util_ref = roman_utils(config_file=pathlib.Path(Config.get().value
-                                   ("photometry.campari.galsim.tds_file")),
-                                   visit=exposures["Pointing"][i],
-                                   sca=exposures["SCA"][i])
-
-        # If no grid, we still need something that can be concatenated in the
-        # linear algebra steps, so we initialize an empty array by default.
-        background_model_array = np.empty((size**2, 0))
-        Lager.debug(f"ra_grid {ra_grid[:5]}")
-        Lager.debug(f"dec_grid {dec_grid[:5]}")
-        Lager.debug("Constructing background model array for image " + str(i))
-        if grid_type != "none":
-            background_model_array = \
-                construct_psf_background(ra_grid, dec_grid,
-                                         cutout_image_list[i].get_wcs(),
-                                         object_x, object_y, size, psf=drawing_psf,
-                                         pixel=pixel,
-                                         util_ref=util_ref, band=band)
-
-        # TODO comment this
-        if not subtract_background:
-            for j in range(num_total_images):
-                if i == j:
-                    bg = np.ones(size**2).reshape(-1, 1)
-                else:
-                    bg = np.zeros(size**2).reshape(-1, 1)
-                background_model_array =\
-                    np.concatenate([background_model_array, bg], axis=1)
-
-        # Add the array of the model points and the background (if using)
-        # to the matrix of all components of the model.
-        psf_matrix.append(background_model_array)
-
+            pointing = int(exposures["Pointing"][i])
+            SCA = int(exposures["SCA"][i])
+        else:
+            pointing = 662
+            SCA = 11
         # TODO make this not bad
-        if num_detect_images != 0 and \
-           i >= num_total_images - num_detect_images:
-            if use_roman:
-                if use_real_images:
-                    pointing = exposures["Pointing"][i]
-                    SCA = exposures["SCA"][i]
-                else:
-                    pointing = 662
-                    SCA = 11
-                # sedlist is the length of the number of supernova
-                # detection images. Therefore, when we iterate onto the
-                # first supernova image, we want to be on the first element
-                # of sedlist. Therefore, we subtract by the number of
-                # predetection images: num_total_images - num_detect_images.
-                sn_index = i - (num_total_images - num_detect_images)
-                Lager.debug(f"Using SED #{sn_index}")
-                sed = sedlist[sn_index]
-                # object_x and object_y are the exact coords of the SN in the SCA frame.
-                # x and y are the pixels the image has been cut out on, and
-                # hence must be ints. Before, I had object_x and object_y as SN coords in the cutout frame, hence this switch.
-                # In snappl, centers of pixels occur at integers, so the center of the lower left pixel is (0,0).
-                # Therefore, if you are at (0.2, 0.2), you are in the lower left pixel, but at (0.6, 0.6), you have
-                # crossed into the next pixel, which is (1,1). So we need to round everything between -0.5 and 0.5 to 0,
-                # and everything between 0.5 and 1.5 to 1, etc. This code below does that, and follows how snappl does
-                # it. For more detail, see the docstring of get_stamp in the PSF class definition of snappl.
-                x = int(np.floor(object_x + 0.5))
-                y = int(np.floor(object_y + 0.5))
-                Lager.debug(f"x, y, object_x, object_y, {x, y, object_x, object_y}")
-                psf_source_array =\
-                    construct_psf_source(x, y, pointing, SCA,
-                                         stampsize=size, x_center=object_x,
-                                         y_center=object_y, sed=sed,
-                                         photOps=source_phot_ops)
-            else:
-                stamp = galsim.Image(size, size, wcs=cutout_wcs_list[i])
-                profile = galsim.DeltaFunction()*sed
-                profile = profile.withFlux(1, roman_bandpasses[band])
-                convolved = galsim.Convolve(profile, drawing_psf)
-                psf_source_array =\
-                    convolved.drawImage(roman_bandpasses[band],
-                                        method=draw_method_for_non_roman_psf,
-                                        image=stamp,
-                                        wcs=cutout_wcs_list[i],
-                                        center=(object_x, object_y),
-                                        use_true_center=True,
-                                        add_to_image=False)
-                psf_source_array = psf_source_array.array.flatten()
-
-            sn_matrix.append(psf_source_array)
+        detected = num_detect_images != 0 and \
+            i >= num_total_images - num_detect_images
+        # sedlist is the length of the number of supernova detection images.
+        # Therefore, when we iterate onto the first supernova image, we want
+        # to be on the first element of sedlist. Therefore, we subtract by
+        # the number of predetection images.
+        sn_index = i - (num_total_images - num_detect_images)
+        epoch_kwargs.append(
+            {"sca_wcs": image_list[i].get_wcs(),
+             "cutout_wcs": cutout_image_list[i].get_wcs(),
+             "ra": ra, "dec": dec, "ra_grid": ra_grid, "dec_grid": dec_grid,
+             "size": size, "band": band, "grid_type": grid_type,
+             "psf": drawing_psf, "pixel": pixel,
+             "util_ref": None if use_real_images else util_ref,
+             "tds_file": tds_file, "pointing": pointing, "SCA": SCA,
+             "sed": sedlist[sn_index] if detected else None,
+             "galsim_wcs": cutout_wcs_list[i] if detected and not use_roman
+             else None,
+             "source_phot_ops": source_phot_ops,
+             "draw_method_for_non_roman_psf": draw_method_for_non_roman_psf,
+             "oversample": oversample if use_fft_operator else None,
+             "dtype": dtype})
+
+    psf_matrix, sn_matrix, psf_kernels, kernel_starts, kernel_min = \
+        assemble_epoch_models(epoch_kwargs, psf_matrix, size,
+                              out_of_core=out_of_core,
+                              subtract_background=subtract_background,
+                              epoch_workers=epoch_workers,
+                              epoch_executor=epoch_executor)
 
     banner("Lin Alg Section")
-    psf_matrix = np.vstack(np.array(psf_matrix))
-    Lager.debug(f"{psf_matrix.shape} psf matrix shape")
-
-    # Add in the supernova images to the matrix in the appropriate location
-    # so that it matches up with the image it represents.
-    # All others should be zero.
-
-    # Get the weights
-    if weighting:
-        wgt_matrix = get_weights(cutout_image_list, snra, sndec)
+    if use_fft_operator or out_of_core or closed_form:
+        # None of these need the dense SN matrix from prep_data_for_fit.
+        images = np.concatenate([im.data.flatten() for im in
+                                 cutout_image_list]).astype(dtype)
+        err = np.concatenate([im.noise.flatten() for im in
+                              cutout_image_list]).astype(dtype)
+        if weighting:
+            with stage("weights"):
+                wgt_matrix = np.hstack(get_weights(cutout_image_list, snra,
+                                                   sndec)).astype(dtype)
+        else:
+            wgt_matrix = np.ones_like(images)
+
+    if use_fft_operator:
+        # The design matrix is never built, the operator applies it (and its
+        # transpose) with FFTs.
+        psf_matrix = \
+            build_fft_design_operator(psf_kernels, kernel_min, kernel_starts,
+                                      grid_spacing, oversample, grid_width,
+                                      size, sn_matrix, num_total_images,
+                                      fit_background=not subtract_background)
+        weighted_psf_matrix = \
+            sp.linalg.aslinearoperator(sp.diags(wgt_matrix)) @ psf_matrix
+    elif out_of_core:
+        psf_matrix.flush()
+        Lager.debug(f"{psf_matrix.shape} psf matrix shape (on disk)")
+        if not (use_float32 or two_stage or incremental):
+            weighted_psf_matrix = chunked_design_operator(psf_matrix,
+                                                          wgt_matrix)
+    elif closed_form:
+        # This has no columns, psf_only_photometry uses the SN stamps as they
+        # are.
+        psf_matrix = np.vstack(psf_matrix)
     else:
-        wgt_matrix = np.ones(psf_matrix.shape[1])
-
-    images, err, sn_matrix, wgt_matrix =\
-        prep_data_for_fit(cutout_image_list, sn_matrix, wgt_matrix)
-
-    # Calculate amount of the PSF cut out by setting a distance cap
-    test_sn_matrix = np.copy(sn_matrix)
-    test_sn_matrix[np.where(wgt_matrix == 0), :] = 0
-    Lager.debug(f"SN PSF Norms Pre Distance Cut:{np.sum(sn_matrix, axis=0)}")
-    Lager.debug("SN PSF Norms Post Distance Cut:"
-                f"{np.sum(test_sn_matrix, axis=0)}")
-
-    # Combine the background model and the supernova model into one matrix.
-
-    psf_matrix = np.hstack([psf_matrix, sn_matrix])
+        # vstack the list directly, np.array would make a second full copy.
+        psf_matrix = np.vstack(psf_matrix)
+        Lager.debug(f"{psf_matrix.shape} psf matrix shape")
+
+        # Add in the supernova images to the matrix in the appropriate
+        # location so that it matches up with the image it represents.
+        # All others should be zero.
+
+        # Get the weights
+        if weighting:
+            with stage("weights"):
+                wgt_matrix = get_weights(cutout_image_list, snra, sndec)
+        else:
+            wgt_matrix = np.ones(psf_matrix.shape[1])
+
+        with stage("prep"):
+            images, err, sn_matrix, wgt_matrix =\
+                prep_data_for_fit(cutout_image_list, sn_matrix, wgt_matrix,
+                                  dtype=dtype)
+
+        # Calculate amount of the PSF cut out by setting a distance cap
+        test_sn_matrix = np.copy(sn_matrix)
+        test_sn_matrix[np.where(wgt_matrix == 0), :] = 0
+        Lager.debug("SN PSF Norms Pre Distance Cut:"
+                    f"{np.sum(sn_matrix, axis=0)}")
+        Lager.debug("SN PSF Norms Post Distance Cut:"
+                    f"{np.sum(test_sn_matrix, axis=0)}")
+
+        # Combine the background model and the supernova model into one
+        # matrix. If we are fitting the sky, there is one sky level per
+        # image, i.e. a column that is one in the rows of that image and zero
+        # everywhere else. These are kept as a sparse block, and applied
+        # with the dense grid and SN columns by sky_design_operator. The
+        # other solvers, and design, need one dense matrix.
+        num_grid = np.size(ra_grid)
+        dense_matrix = np.hstack([psf_matrix, sn_matrix])
+        dense_solver = use_float32 or two_stage or incremental or \
+            design is not None
+        if not subtract_background and not dense_solver:
+            sky_block = sky_indicator_block(num_total_images, size,
+                                            dtype=dtype)
+            psf_matrix = sky_design_operator(dense_matrix, sky_block,
+                                             num_grid)
+            weighted_psf_matrix = sky_design_operator(dense_matrix, sky_block,
+                                                      num_grid, wgt_matrix)
+        else:
+            if not subtract_background:
+                psf_matrix = np.hstack([
+                    dense_matrix[:, :num_grid],
+                    sky_indicator_block(num_total_images, size,
+                                        dtype=dtype).toarray(),
+                    dense_matrix[:, num_grid:]])
+            else:
+                psf_matrix = dense_matrix
+            del dense_matrix
+            if not (use_float32 or two_stage or incremental):
+                # lsqr_with_refinement weights on the fly, a weighted copy
+                # would cost as much memory as the float32 storage saves.
+                weighted_psf_matrix = psf_matrix*wgt_matrix.reshape(-1, 1)
+
+    note("design_matrix_shape", list(psf_matrix.shape))
+    if design is not None:
+        design.update(psf_matrix=psf_matrix, wgt_matrix=wgt_matrix,
+                      images=images, num_total_images=num_total_images,
+                      num_detect_images=num_detect_images, size=size)
 
     banner("Solving Photometry")
 
@@ -1881,28 +1411,143 @@ def run_one_object(ID, object_type, num_total_images, num_detect_images,
     Lager.debug(f"shape wgt_matrix: {wgt_matrix.reshape(-1, 1).shape}")
     Lager.debug(f"image shape: {images.shape}")
 
-    if method == "lsqr":
-        lsqr = sp.linalg.lsqr(psf_matrix*wgt_matrix.reshape(-1, 1),
-                              images*wgt_matrix, x0=x0test, atol=1e-12,
-                              btol=1e-12, iter_lim=300000, conlim=1e10)
-        X, istop, itn, r1norm = lsqr[:4]
-        Lager.debug(f"Stop Condition {istop}, iterations: {itn}," +
-                    f"r1norm: {r1norm}")
-    flux = X[-num_detect_images:]
-    inv_cov = psf_matrix.T @ np.diag(wgt_matrix) @ psf_matrix
+    # Seed lsqr with the solution of a previous run of this object, if there
+    # is one.
+    itn = -1
+    warm_started = False
+    if cache_dir is not None:
+        if not use_real_images:
+            raise ValueError("The warm start cache needs real images.")
+        cache_file = warm_start_path(cache_dir, ID, band,
+                                     {"grid_type": grid_type,
+                                      "spacing": spacing, "size": size,
+                                      "subtract_background":
+                                      subtract_background})
+        if cache_file.exists() and not incremental:
+            num_grid = np.size(ra_grid)
+            grid_guess = np.zeros(num_grid) if x0test is None \
+                else x0test[:num_grid]
+            flux_guess = initial_flux_guess if make_initial_guess else 0
+            x0test, cached_itn = \
+                warm_start_guess(cache_file, ra_grid, dec_grid, exposures,
+                                 not subtract_background, grid_guess,
+                                 flux_guess)
+            warm_started = True
+
+    # The solution for the images modelled in this run.
+    model_X = None
+    if closed_form:
+        with stage("solve"):
+            # lsqr keeps the initial guess of the fluxes it can not move.
+            # (Without make_initial_guess, x0test has no SN columns here,
+            # the closed form psf_matrix has none.)
+            sn_guess = None
+            if x0test is not None and np.size(x0test) >= num_total_images:
+                sn_guess = x0test[-num_total_images:]
+            X, sigma_flux, closed_form_model = \
+                psf_only_photometry(sn_matrix, images, wgt_matrix,
+                                    num_total_images, x0=sn_guess)
+        flux = X[-num_detect_images:]
+    elif incremental:
+        if state is None:
+            state = new_normal_state(np.size(ra_grid),
+                                     fit_background=not subtract_background)
+        else:
+            exposures = tb.vstack([old_exposures, exposures])
+        with stage("solve"):
+            state, new_columns = update_normal_state(state, psf_matrix,
+                                                     images, wgt_matrix,
+                                                     num_total_images)
+            X, cov, sn_columns = solve_normal_state(state)
+        save_normal_state(state_file, state, exposures, ra_grid, dec_grid,
+                          settings)
+        model_X = X[new_columns]
+        detected = np.asarray(exposures["DETECTED"], dtype=bool)
+        flux = X[sn_columns][detected]
+        sigma_flux = np.sqrt(np.diag(cov)[sn_columns][detected])
+    elif two_stage:
+        num_grid = np.size(ra_grid)
+        with stage("solve"):
+            X, flux_cov = \
+                two_stage_fit(psf_matrix, images, wgt_matrix,
+                              num_total_images, num_detect_images, size,
+                              num_grid, fit_background=not subtract_background,
+                              x0=None if x0test is None else x0test[:num_grid])
+        flux = X[-num_detect_images:]
+        Lager.debug(f"flux cov diag: {np.diag(flux_cov)}")
+        sigma_flux = np.sqrt(np.diag(flux_cov))
+    else:
+        flux_columns = np.arange(psf_matrix.shape[1] - num_detect_images,
+                                 psf_matrix.shape[1])
+        if method == "lsqr" and use_float32:
+            with stage("solve"):
+                X, itn = lsqr_with_refinement(psf_matrix, wgt_matrix, images,
+                                              x0=x0test,
+                                              precondition=precondition,
+                                              flux_columns=flux_columns,
+                                              flux_rtol=flux_rtol)
+            Lager.debug(f"Mixed precision lsqr iterations: {itn}")
+        elif method == "lsqr":
+            with stage("solve"):
+                X, istop, itn = solve_lsqr(weighted_psf_matrix,
+                                           images*wgt_matrix, x0=x0test,
+                                           precondition=precondition,
+                                           flux_columns=flux_columns,
+                                           flux_rtol=flux_rtol)
+            Lager.info(f"{ID}: lsqr stop condition {istop}, iterations: "
+                       f"{itn}")
+        if itn >= 0:
+            count("lsqr_iterations", itn)
+        flux = X[-num_detect_images:]
+        with stage("covariance"):
+            if use_fft_operator:
+                inv_cov = normal_matrix_from_operator(psf_matrix, wgt_matrix)
+            elif sky_block is not None:
+                inv_cov = sky_normal_matrix(dense_matrix, sky_block, num_grid,
+                                            wgt_matrix)
+            elif out_of_core or use_float32:
+                # Accumulate in double precision, even if stored in single.
+                inv_cov = chunked_normal_matrix(psf_matrix,
+                                                wgt_matrix.astype(np.float64))
+            else:
+                inv_cov = psf_matrix.T @ np.diag(wgt_matrix) @ psf_matrix
 
-    try:
-        cov = np.linalg.inv(inv_cov)
-    except LinAlgError:
-        cov = np.linalg.pinv(inv_cov)
+            try:
+                cov = np.linalg.inv(inv_cov)
+            except LinAlgError:
+                cov = np.linalg.pinv(inv_cov)
 
-    Lager.debug(f"cov diag: {np.diag(cov)[-num_detect_images:]}")
-    sigma_flux = np.sqrt(np.diag(cov)[-num_detect_images:])
+        Lager.debug(f"cov diag: {np.diag(cov)[-num_detect_images:]}")
+        sigma_flux = np.sqrt(np.diag(cov)[-num_detect_images:])
     Lager.debug(f"sigma flux: {sigma_flux}")
 
+    if cache_dir is not None:
+        # itn is -1 for the solvers that do not use the joint lsqr.
+        if itn >= 0 and warm_started:
+            Lager.info(f"lsqr took {itn} iterations warm started from the "
+                       f"cache, the cached run took {cached_itn}.")
+        elif itn >= 0:
+            Lager.info(f"lsqr took {itn} iterations, no warm start cached.")
+        save_warm_start(cache_file, X, ra_grid, dec_grid, exposures,
+                        not subtract_background, iterations=itn)
+
     # Using the values found in the fit, construct the model images.
-    pred = X*psf_matrix
-    sumimages = np.sum(pred, axis=1)
+    if model_X is None:
+        model_X = X
+    with stage("model"):
+        if closed_form:
+            sumimages = closed_form_model
+        elif use_fft_operator or sky_block is not None:
+            sumimages = psf_matrix.matvec(model_X)
+        elif out_of_core:
+            sumimages = chunked_design_operator(psf_matrix).matvec(model_X)
+            del psf_matrix
+            scratch.cleanup()
+        elif use_float32 or two_stage or incremental:
+            sumimages = chunked_design_operator(psf_matrix).matvec(model_X)
+        else:
+            pred = model_X*psf_matrix
+            sumimages = np.sum(pred, axis=1)
 
     # TODO: Move this to a separate function
     if check_perfection:
@@ -1924,11 +1569,4 @@ def run_one_object(ID, object_type, num_total_images, num_detect_images,
         sim_lc = np.zeros(num_detect_images)
     return flux, sigma_flux, images, sumimages, exposures, ra_grid, dec_grid, \
         wgt_matrix, confusion_metric, X, \
-        [im.get_wcs() for im in cutout_image_list], sim_lc
-
-
-def plot_image_and_grid(image, wcs, ra_grid, dec_grid):
-    Lager.debug(f"WCS: {type(wcs)}")
-    fig, ax = plt.subplots(subplot_kw=dict(projection=wcs))
-    plt.imshow(image, origin="lower", cmap="gray")
-    plt.scatter(ra_grid, dec_grid)
+        [im.get_wcs() for im in cutout_image_list], sim_lc, new_exposures
@@ -1,7 +1,16 @@
 # Standard Library
 import argparse
+import collections
+import functools
+import json
+import multiprocessing
+import os
 import pathlib
+import time
+import traceback
 import warnings
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
 
 # Common Library
 import galsim
@@ -17,7 +26,31 @@ from snpit_utils.config import Config
 from snpit_utils.logger import SNLogger as Lager
 
 # Campari
-from campari.AllASPFuncs import banner, build_lightcurve, build_lightcurve_sim, run_one_object, save_lightcurve
+from campari.AllASPFuncs import (
+    banner,
+    build_lightcurve,
+    build_lightcurve_sim,
+    cache_stats,
+    fit_cost_model,
+    install_aperture_cache,
+    NoNewExposures,
+    plan_object,
+    run_one_object,
+    save_lightcurve,
+)
+from campari.daemon import serve
+from campari.instrument import (
+    current_report,
+    max_rss_mb,
+    memory_summary,
+    recording,
+    stage,
+    start_recording,
+    stop_recording,
+)
+from campari.manifest import add_to_manifest, claim_next, manifest_status, mark_finished, settings_hash
+from campari.metrics import MetricsWriter
+from campari.profiling import PROFILE_MODES, profiled
 
 # This supresses a warning because the Open Universe Simulations dates are not
 # FITS compliant.
@@ -101,6 +134,61 @@ def main():
                         help="Path to a csv file containing a list of "
                              "OpenUniverse SNIDs to run.")
 
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Number of worker processes to run the objects "
+                             "in. With more than one, a summary of the run "
+                             "is saved in the output directory.")
+    parser.add_argument("--manifest", nargs="?", const="", default=None,
+                        help="Keep track of which objects have been run in "
+                             "this SQLite manifest (by default "
+                             "campari_manifest.sqlite in the output "
+                             "directory), and only run the ones that are "
+                             "not done yet. Several jobs can share one "
+                             "manifest.")
+    parser.add_argument("--max-attempts", type=int, default=3,
+                        help="With --manifest, how many times to try an "
+                             "object before leaving it as failed.")
+    parser.add_argument("--stale-after", type=float, default=None,
+                        help="With --manifest, seconds after which an "
+                             "object that is still marked as running is "
+                             "assumed to have been cut off, and is run "
+                             "again.")
+    parser.add_argument("--plan", action="store_true",
+                        help="Do not fit anything, instead find the "
+                             "exposures and grid of each object and "
+                             "estimate the memory and run time of its fit. "
+                             "The estimates are saved as plan_<band>.json in "
+                             "the output directory.")
+    parser.add_argument("--schedule", type=str, default=None,
+                        help="A plan saved by --plan. The objects are run "
+                             "longest first, and objects that do not fit in "
+                             "memory_budget_gb are run out of core, or "
+                             "skipped if that does not fit either.")
+    parser.add_argument("--calibrate", type=str, default=None,
+                        help="A plan saved by --plan, for objects that have "
+                             "since been run with --workers. Fit the cost "
+                             "model to their run times in "
+                             "batch_summary_<band>.json, log it and exit.")
+    parser.add_argument("--cluster", type=int, default=None,
+                        help="With --schedule, group objects that share "
+                             "exposures into clusters of at most this many, "
+                             "and run each cluster in one worker, so that "
+                             "they reuse each other's images and PSFs. Cache "
+                             "hit rates and throughput per cluster are "
+                             "added to the batch summary. With --manifest, "
+                             "objects are still claimed one at a time, in "
+                             "cluster order.")
+    parser.add_argument("--serve", nargs="?", const="", default=None,
+                        help="Do not run any objects, instead wait for fit "
+                             "requests on this UNIX socket (by default "
+                             "campari_<band>.sock in the output directory) "
+                             "and reply with their lightcurves. See "
+                             "campari.daemon.")
+    parser.add_argument("--blas-threads", type=int, default=None,
+                        help="Number of BLAS threads in each worker. "
+                             "Defaults to the number of cores divided by "
+                             "--workers.")
+
     # If instead you give --ra and --dec, it will assume there is a
     # point source at that position and will scene model a stamp around
     # it. (NOT YET SUPPORTED.)
@@ -166,6 +254,8 @@ def main():
 
     if args.img_list is not None:
         raise NotImplementedError( "--img-list not yet supported." )
+    if SNID is None and args.serve is None:
+        raise ValueError("Must pass --SNID, --SNID-file or --serve.")
 
     num_total_images = args.num_total_images
     num_detect_images = args.num_detect_images
@@ -203,6 +293,25 @@ def main():
     spacing = config.value("photometry.campari.grid_options.spacing")
     percentiles = config.value("photometry.campari.grid_options.percentiles")
     grid_type = config.value("photometry.campari.grid_options.type")
+    use_fft_operator = config.value("photometry.campari.grid_options.use_fft_operator")
+    out_of_core = config.value("photometry.campari.out_of_core")
+    use_float32 = config.value("photometry.campari.use_float32")
+    two_stage = config.value("photometry.campari.two_stage_fit")
+    closed_form = config.value("photometry.campari.closed_form")
+    incremental = config.value("photometry.campari.incremental")
+    warm_start = config.value("photometry.campari.warm_start")
+    precondition = config.value("photometry.campari.precondition")
+    flux_rtol = config.value("photometry.campari.flux_rtol")
+    epoch_workers = config.value("photometry.campari.epoch_workers")
+    epoch_executor = config.value("photometry.campari.epoch_executor")
+    image_cache_size = config.value("photometry.campari.sca_image_cache_size")
+    cost_model = config.value("photometry.campari.cost_model")
+    memory_budget_gb = config.value("photometry.campari.memory_budget_gb")
+    profile = config.value("photometry.campari.profile")
+    metrics_interval = config.value("photometry.campari.metrics_interval")
+    debug_dir = pathlib.Path(config.value("photometry.campari.paths.debug_dir"))
+    state_dir = pathlib.Path(config.value("photometry.campari.paths.state_dir")) if incremental else None
+    cache_dir = pathlib.Path(config.value("photometry.campari.paths.cache_dir")) if warm_start else None
 
 
     er = f"{grid_type} is not a recognized grid type. Available options are "
@@ -210,90 +319,753 @@ def main():
     assert grid_type in ["regular", "adaptive", "contour",
                          "single", "none"], er
 
-    # PSF for when not using the Roman PSF:
-    lam = 1293  # nm
-    aberrations = galsim.roman.getPSF(1, band, pupil_bin=1).aberrations
-    airy = galsim.ChromaticOpticalPSF(lam, diam=2.36,
-                                      aberrations=aberrations)
+    airy = airy_psf(band)
 
     if make_exact:
         assert grid_type == "single"
+    if use_fft_operator:
+        assert grid_type == "regular", "use_fft_operator requires a regular grid."
+        assert not out_of_core, "use_fft_operator and out_of_core are mutually exclusive."
+        assert not use_float32, "use_fft_operator and use_float32 are mutually exclusive."
+        assert not two_stage, "use_fft_operator and two_stage_fit are mutually exclusive."
+    if incremental:
+        assert use_real_images, "incremental needs real images."
+        assert not use_fft_operator, "use_fft_operator and incremental are mutually exclusive."
+        assert not two_stage, "two_stage_fit and incremental are mutually exclusive."
+    if warm_start:
+        assert use_real_images, "warm_start needs real images."
+    if closed_form:
+        assert grid_type == "none", "closed_form needs grid_options.type none."
+        assert subtract_background, "closed_form needs subtract_background."
+        assert method == "lsqr", "closed_form replaces the lsqr method."
+        assert not (use_fft_operator or out_of_core or use_float32 or two_stage
+                    or incremental or warm_start), \
+            "closed_form can not be used with another solver mode."
+    assert epoch_executor in ["thread", "process"], \
+        f"epoch_executor must be thread or process, not {epoch_executor}."
+    assert not profile or profile in PROFILE_MODES, \
+        f"profile must be one of {PROFILE_MODES}, not {profile}."
     if avoid_non_linearity:
         assert deltafcn_profile
     assert num_detect_images <= num_total_images
 
     galsim.roman.roman_psfs._make_aperture.clear()  # clear cache
+    aperture_cache_dir = config.value("photometry.campari.paths.aperture_cache_dir")
+    if aperture_cache_dir is not None:
+        install_aperture_cache(aperture_cache_dir)
 
     if not isinstance(SNID, list):
         SNID = [SNID]
     Lager.debug("Snappl version:")
     Lager.debug(snappl.__version__)
-    # run one supernova function TODO
-    for ID in SNID:
-        banner(f"Running SN {ID}")
+
+    run_kwargs = {"object_type": object_type,
+                  "num_total_images": num_total_images,
+                  "num_detect_images": num_detect_images,
+                  "roman_path": roman_path, "sn_path": sn_path, "size": size,
+                  "band": band, "fetch_SED": fetch_SED,
+                  "use_real_images": use_real_images, "use_roman": use_roman,
+                  "subtract_background": subtract_background,
+                  "make_initial_guess": make_initial_guess,
+                  "initial_flux_guess": initial_flux_guess,
+                  "weighting": weighting, "method": method,
+                  "grid_type": grid_type, "pixel": pixel,
+                  "source_phot_ops": source_phot_ops, "lc_start": lc_start,
+                  "lc_end": lc_end, "do_xshift": do_xshift,
+                  "bg_gal_flux": bg_gal_flux, "do_rotation": do_rotation,
+                  "airy": airy, "mismatch_seds": mismatch_seds,
+                  "deltafcn_profile": deltafcn_profile, "noise": noise,
+                  "check_perfection": check_perfection,
+                  "avoid_non_linearity": avoid_non_linearity,
+                  "sim_gal_ra_offset": sim_gal_ra_offset,
+                  "sim_gal_dec_offset": sim_gal_dec_offset,
+                  "spacing": spacing, "percentiles": percentiles,
+                  "use_fft_operator": use_fft_operator,
+                  "out_of_core": out_of_core, "scratch_dir": debug_dir,
+                  "use_float32": use_float32, "two_stage": two_stage,
+                  "closed_form": closed_form,
+                  "state_dir": state_dir, "cache_dir": cache_dir,
+                  "precondition": precondition, "flux_rtol": flux_rtol,
+                  "epoch_workers": epoch_workers,
+                  "epoch_executor": epoch_executor,
+                  "image_cache_size": image_cache_size}
+
+    output_dir = pathlib.Path(cfg.value("photometry.campari.paths.output_dir"))
+    if args.serve is not None:
+        serve(args.serve or output_dir / f"campari_{band}.sock",
+              functools.partial(fit_request, run_kwargs=run_kwargs))
+        return
+    if args.plan:
+        plan_objects(SNID, run_kwargs, output_dir / f"plan_{band}.json",
+                     cost_model=cost_model)
+        return
+    if args.calibrate is not None:
+        with open(args.calibrate) as f:
+            plan = json.load(f)
+        with open(output_dir / f"batch_summary_{band}.json") as f:
+            seconds = {str(obj["ID"]): obj["seconds"] for obj in
+                       json.load(f)["objects"]
+                       if obj["status"] == "succeeded"}
+        plan = [p for p in plan if str(p["ID"]) in seconds]
+        coeffs = fit_cost_model([p["terms"] for p in plan],
+                                [seconds[str(p["ID"])] for p in plan])
+        Lager.info(f"Calibrated cost model, to set as "
+                   f"photometry.campari.cost_model: "
+                   f"[{', '.join(f'{c:.3g}' for c in coeffs)}]")
+        return
+
+    object_kwargs = {}
+    if args.schedule is not None:
+        with open(args.schedule) as f:
+            plan = json.load(f)
+        SNID, object_kwargs = schedule_objects(SNID, plan, memory_budget_gb,
+                                               out_of_core=out_of_core)
+
+    IDs = SNID
+    if args.cluster is not None:
+        if args.schedule is None:
+            raise ValueError("--cluster needs the exposures in a --schedule "
+                             "plan.")
+        clusters = cluster_objects(SNID, plan, args.cluster)
+        Lager.info(f"{len(SNID)} objects in {len(clusters)} clusters.")
+        # Run in this order by the serial loop and added to a manifest in it,
+        # the pool hands each cluster to one worker.
+        SNID = [ID for cluster in clusters for ID in cluster]
+        IDs = clusters if args.workers > 1 else SNID
+
+    on_finish = None
+    if args.manifest is not None:
+        manifest_path = pathlib.Path(args.manifest) if args.manifest \
+            else output_dir / "campari_manifest.sqlite"
+        # airy only depends on the band, which is already part of the key.
+        config_hash = settings_hash({key: value for key, value in
+                                     run_kwargs.items() if key != "airy"})
+        added = add_to_manifest(manifest_path, SNID, band, config_hash)
+        Lager.info(f"Added {added} objects to {manifest_path}, status: "
+                   f"{manifest_status(manifest_path, band, config_hash)}")
+        # Objects are claimed one at a time, as they are about to be run,
+        # so that other jobs sharing the manifest can take the rest.
+        IDs = claimed_IDs(manifest_path, band, config_hash,
+                          max_attempts=args.max_attempts,
+                          stale_after=args.stale_after)
+
+        def on_finish(result):
+            mark_finished(manifest_path, result["ID"], band, config_hash,
+                          result["status"] != "failed",
+                          error=result["error"], seconds=result["seconds"])
+
+    if metrics_interval is not None:
+        metrics_prefix = output_dir / f"campari_metrics_{band}"
+        Lager.info(f"Writing the batch metrics to {metrics_prefix}.prom and "
+                   f"{metrics_prefix}.json every {metrics_interval} s.")
+        metrics_writer = MetricsWriter(metrics_prefix, metrics_interval, band,
+                                       args.workers)
+        metrics_writer.start()
+        mark = on_finish
+
+        def on_finish(result):
+            if mark is not None:
+                mark(result)
+            metrics_writer.add(result)
+
+    try:
+        if args.workers > 1:
+            start = time.perf_counter()
+            summary, clusters = run_batch(IDs, run_kwargs, args.workers,
+                                          blas_threads=args.blas_threads,
+                                          config_file=args.config, args=args,
+                                          on_finish=on_finish,
+                                          object_kwargs=object_kwargs)
+            num_failed = sum(s["status"] == "failed" for s in summary)
+            Lager.info(f"Ran {len(summary)} objects with {args.workers} "
+                       f"workers in {time.perf_counter() - start:.1f} s, "
+                       f"{num_failed} failed.")
+            for cluster in clusters:
+                cluster["objects_per_hour"] = \
+                    3600 * len(cluster["IDs"]) / cluster["seconds"]
+                for cache in cluster["cache"].values():
+                    lookups = cache["hits"] + cache["misses"]
+                    cache["hit_rate"] = \
+                        cache["hits"] / lookups if lookups else None
+            totals = {name: sum(c["cache"][name]["hits"] for c in clusters)
+                      / max(1, sum(c["cache"][name]["hits"]
+                                   + c["cache"][name]["misses"]
+                                   for c in clusters))
+                      for name in (clusters[0]["cache"] if clusters else [])}
+            Lager.info(f"Cache hit rates: {totals}")
+            with open(output_dir / f"batch_summary_{band}.json", "w") as f:
+                json.dump({"band": band, "workers": args.workers,
+                           "wall_seconds": time.perf_counter() - start,
+                           "num_succeeded": len(summary) - num_failed,
+                           "num_failed": num_failed, "cache_hit_rates": totals,
+                           "memory": memory_summary(summary),
+                           "objects": summary, "clusters": clusters},
+                          f, indent=2, default=str)
+        elif on_finish is not None:
+            for ID in IDs:
+                on_finish(_process_object_safely(
+                    ID, {**run_kwargs, **object_kwargs.get(ID, {})}))
+        else:
+            for ID in IDs:
+                process_object(ID, {**run_kwargs, **object_kwargs.get(ID, {})})
+    finally:
+        if metrics_interval is not None:
+            metrics_writer.stop()
+
+    if args.manifest is not None:
+        Lager.info(f"Manifest status: "
+                   f"{manifest_status(manifest_path, band, config_hash)}")
+
+
+def plan_objects(IDs, run_kwargs, plan_file, cost_model=None):
+    """Plan the fit of each object with plan_object, and save the plans,
+    longest first, as JSON.
+
+    Inputs:
+    IDs: list of object IDs.
+    run_kwargs: dict, the arguments of run_one_object other than ID.
+    plan_file: str or pathlib.Path, where to save the plans.
+    cost_model: passed on to estimate_cost. A warning is logged if it is
+                None, i.e. the uncalibrated DEFAULT_COST_MODEL is used.
+
+    Returns:
+    plans: list of dicts, see plan_object, with whether cost_model was
+           given under "calibrated".
+    """
+    if not run_kwargs["use_real_images"]:
+        raise ValueError("Only objects with real images can be planned.")
+    if cost_model is None:
+        Lager.warning("photometry.campari.cost_model is not set, so the run "
+                      "times are estimated with the uncalibrated default "
+                      "cost model. Fit it with RomanASP --calibrate.")
+    modes = {key: run_kwargs[key] for key in
+             ["use_fft_operator", "out_of_core", "use_float32", "two_stage"]}
+    plans = []
+    for ID in IDs:
+        try:
+            plans.append(plan_object(
+                ID, run_kwargs["num_total_images"],
+                run_kwargs["num_detect_images"], run_kwargs["sn_path"],
+                run_kwargs["band"], run_kwargs["size"],
+                run_kwargs["subtract_background"], run_kwargs["roman_path"],
+                run_kwargs["object_type"], run_kwargs["grid_type"],
+                percentiles=run_kwargs["percentiles"],
+                lc_start=run_kwargs["lc_start"], lc_end=run_kwargs["lc_end"],
+                cost_model=cost_model, **modes))
+        except ValueError as e:
+            Lager.info(f"Can not plan {ID}, ValueError: {e}")
+            continue
+        plans[-1]["calibrated"] = cost_model is not None
+        Lager.info(f"{ID}: {plans[-1]['num_total_images']} images, "
+                   f"{plans[-1]['num_grid']} grid points, "
+                   f"{plans[-1]['memory_bytes'] / 2**30:.2f} GB, "
+                   f"{plans[-1]['seconds']:.0f} s")
+
+    plans.sort(key=lambda plan: plan["seconds"], reverse=True)
+    with open(plan_file, "w") as f:
+        json.dump(plans, f, indent=2, default=str)
+    Lager.info(f"Saved the plan of {len(plans)} objects to {plan_file}, "
+               f"{sum(p['seconds'] for p in plans) / 3600:.1f} hours in "
+               "total.")
+    return plans
+
+
+def schedule_objects(IDs, plans, memory_budget_gb=None, out_of_core=False):
+    """Order objects longest first, and make sure each fits in the memory
+    of one worker.
+
+    Inputs:
+    IDs: list of object IDs to run.
+    plans: list of dicts, from plan_objects. A warning is logged if any of
+           them were made without a calibrated cost model.
+    memory_budget_gb: float, the memory each worker can use, or None for no
+                      limit. Objects over it are run out of core if that
+                      fits, and skipped otherwise.
+    out_of_core: bool, whether the objects are already run out of core.
+
+    Returns:
+    IDs: list, the IDs to run, longest first. IDs that are not in the plans
+         are run last, in the order given.
+    object_kwargs: dict, for each ID that needs them, the run_one_object
+                   arguments to change for it.
+    """
+    plans = {str(plan["ID"]): plan for plan in plans}
+    uncalibrated = sum(not plan.get("calibrated", False)
+                       for plan in plans.values())
+    if uncalibrated:
+        Lager.warning(f"The run times of {uncalibrated} of the "
+                      f"{len(plans)} planned objects were estimated with the "
+                      "uncalibrated default cost model, so they may be run "
+                      "in the wrong order. Fit it with RomanASP --calibrate.")
+    budget = np.inf if memory_budget_gb is None else memory_budget_gb * 2**30
+    planned = sorted((ID for ID in IDs if str(ID) in plans),
+                     key=lambda ID: plans[str(ID)]["seconds"], reverse=True)
+
+    scheduled = []
+    object_kwargs = {}
+    for ID in planned:
+        plan = plans[str(ID)]
+        if plan["memory_bytes"] <= budget:
+            scheduled.append(ID)
+        elif plan["memory_bytes_out_of_core"] <= budget:
+            Lager.info(f"{ID} needs {plan['memory_bytes'] / 2**30:.1f} GB, "
+                       "running it out of core.")
+            scheduled.append(ID)
+            if not out_of_core:
+                # out_of_core can not be combined with these.
+                object_kwargs[ID] = {"out_of_core": True,
+                                     "use_fft_operator": False,
+                                     "use_float32": False,
+                                     "two_stage": False}
+        else:
+            Lager.warning(f"Skipping {ID}, it needs "
+                          f"{plan['memory_bytes_out_of_core'] / 2**30:.1f} "
+                          f"GB even out of core, over the budget of "
+                          f"{memory_budget_gb} GB.")
+
+    scheduled += [ID for ID in IDs if str(ID) not in plans]
+    return scheduled, object_kwargs
+
+
+def cluster_objects(IDs, plans, max_cluster_size):
+    """Group objects that share exposures, so that one worker can run them
+    one after another and reuse the SCA images, roman_utils and PSF objects
+    of the previous one.
+
+    Each cluster starts from the first object not yet in a cluster, in the
+    order given (e.g. longest first, from schedule_objects), and grows by
+    adding the object that shares the most exposures with the last one
+    added, until none does or it has max_cluster_size objects.
+
+    Inputs:
+    IDs: list of object IDs.
+    plans: list of dicts, from plan_objects, with the exposures of each
+           object.
+    max_cluster_size: int, the most objects in one cluster. Smaller clusters
+                      balance the load between workers better.
+
+    Returns:
+    clusters: list of lists of IDs. Objects that are not in the plans are
+              clusters of their own, at the end.
+    """
+    plans = {str(plan["ID"]): plan for plan in plans}
+    exposures = {ID: {tuple(exposure) for exposure in
+                      plans[str(ID)]["exposures"]}
+                 for ID in IDs if str(ID) in plans}
+    order = {ID: i for i, ID in enumerate(IDs)}
+    # Which objects are in each exposure.
+    index = collections.defaultdict(set)
+    for ID, object_exposures in exposures.items():
+        for exposure in object_exposures:
+            index[exposure].add(ID)
+
+    remaining = set(exposures)
+    clusters = []
+    for ID in IDs:
+        if ID not in remaining:
+            continue
+        cluster = [ID]
+        remaining.discard(ID)
+        while len(cluster) < max_cluster_size:
+            shared = collections.Counter(
+                other for exposure in exposures[cluster[-1]]
+                for other in index[exposure] if other in remaining)
+            if not shared:
+                break
+            best = max(shared, key=lambda other: (shared[other],
+                                                  -order[other]))
+            cluster.append(best)
+            remaining.discard(best)
+        clusters.append(cluster)
+
+    clusters += [[ID] for ID in IDs if ID not in exposures]
+    return clusters
+
+
+def claimed_IDs(manifest_path, band, config_hash, max_attempts=3,
+                stale_after=None):
+    """Yield the IDs of the objects in a manifest that still need to be run,
+    claiming each one as it is asked for. See campari.manifest.claim_next.
+    """
+    while (ID := claim_next(manifest_path, band, config_hash,
+                            max_attempts=max_attempts,
+                            stale_after=stale_after)) is not None:
+        # The IDs are stored as text, the object IDs are ints.
+        yield int(ID)
+
+
+# The BLAS libraries numpy may be linked against read these when they load.
+BLAS_THREAD_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+                    "MKL_NUM_THREADS")
+
+
+def process_object(ID, run_kwargs):
+    """Run campari on one object and save its lightcurve, images and model.
+
+    Inputs:
+    ID: the ID of the object.
+    run_kwargs: dict, the arguments of run_one_object other than ID.
+
+    Returns:
+    summary: dict with the ID, the status ("succeeded", "failed", or
+             "up_to_date" if an incremental fit had no new exposures), the
+             error if it failed, and the time taken in seconds. With
+             photometry.campari.instrument, also the report of the time
+             spent in each stage, the counters and the cache hits and
+             misses, which is added to the lightcurve metadata and saved
+             to debug_dir as {identifier}_{band}_{psftype}_report.json.
+             With photometry.campari.profile_memory, the report has the
+             memory of each stage too, which is saved next to the
+             lightcurve as {identifier}_{band}_{psftype}_memory.json.
+             With photometry.campari.metrics_interval set, also the report
+             (not saved), the pid of the process and its peak RSS in MB
+             (max_rss_mb), for the batch metrics.
+             With photometry.campari.profile, the fit is profiled, and the
+             profile saved to debug_dir as
+             {identifier}_{band}_{psftype}_profile.* (see
+             campari.profiling).
+    """
+    cfg = Config.get()
+    profile = cfg.value("photometry.campari.profile")
+    if not profile:
+        return _run_and_save(ID, run_kwargs)
+    identifier = str(ID) if run_kwargs["use_real_images"] else "simulated"
+    psftype = "romanpsf" if run_kwargs["use_roman"] else "analyticpsf"
+    debug_dir = pathlib.Path(cfg.value("photometry.campari.paths.debug_dir"))
+    prefix = debug_dir / f"{identifier}_{run_kwargs['band']}_{psftype}"
+    Lager.info(f"Saving the {profile} profile to {prefix}_profile.*")
+    with profiled(profile, prefix,
+                  interval=cfg.value("photometry.campari.profile_interval")):
+        return _run_and_save(ID, run_kwargs)
+
+
+def _run_and_save(ID, run_kwargs):
+    """process_object, without the profiling."""
+    banner(f"Running SN {ID}")
+    start = time.perf_counter()
+    cfg = Config.get()
+    instrumented = cfg.value("photometry.campari.instrument")
+    profile_memory = cfg.value("photometry.campari.profile_memory")
+    # The batch metrics are made from the reports.
+    recorded = instrumented or profile_memory or \
+        cfg.value("photometry.campari.metrics_interval") is not None
+    if recorded:
+        start_recording(memory=profile_memory)
+        caches_before = cache_stats()
+    # The recording is stopped however the fit ends, so that a fit that
+    # raises does not leave it on for the next object of this process.
+    try:
         try:
             flux, sigma_flux, images, sumimages, exposures, ra_grid, dec_grid, wgt_matrix, \
-                confusion_metric, X, cutout_wcs_list, sim_lc = \
-                run_one_object(ID, object_type, num_total_images, num_detect_images, roman_path,
-                            sn_path, size, band, fetch_SED, use_real_images,
-                            use_roman, subtract_background,
-                            make_initial_guess, initial_flux_guess,
-                            weighting, method, grid_type,
-                            pixel, source_phot_ops,
-                            lc_start, lc_end, do_xshift, bg_gal_flux,
-                            do_rotation, airy, mismatch_seds, deltafcn_profile,
-                            noise, check_perfection, avoid_non_linearity,
-                            sim_gal_ra_offset, sim_gal_dec_offset,
-                            spacing, percentiles)
+                confusion_metric, X, cutout_wcs_list, sim_lc, new_exposures = \
+                run_one_object(ID, **run_kwargs)
+        except NoNewExposures as e:
+            # An incremental fit with nothing new, the saved state and the
+            # outputs of the last run stand.
+            Lager.info(f"{ID}: {e}")
+            return {"ID": ID, "status": "up_to_date", "error": None,
+                    "seconds": time.perf_counter() - start}
         # I don't have a particular error in mind for this, but I think
         # it's worth having a catch just in case that one supernova fails,
         # this way the rest of the code doesn't halt.
         except ValueError as e:
             Lager.info(f"ValueError: {e}")
-            continue
+            return {"ID": ID, "status": "failed", "error": f"ValueError: {e}",
+                    "seconds": time.perf_counter() - start}
 
         # Saving the output. The output needs two sections, one where we
         # create a lightcurve compared to true values, and one where we save
         # the images.
-
-        if use_real_images:
-            identifier = str(ID)
-            lc = build_lightcurve(ID, exposures, sn_path, confusion_metric,
-                                  flux, use_roman, band, object_type,
-                                  sigma_flux)
-        else:
-            identifier = "simulated"
-            lc = build_lightcurve_sim(sim_lc, flux, sigma_flux)
-        if use_roman:
+        band = run_kwargs["band"]
+        with stage("lightcurve"):
+            if run_kwargs["use_real_images"]:
+                identifier = str(ID)
+                lc = build_lightcurve(ID, exposures, run_kwargs["sn_path"],
+                                      confusion_metric, flux,
+                                      run_kwargs["use_roman"], band,
+                                      run_kwargs["object_type"], sigma_flux)
+            else:
+                identifier = "simulated"
+                lc = build_lightcurve_sim(sim_lc, flux, sigma_flux)
+        if run_kwargs["use_roman"]:
             psftype = "romanpsf"
         else:
             psftype = "analyticpsf"
+        if instrumented:
+            # The stages up to here, the full report (with the output
+            # stage) is saved next to the images.
+            lc.meta["instrumentation"] = current_report()
 
         output_dir = pathlib.Path(cfg.value("photometry.campari.paths.output_dir"))
-        save_lightcurve(lc, identifier, band, psftype,
-                        output_path=output_dir)
-
-        # Now, save the images
-        images_and_model = np.array([images, sumimages, wgt_matrix])
         debug_dir = pathlib.Path(cfg.value("photometry."
                                  "campari.paths.debug_dir"))
-        Lager.info(f"Saving images to {debug_dir}")
-        np.save(debug_dir / f"{identifier}_{band}_{psftype}_images.npy",
-                images_and_model)
-
-        # Save the ra and decgrid
-        np.save(debug_dir / f"{identifier}_{band}_{psftype}_grid.npy",
-                [ra_grid, dec_grid, X[:np.size(ra_grid)]])
-
-        # save wcses
-        primary_hdu = fits.PrimaryHDU()
-        hdul = [primary_hdu]
-        for i, wcs in enumerate(cutout_wcs_list):
-            hdul.append(fits.ImageHDU(header=wcs.to_fits_header(),
-                        name="WCS" + str(i)))
-        hdul = fits.HDUList(hdul)
-        filepath = debug_dir / f"{identifier}_{band}_{psftype}_wcs.fits"
-        hdul.writeto(filepath, overwrite=True)
+        with stage("output"):
+            save_lightcurve(lc, identifier, band, psftype,
+                            output_path=output_dir)
+
+            # Now, save the images
+            images_and_model = np.array([images, sumimages, wgt_matrix])
+            Lager.info(f"Saving images to {debug_dir}")
+            np.save(debug_dir / f"{identifier}_{band}_{psftype}_images.npy",
+                    images_and_model)
+            # The images are those of the exposures modelled in this run,
+            # which in incremental mode are only the new ones, not all the
+            # rows of the lightcurve. Their exposures are saved with them.
+            if new_exposures is not None:
+                new_exposures.write(debug_dir / f"{identifier}_{band}_"
+                                    f"{psftype}_images_exposures.ecsv",
+                                    overwrite=True)
+
+            # Save the ra and decgrid
+            np.save(debug_dir / f"{identifier}_{band}_{psftype}_grid.npy",
+                    [ra_grid, dec_grid, X[:np.size(ra_grid)]])
+
+            # save wcses
+            primary_hdu = fits.PrimaryHDU()
+            hdul = [primary_hdu]
+            for i, wcs in enumerate(cutout_wcs_list):
+                hdul.append(fits.ImageHDU(header=wcs.to_fits_header(),
+                            name="WCS" + str(i)))
+            hdul = fits.HDUList(hdul)
+            filepath = debug_dir / f"{identifier}_{band}_{psftype}_wcs.fits"
+            hdul.writeto(filepath, overwrite=True)
+    finally:
+        report = stop_recording() if recorded else None
+
+    summary = {"ID": ID, "status": "succeeded", "error": None,
+               "seconds": time.perf_counter() - start}
+    if recorded:
+        report["caches"] = cache_delta(caches_before, cache_stats())
+        summary["report"] = report
+        summary["pid"] = os.getpid()
+        summary["max_rss_mb"] = max_rss_mb()
+    if instrumented:
+        with open(debug_dir / f"{identifier}_{band}_{psftype}_report.json",
+                  "w") as f:
+            json.dump({**summary, "band": band}, f, indent=2, default=str)
+    if profile_memory:
+        memory_file = output_dir / f"{identifier}_{band}_{psftype}_memory.json"
+        Lager.info(f"Saving the memory of each stage to {memory_file}")
+        with open(memory_file, "w") as f:
+            json.dump({"ID": ID, "band": band, "memory": report["memory"]},
+                      f, indent=2)
+    return summary
+
+
+def cache_delta(before, after):
+    """The hits and misses of each cache between two cache_stats()."""
+    return {name: {key: after[name][key] - before[name][key]
+                   for key in ["hits", "misses"]} for name in after}
+
+
+@functools.lru_cache(maxsize=8)
+def airy_psf(band):
+    """The PSF used when not using the Roman PSF, an optical PSF with the
+    aberrations of SCA 1 in band.
+    """
+    lam = 1293  # nm
+    aberrations = galsim.roman.getPSF(1, band, pupil_bin=1).aberrations
+    return galsim.ChromaticOpticalPSF(lam, diam=2.36, aberrations=aberrations)
+
+
+def fit_request(request, run_kwargs):
+    """Fit one object for a daemon (see campari.daemon) and reply with its
+    lightcurve. Nothing is saved.
+
+    Inputs:
+    request: dict, with the ID of the object, and optionally its band and
+             a dict of overrides of run_kwargs.
+    run_kwargs: dict, the arguments of run_one_object other than ID, that
+                the daemon was started with.
+
+    Returns:
+    reply: dict with the ID, band, status ("succeeded", or "up_to_date",
+           with no lightcurve, if an incremental fit had no new exposures),
+           error (None), the time taken in seconds, the lightcurve as a
+           dict of columns, its metadata, and
+           the report of the time spent in each stage if
+           photometry.campari.instrument is set (None if not, or if a
+           recording had already been started).
+    """
+    if "ra" in request or "dec" in request:
+        raise NotImplementedError("RA and Dec requests not yet supported.")
+    start = time.perf_counter()
+    overrides = request.get("overrides", {})
+    unknown = set(overrides) - set(run_kwargs)
+    if unknown:
+        raise ValueError(f"Unknown overrides {sorted(unknown)}, must be "
+                         f"among {sorted(run_kwargs)}.")
+    kwargs = {**run_kwargs, **overrides}
+    band = request.get("band", run_kwargs["band"])
+    if band != run_kwargs["band"]:
+        kwargs["band"] = band
+        kwargs["airy"] = airy_psf(band)
+
+    ID = request["ID"]
+    # Only stop the recording started here, not one the caller is making.
+    started = Config.get().value("photometry.campari.instrument") \
+        and not recording()
+    if started:
+        start_recording()
+    up_to_date = None
+    try:
+        flux, sigma_flux, images, sumimages, exposures, ra_grid, dec_grid, wgt_matrix, \
+            confusion_metric, X, cutout_wcs_list, sim_lc, new_exposures = \
+            run_one_object(ID, **kwargs)
+    except NoNewExposures as e:
+        up_to_date = str(e)
+    finally:
+        report = stop_recording() if started else None
+    if up_to_date is not None:
+        return {"ID": ID, "band": band, "status": "up_to_date",
+                "error": None, "seconds": time.perf_counter() - start,
+                "lightcurve": None, "meta": {"message": up_to_date},
+                "report": report}
+    if kwargs["use_real_images"]:
+        lc = build_lightcurve(ID, exposures, kwargs["sn_path"],
+                              confusion_metric, flux, kwargs["use_roman"],
+                              band, kwargs["object_type"], sigma_flux)
+    else:
+        lc = build_lightcurve_sim(sim_lc, flux, sigma_flux)
+
+    return {"ID": ID, "band": band, "status": "succeeded", "error": None,
+            "seconds": time.perf_counter() - start,
+            "lightcurve": {name: np.asarray(lc[name]).tolist()
+                           for name in lc.colnames},
+            "meta": dict(lc.meta), "report": report}
+
+
+def _init_worker(config_file, args):
+    """Load the config in a fresh worker process, with the command line
+    overrides of the parent applied, and preload the galsim apertures."""
+    cfg = Config.get(config_file, setdefault=True)
+    cfg.parse_args(args)
+    aperture_cache_dir = cfg.value("photometry.campari.paths.aperture_cache_dir")
+    if aperture_cache_dir is not None:
+        install_aperture_cache(aperture_cache_dir, preload=True)
+
+
+def _process_object_safely(ID, run_kwargs):
+    """process_object, but any error only fails this object."""
+    start = time.perf_counter()
+    try:
+        return process_object(ID, run_kwargs)
+    except Exception:
+        Lager.error(f"{ID} failed:\n{traceback.format_exc()}")
+        return {"ID": ID, "status": "failed", "error": traceback.format_exc(),
+                "seconds": time.perf_counter() - start}
+
+
+def _process_cluster_safely(IDs, run_kwargs, object_kwargs):
+    """Run a cluster of objects one after another in this process, and
+    report how well the caches did on them.
+
+    Returns:
+    results: list of dicts, one per object, see process_object.
+    report: dict with the IDs, the time taken in seconds and the hits and
+            misses of each cache (see cache_stats) over the cluster.
+    """
+    before = cache_stats()
+    start = time.perf_counter()
+    results = [_process_object_safely(ID, {**run_kwargs,
+                                           **object_kwargs.get(ID, {})})
+               for ID in IDs]
+    return results, {"IDs": list(IDs), "seconds": time.perf_counter() - start,
+                     "cache": cache_delta(before, cache_stats())}
+
+
+def run_batch(IDs, run_kwargs, workers, blas_threads=None, config_file=None,
+              args=None, on_finish=None, object_kwargs=None):
+    """Run many objects in a pool of worker processes.
+
+    The workers are spawned (not forked) processes, each with its own config
+    and its own caches of parquet files, roman_utils and PSF objects, which
+    stay warm from one object to the next. Objects are handed out a few at a
+    time as workers free up, and each worker saves the outputs of its own
+    objects. A cluster of objects (see cluster_objects) is handed to one
+    worker, which runs them in order. An object that raises only fails
+    itself. If a worker process dies (e.g. it runs out of memory), the
+    objects in flight at the time are recorded as failed, and a new pool is
+    started for the rest.
+
+    Inputs:
+    IDs: iterable of object IDs, or of lists of them for clusters. It is
+         only advanced as workers free up, so it can hand out objects lazily
+         (see claimed_IDs).
+    run_kwargs: dict, the arguments of run_one_object other than ID.
+    workers: int, number of worker processes.
+    blas_threads: int, number of BLAS threads in each worker, so that the
+                  workers do not oversubscribe the cores. Defaults to the
+                  number of cores divided by workers.
+    config_file, args: the config file and parsed command line arguments,
+                       to set up the config in the workers the same way as
+                       in this process.
+    on_finish: function, if given, called in this process with the summary
+               of each object as it finishes.
+    object_kwargs: dict, for some IDs, run_one_object arguments that are
+                   different for them (see schedule_objects).
+
+    Returns:
+    summary: list of dicts, one per object, see process_object. In the order
+             the objects finished.
+    clusters: list of dicts, one per cluster (or single object), see
+              _process_cluster_safely. Clusters lost with a dead worker are
+              left out.
+    """
+    object_kwargs = {} if object_kwargs is None else object_kwargs
+    if blas_threads is None:
+        blas_threads = max(1, (os.cpu_count() or 1) // workers)
+    # These have to be in the environment before the workers import numpy.
+    old_env = {var: os.environ.get(var) for var in BLAS_THREAD_VARS}
+    os.environ.update({var: str(blas_threads) for var in BLAS_THREAD_VARS})
+
+    units = ([ID] if not isinstance(ID, (list, tuple)) else list(ID)
+             for ID in IDs)
+    # The next objects to run, None once there are no more.
+    next_unit = next(units, None)
+    summary = []
+    clusters = []
+    try:
+        while next_unit is not None:
+            with ProcessPoolExecutor(max_workers=workers,
+                                     mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=_init_worker,
+                                     initargs=(config_file, args)) as pool:
+                in_flight = {}
+                broken = False
+                while in_flight or (next_unit is not None and not broken):
+                    while next_unit is not None and not broken and \
+                            len(in_flight) < 2 * workers:
+                        future = pool.submit(_process_cluster_safely,
+                                             next_unit, run_kwargs,
+                                             object_kwargs)
+                        in_flight[future] = next_unit
+                        next_unit = next(units, None)
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        unit = in_flight.pop(future)
+                        try:
+                            results, report = future.result()
+                            clusters.append(report)
+                        except BrokenProcessPool:
+                            broken = True
+                            Lager.error(f"A worker died while running {unit}, "
+                                        "or an object next to it.")
+                            results = [{"ID": ID, "status": "failed",
+                                        "error": "The worker process died.",
+                                        "seconds": None} for ID in unit]
+                        for result in results:
+                            summary.append(result)
+                            if on_finish is not None:
+                                on_finish(result)
+    finally:
+        for var, value in old_env.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+    return summary, clusters
 
 
 if __name__ == "__main__":
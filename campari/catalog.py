@@ -0,0 +1,634 @@
+"""Reading the OpenUniverse catalogs: objects, their exposures and SEDs, and
+building and saving lightcurves.
+
+galsim, requests and h5py are only imported by the functions that use them,
+so that importing the catalog functions does not.
+"""
+
+# Standard Library
+import functools
+import os
+import pathlib
+import warnings
+
+# Common Library
+import astropy.table as tb
+import numpy as np
+import pandas as pd
+from astropy import units as u
+from astropy.coordinates import SkyCoord
+from astropy.io import fits
+from astropy.table import QTable, Table
+from astropy.utils.exceptions import AstropyWarning
+from erfa import ErfaWarning
+
+# SN-PIT
+from snpit_utils.config import Config
+from snpit_utils.logger import SNLogger as Lager
+
+# This supresses a warning because the Open Universe Simulations dates are not
+# FITS compliant.
+warnings.simplefilter("ignore", category=AstropyWarning)
+# Because the Open Universe Sims have dates from the future, we supress a
+# warning about using future dates.
+warnings.filterwarnings("ignore", category=ErfaWarning)
+
+
+def findAllExposures(snid, ra, dec, peak, start, end, band, maxbg=24,
+                     maxdet=24, return_list=False, stampsize=25,
+                     roman_path=None, pointing_list=None, SCA_list=None,
+                     truth="simple_model", lc_start=-np.inf, lc_end=np.inf,
+                     server_url=None):
+    """ This function finds all the exposures that contain a given supernova,
+    and returns a list of them. Utilizes Rob's awesome database method to
+    find the exposures. Humongous speed up thanks to this.
+
+    Inputs:
+    snid: the ID of the supernova
+    ra, dec: the RA and DEC of the supernova (TODO: Is this necessary if we're
+            passing the ID?)
+    peak: the peak of the supernova
+    start, end: the start and end of the observing window
+    maxbg: the maximum number of background images to consider
+    maxdet: the maximum number of detected images to consider
+    return_list: whether to return the exposures as a list or not
+    stampsize: the size of the stamp to use
+    roman_path: the path to the Roman data
+    pointing_list: If this is passed in, only consider these pointings
+    SCA_list: If this is passed in, only consider these SCAs
+    truth: If "truth" use truth images, if "simple_model" use simple model
+            images.
+    band: the band to consider
+    lc_start, lc_end: the start and end of the light curve window, in terms of
+                      time, in days, away from the peak.
+    server_url: the simdex server to ask which images contain the object.
+                Defaults to photometry.campari.simdex_url in the config.
+    """
+
+    f = fits.open(roman_path +
+                  "/RomanTDS/Roman_TDS_obseq_11_6_23_radec.fits")[1]
+    f = f.data
+
+    explist = tb.Table(names=("Pointing", "SCA", "BAND", "zeropoint", "RA",
+                              "DEC", "date", "true mag", "true flux",
+                              "realized flux"),
+                       dtype=("i8", "i4", "str", "f8", "f8", "f8", "f8",
+                              "f8", "f8", "f8"))
+
+    # Rob's database method! :D
+
+    import requests
+
+    if server_url is None:
+        server_url = Config.get().value("photometry.campari.simdex_url")
+    req = requests.Session()
+    result = req.post(f"{server_url}/findromanimages/containing=({ra},{dec})")
+    if result.status_code != 200:
+        raise RuntimeError(f"Got status code {result.status_code}\n"
+                           "{result.text}")
+
+    res = pd.DataFrame(result.json())[["filter", "pointing", "sca", "mjd"]]
+    res.rename(columns={"mjd": "date", "pointing": "Pointing", "sca": "SCA"},
+               inplace=True)
+
+    res = res.loc[res["filter"] == band]
+    det = res.loc[(res["date"] >= start) & (res["date"] <= end)].copy()
+    det["offpeak_time"] = det["date"] - peak
+    det = det.sort_values("offpeak_time")
+    if lc_start != -np.inf or lc_end != np.inf:
+        det = det.loc[(det["offpeak_time"] >= lc_start) &
+                      (det["offpeak_time"] <= lc_end)]
+    if isinstance(maxdet, int):
+        det = det.iloc[:maxdet]
+    det["DETECTED"] = True
+
+    if pointing_list is not None:
+        det = det.loc[det["Pointing"].isin(pointing_list)]
+
+    bg = res.loc[(res["date"] < start) | (res["date"] > end)].copy()
+    bg["offpeak_time"] = bg["date"] - peak
+    if lc_start != -np.inf or lc_end != np.inf:
+        bg = bg.loc[(bg["offpeak_time"] >= lc_start) &
+                    (bg["offpeak_time"] <= lc_end)]
+    if isinstance(maxbg, int):
+        bg = bg.iloc[:maxbg]
+    bg["DETECTED"] = False
+
+    # combine these two dataframes
+    all_images = pd.concat([det, bg])
+    all_images["zeropoint"] = np.nan
+
+    # Now we need to loop through the images and get the information we need
+    zpts = []
+    true_mag = []
+    true_fluxes = []
+    realized_fluxes = []
+    for index, row in all_images.iterrows():
+        cat = pd.read_csv(roman_path+f"/RomanTDS/truth/{band}/{row.Pointing}/"
+                          f"Roman_TDS_index_{band}_{row.Pointing}"
+                          f"_{row.SCA}.txt", sep=r"\s+", skiprows=1,
+                          names=["object_id", "ra", "dec", "x", "y",
+                                 "realized_flux", "flux", "mag", "obj_type"])
+        cat_star = cat.loc[cat["obj_type"] == "star"]
+        logflux = -2.5*np.log10(cat_star["flux"])
+        mag = cat_star["mag"]
+        zpt = np.mean(mag - logflux)
+        zpts.append(zpt)
+
+        if row.DETECTED:
+            try:
+                true_mag.append(cat.loc[cat["object_id"] == snid]
+                                .mag.values[0])
+                true_fluxes.append(cat.loc[cat["object_id"] == snid]
+                                   .flux.values[0])
+                realized_fluxes.append(cat.loc[cat["object_id"] == snid]
+                                       .realized_flux.values[0])
+
+            except Exception:
+                Lager.error(f"No truth file found for \
+                             {row.Pointing, row.SCA}")
+                true_mag.append(np.nan)
+                true_fluxes.append(np.nan)
+                realized_fluxes.append(np.nan)
+                continue
+
+        else:
+            true_mag.append(np.nan)
+            true_fluxes.append(np.nan)
+            realized_fluxes.append(np.nan)
+    all_images["zeropoint"] = zpts
+    all_images["true mag"] = true_mag
+    all_images["true flux"] = true_fluxes
+    all_images["realized flux"] = realized_fluxes
+    all_images["BAND"] = band
+
+    explist = Table.from_pandas(all_images)
+    explist.sort(["DETECTED", "SCA"])
+    Lager.info("\n" + str(explist))
+
+    if return_list:
+        return explist
+
+
+def find_parquet(ID, path, obj_type="SN"):
+    """Find the parquet file that contains a given supernova ID."""
+
+    files = os.listdir(path)
+    file_prefix = {"SN": "snana", "star": "pointsource"}
+    files = [f for f in files if file_prefix[obj_type] in f]
+    files = [f for f in files if ".parquet" in f]
+    files = [f for f in files if "flux" not in f]
+
+    for f in files:
+        pqfile = int(f.split("_")[1].split(".")[0])
+        df = open_parquet(pqfile, path, obj_type=obj_type)
+        # The issue is SN parquet files store their IDs as ints and star
+        # parquet files as strings.
+        # Should I convert the entire array or is there a smarter way to do
+        # this?
+        if ID in df.id.values or str(ID) in df.id.values:
+            return pqfile
+
+
+# Parquet files, roman_utils objects and PSF objects are cached, so that a
+# process that runs many objects (e.g. a worker of the batch runner in
+# RomanASP) only reads and builds them once. Callers must not modify what they
+# get back in place.
+
+
+@functools.lru_cache(maxsize=64)
+def open_parquet(parq, path, obj_type="SN", engine="fastparquet"):
+    """Convenience function to open a parquet file given its number."""
+    file_prefix = {"SN": "snana", "star": "pointsource"}
+    base_name = "{:s}_{}.parquet".format(file_prefix[obj_type], parq)
+    file_path = os.path.join(path, base_name)
+    Lager.debug(f"Opening parquet file: {file_path}")
+    df = pd.read_parquet(file_path, engine=engine)
+    return df
+
+
+def radec2point(RA, DEC, filt, path, start=None, end=None):
+    """This function takes in RA and DEC and returns the pointing and SCA with
+    center closest to desired RA/DEC
+    """
+    f = fits.open(path+"/RomanTDS/Roman_TDS_obseq_11_6_23_radec.fits")[1]
+    f = f.data
+
+    allRA = f["RA"]
+    allDEC = f["DEC"]
+
+    pointing_sca_coords = SkyCoord(allRA*u.deg, allDEC*u.deg, frame="icrs")
+    search_coord = SkyCoord(RA*u.deg, DEC*u.deg, frame="icrs")
+    dist = pointing_sca_coords.separation(search_coord).arcsec
+
+    dist[np.where(f["filter"] != filt)] = np.inf
+    reshaped_array = dist.flatten()
+    # Find the indices of the minimum values along the flattened slices
+    min_indices = np.argmin(reshaped_array, axis=0)
+    # Convert the flat indices back to 2D coordinates
+    rows, cols = np.unravel_index(min_indices, dist.shape[:2])
+
+    # The plus 1 is because the SCA numbering starts at 1
+    return rows, cols + 1
+
+
+def get_object_info(ID, parq, band, snpath, roman_path, obj_type):
+
+    """Fetch some info about an object given its ID.
+    Inputs:
+    ID: the ID of the object
+    parq: the parquet file containing the object
+    band: the band to consider
+    date: whether to return the start end and peak dates of the object
+    snpath: the path to the supernova data
+    roman_path: the path to the Roman data
+    host: whether to return the host RA and DEC
+
+    Returns:
+    ra, dec: the RA and DEC of the object
+    pointing, sca: the pointing and SCA of the object
+    start, end, peak: the start, end, and peak dates of the object
+    """
+
+    df = open_parquet(parq, snpath, obj_type=obj_type)
+    if obj_type == "star":
+        ID = str(ID)
+
+    df = df.loc[df.id == ID]
+    ra, dec = df.ra.values[0], df.dec.values[0]
+
+    if obj_type == "SN":
+        start = df.start_mjd.values
+        end = df.end_mjd.values
+        peak = df.peak_mjd.values
+    else:
+        start = [0]
+        end = [np.inf]
+        peak = [0]
+
+    pointing, sca = radec2point(ra, dec, band, roman_path)
+
+    return ra, dec, pointing, sca, start, end, peak
+
+
+def get_galsim_SED(SNID, date, sn_path, fetch_SED, obj_type="SN"):
+    """Return the appropriate SED for the object on the day. Since SN SEDs
+    are time dependent but stars are not, we need to handle them differently.
+
+    Inputs:
+    SNID: the ID of the object
+    date: the date of the observation
+    sn_path: the path to the supernova data
+    fetch_SED: If true, fetch true SED from the database, otherwise return a
+                flat SED.
+    obj_type: the type of object (SN or star)
+
+    Internal Variables:
+    lam: the wavelength of the SED in Angstrom
+    flambda: the flux of the SED units in erg/s/cm^2/Angstrom
+
+    Returns:
+    sed: galsim.SED object
+    """
+    if fetch_SED:
+        if obj_type == "SN":
+            lam, flambda = get_SN_SED(SNID, date, sn_path)
+        if obj_type == "star":
+            lam, flambda = get_star_SED(SNID, sn_path)
+    else:
+        lam, flambda = [1000, 26000], [1, 1]
+
+    import galsim
+
+    sed = galsim.SED(galsim.LookupTable(lam, flambda, interpolant="linear"),
+                     wave_type="Angstrom", flux_type="fphotons")
+
+    return sed
+
+
+def get_star_SED(SNID, sn_path):
+    """Return the appropriate SED for the star.
+    Inputs:
+    SNID: the ID of the object
+    sn_path: the path to the supernova data
+
+    Returns:
+    lam: the wavelength of the SED in Angstrom (numpy  array of floats)
+    flambda: the flux of the SED units in erg/s/cm^2/Angstrom
+             (numpy array of floats)
+    """
+    filenum = find_parquet(SNID, sn_path, obj_type="star")
+    pqfile = open_parquet(filenum, sn_path, obj_type="star")
+    file_name = pqfile[pqfile["id"] == str(SNID)]["sed_filepath"].values[0]
+    # SED needs to move out to snappl
+    fullpath = pathlib.Path(Config.get().value("photometry.campari." +
+                            "paths.sims_sed_library")) / file_name
+    sed_table = pd.read_csv(fullpath,  compression="gzip", sep=r"\s+",
+                            comment="#")
+    lam = sed_table.iloc[:, 0]
+    flambda = sed_table.iloc[:, 1]
+    return np.array(lam), np.array(flambda)
+
+
+def get_SN_SED(SNID, date, sn_path):
+    """Return the appropriate SED for the supernova on the given day.
+
+    Inputs:
+    SNID: the ID of the object
+    date: the date of the observation
+    sn_path: the path to the supernova data
+
+    Returns:
+    lam: the wavelength of the SED in Angstrom
+    flambda: the flux of the SED units in erg/s/cm^2/Angstrom
+    """
+    filenum = find_parquet(SNID, sn_path, obj_type="SN")
+    file_name = "snana" + "_" + str(filenum) + ".hdf5"
+    fullpath = os.path.join(sn_path, file_name)
+    # Setting locking=False on the next line becasue it seems that you can't
+    #   open an h5py file unless you have write access to... something.
+    #   Not sure what.  The directory where it exists?  We won't
+    #   always have that.  It's scary to set locking to false, because it
+    #   subverts all kinds of safety stuff that hdf5 does.  However,
+    #   because these files were created once in this case, it's not actually
+    #   scary, and we expect them to be static.  Locking only matters if you
+    #   think somebody else might change the file
+    #   while you're in the middle of reading bits of it.
+    import h5py
+    sed_table = h5py.File(fullpath, "r", locking=False)
+    sed_table = sed_table[str(SNID)]
+    flambda = sed_table["flambda"]
+    lam = sed_table["lambda"]
+    mjd = sed_table["mjd"]
+    bestindex = np.argmin(np.abs(np.array(mjd) - date))
+    max_days_cutoff = 10
+    closest_days_away = np.min(np.abs(np.array(mjd) - date))
+
+    if closest_days_away > max_days_cutoff:
+        Lager.warning(f"WARNING: No SED data within {max_days_cutoff} days of "
+                      + "date. \n The closest SED is " + closest_days_away +
+                      " days away.")
+    return np.array(lam), np.array(flambda[bestindex])
+
+
+def calc_mag_and_err(flux, sigma_flux, band, zp=None):
+    """This function calculates the magnitude and magnitude error from the
+       flux.
+
+    flux: float or array of floats, the flux
+    sigma_flux: float or array of floats, the flux error
+    band: str, the bandpass of the images used
+    zp: float, the zeropoint of the bandpass. If None, use the galsim-
+                calculated value.
+
+    Returns:
+    mag: float or array of floats, the AB magnitude
+    magerr: float or array of floats, the magnitude error
+    zp: float, the zeropoint of the bandpass
+    """
+
+    from galsim import roman
+
+    exptime = {"F184": 901.175,
+               "J129": 302.275,
+               "H158": 302.275,
+               "K213": 901.175,
+               "R062": 161.025,
+               "Y106": 302.275,
+               "Z087": 101.7}
+
+    area_eff = roman.collecting_area
+    zp = roman.getBandpasses()[band].zeropoint if zp is None else zp
+    mag = -2.5 * np.log10(flux) + 2.5*np.log10(exptime[band]*area_eff) + zp
+    magerr = (2.5 / np.log(10) * (sigma_flux / flux))
+    magerr[flux < 0] = np.nan
+    return mag, magerr, zp
+
+
+def build_lightcurve(ID, exposures, sn_path, confusion_metric, flux,
+                     use_roman, band, object_type, sigma_flux):
+
+    """This code builds a lightcurve datatable from the output of the SMP
+       algorithm.
+
+    Input:
+    ID (int): supernova ID
+    exposures (table): table of exposures used in the SMP algorithm
+    sn_path (str): path to supernova data
+    confusion_metric (float): the confusion metric derived in the SMP algorithm
+    num_detect_images (int): number of detection images in the lightcurve
+    X (array): the output of the SMP algorithm
+    use_roman (bool): whether or not the lightcurve was built using Roman PSF
+    band (str): the bandpass of the images used
+
+    Returns:
+    lc: a QTable containing the lightcurve data
+    """
+
+    detections = exposures[np.where(exposures["DETECTED"])]
+    parq_file = find_parquet(ID, path=sn_path, obj_type=object_type)
+    df = open_parquet(parq_file, path=sn_path, obj_type=object_type)
+
+    mag, magerr, zp = calc_mag_and_err(flux, sigma_flux, band)
+    sim_sigma_flux = 0  # These are truth values!
+    sim_realized_mag, _, _ = calc_mag_and_err(detections["realized flux"],
+                                              sim_sigma_flux, band)
+    sim_true_mag, _, _ = calc_mag_and_err(detections["true flux"],
+                                          sim_sigma_flux, band)
+    if object_type == "SN":
+        df_object_row = df.loc[df.id == ID]
+    if object_type == "star":
+        df_object_row = df.loc[df.id == str(ID)]
+
+    if object_type == "SN":
+        meta_dict = {"confusion_metric": confusion_metric,
+                     "host_sep": df_object_row["host_sn_sep"].values[0],
+                     "host_mag_g": df_object_row["host_mag_g"].values[0],
+                     "obj_ra": df_object_row["ra"].values[0],
+                     "obj_dec": df_object_row["dec"].values[0],
+                     "host_ra": df_object_row["host_ra"].values[0],
+                     "host_dec": df_object_row["host_dec"].values[0]}
+    else:
+        meta_dict = {"ra": df_object_row["ra"].values[0],
+                     "dec": df_object_row["dec"].values[0]}
+
+    data_dict = {"MJD": detections["date"], "flux": flux,
+                 "flux_error": sigma_flux, "mag": mag,
+                 "mag_err": magerr,
+                 "band": np.full(np.size(mag), band),
+                 "zeropoint": np.full(np.size(mag), zp),
+                 "SIM_realized_flux": detections["realized flux"],
+                 "SIM_true_flux": detections["true flux"],
+                 "SIM_realized_mag": sim_realized_mag,
+                 "SIM_true_mag": sim_true_mag}
+    units = {"MJD": u.d, "SIM_realized_flux": "",  "flux": "",
+             "flux_error": "", "SIM_realized_mag": "",
+             "SIM_true_flux": "", "SIM_true_mag": ""}
+
+    return QTable(data=data_dict, meta=meta_dict, units=units)
+
+
+def build_lightcurve_sim(supernova, flux, sigma_flux):
+    """This code builds a lightcurve datatable from the output of the SMP
+        algorithm if the user simulated their own lightcurve.
+
+    Inputs
+    supernova (array): the true lightcurve
+    num_detect_images (int): number of detection images in the lightcurve
+    X (array): the output of the SMP algorithm
+
+    Returns
+    lc: a QTable containing the lightcurve data
+    """
+    sim_MJD = np.arange(0, np.size(supernova), 1)
+    data_dict = {"MJD": sim_MJD, "flux": flux,
+                 "flux_error": sigma_flux, "SIM_flux": supernova}
+    meta_dict = {}
+    units = {"MJD": u.d, "SIM_flux": "",  "flux": "", "flux_error": ""}
+    return QTable(data=data_dict, meta=meta_dict, units=units)
+
+
+def save_lightcurve(lc, identifier, band, psftype, output_path=None,
+                    overwrite=True):
+    """This function parses settings in the SMP algorithm and saves the
+    lightcurve to an ecsv file with an appropriate name.
+    Input:
+    lc: the lightcurve data
+    identifier (str): the supernova ID or "simulated"
+    band (str): the bandpass of the images used
+    psftype (str): "romanpsf" or "analyticpsf"
+    output_path (str): the path to save the lightcurve to.  Defaults to
+      config value phtometry.campari.paths.output_dir
+
+    Returns:
+    None, saves the lightcurve to a ecsv file.
+    The file name is:
+    <output_path>/identifier_band_psftype_lc.ecsv
+    """
+
+    output_path = Config.get().value("photometry.campari.paths.output_dir") \
+        if output_path is None else output_path
+    output_path = pathlib.Path(output_path)
+    output_path.mkdir(exist_ok=True, parents=True)
+
+    lc_file = output_path / f"{identifier}_{band}_{psftype}_lc.ecsv"
+
+    Lager.info(f"Saving lightcurve to {lc_file}")
+    lc.write(lc_file, format="ascii.ecsv", overwrite=overwrite)
+
+
+def get_galsim_SED_list(ID, exposures, fetch_SED, object_type, sn_path):
+    sedlist = []
+    """
+    Return the appropriate SED for the object for each observation.
+    If you are getting truth SEDs, this function calls get_SED on each exposure
+    of the object. Then, get_SED calls get_SN_SED or get_star_SED depending on
+    the object type.
+    If you are not getting truth SEDs, this function returns a flat SED for
+    each exposure.
+
+    Inputs:
+    ID: the ID of the object
+    exposures: the exposure table returned by fetchImages.
+    fetch_SED: If true, get the SED from truth tables.
+               If false, return a flat SED for each expsoure.
+    object_type: the type of object (SN or star)
+    sn_path: the path to the supernova data
+
+    Returns:
+    sedlist: list of galsim SED objects, length equal to the number of
+             detection images.
+    """
+    for date in exposures["date"][exposures["DETECTED"]]:
+        sed = get_galsim_SED(ID, date, sn_path, obj_type=object_type,
+                             fetch_SED=fetch_SED)
+        sedlist.append(sed)
+
+    return sedlist
+
+
+def extract_sn_from_parquet_file_and_write_to_csv(parquet_file, sn_path,
+                                                  output_path,
+                                                  mag_limits=None):
+    """Convenience function for getting a list of SN IDs that obey some
+    conditions from a parquet file. This is not used anywhere in the main
+    algorithm.
+
+    Inputs:
+    parquet_file: the path to the parquet file
+    sn_path: the path to the supernova data
+    mag_limits: a tuple of (min_mag, max_mag) to filter the SNe by
+                peak magnitude. If None, no filtering is done.
+
+    Output:
+    Saves a csv file of the SN_IDs of supernovae from the parquet file that
+    pass mag cuts. If none are found, raise a ValueError.
+    """
+    # Get the supernova IDs from the parquet file
+    df = open_parquet(parquet_file, sn_path, obj_type="SN")
+    if mag_limits is not None:
+        min_mag, max_mag = mag_limits
+        # This can't always be just g band I think. TODO
+        df = df[(df["peak_mag_g"] >= min_mag) & (df["peak_mag_g"] <= max_mag)]
+    SN_ID = df.id.values
+    SN_ID = SN_ID[np.log10(SN_ID) < 8]  # The 9 digit SN_ID SNe are weird for
+    # some reason. They only seem to have 1 or 2 images ever. TODO
+    SN_ID = np.array(SN_ID, dtype=int)
+    Lager.info(f"Found {np.size(SN_ID)} supernovae in the given range.")
+    if np.size(SN_ID) == 0:
+        raise ValueError("No supernovae found in the given range.")
+
+    pd.DataFrame(SN_ID).to_csv(output_path, index=False, header=False)
+    Lager.info(f"Saved to {output_path}")
+
+
+def extract_star_from_parquet_file_and_write_to_csv(parquet_file, sn_path,
+                                                    output_path,
+                                                    ra=None,
+                                                    dec=None,
+                                                    radius=None):
+    """Convenience function for getting a list of star IDs
+    from a parquet file. The stars can be cone-searched for by passing a
+    central coordinate and a radius.
+    This is not used anywhere in the main algorithm.
+
+    Inputs:
+    parquet_file: int,  the number label of the parquet file to use.
+    sn_path: str, the path to the supernova data
+    ra: float, the central RA of the region to search in
+    dec: float, the central Dec of the region to search in
+    radius: float, the radius over which cone search is performed. Can have
+                    any angular astropy.unit attached to it. If no unit is
+                    included, the function will produce a warning and then
+                    automatically assume you meant degrees.
+    If no ra, dec, and radius are passed, no cone search
+    is performed and the IDs of the entire parquet file are returned.
+    If one or two of the above arguments is passed but not all three, the
+    cone search is not performed.
+
+    Output:
+    Saves a csv file to output_path of the IDs of stars from the parquet
+    file that pass location cuts. If none are found, raise a ValueError.
+    """
+    if not hasattr(radius, "unit") and radius is not None:
+        Lager.warning("extract_star_from_parquet_file_and_write_to_csv " +
+                      "a radius argument with no units. Assuming degrees.")
+        radius *= u.deg
+
+    df = open_parquet(parquet_file, sn_path, obj_type="star")
+    df = df[df["object_type"] == "star"]
+
+    if radius is not None and (ra is not None and dec is not None):
+        center_coord = SkyCoord(ra*u.deg, dec*u.deg)
+        df_coords = SkyCoord(ra=df["ra"].values*u.deg,
+                             dec=df["dec"].values*u.deg)
+        sep = center_coord.separation(df_coords)
+        df = df[sep < radius]
+
+    star_ID = df.id.values
+    star_ID = np.array(star_ID, dtype=int)
+    Lager.info(f"Found {np.size(star_ID)} stars in the given range.")
+    if np.size(star_ID) == 0:
+        raise ValueError("No stars found in the given range.")
+    pd.DataFrame(star_ID).to_csv(output_path, index=False, header=False)
+    Lager.info(f"Saved to {output_path}")
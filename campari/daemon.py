@@ -0,0 +1,115 @@
+"""A long-lived campari process that takes fit requests over a local UNIX
+socket, so that the imports, config, parquet files, roman_utils and PSFs it
+has loaded stay warm from one request to the next.
+
+Start it with RomanASP.py --serve [SOCKET], and send it requests with
+send_request, or from the command line with
+    python -m campari.daemon SOCKET '{"ID": 40120913, "band": "Y106"}'
+
+Each request and each reply is one line of JSON. A request has the ID of
+the object, and optionally its band and overrides of the arguments of
+run_one_object, e.g. {"ID": 40120913, "band": "H158", "overrides":
+{"num_total_images": 10}}. {"shutdown": true} stops the daemon. A reply has
+the status ("succeeded", "failed" or "up_to_date"), the error if it failed,
+the time the fit took in seconds and the lightcurve, as a dict of columns
+and a dict of metadata. Requests are run one at a time, in the order they come in.
+"""
+
+# Standard Library
+import argparse
+import json
+import os
+import socket
+import socketserver
+import time
+import traceback
+
+# SN-PIT
+from snpit_utils.logger import SNLogger as Lager
+
+
+def serve(socket_path, handle):
+    """Answer requests on a UNIX socket until one asks to shut down.
+
+    Inputs:
+    socket_path: str or pathlib.Path, the socket. A socket left over from a
+                 daemon that did not shut down cleanly is replaced.
+    handle: function, called with each request (a dict) and returning the
+            reply (a dict). If it raises, the reply is a failure with the
+            traceback as the error, and the daemon carries on.
+    """
+    socket_path = str(socket_path)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                start = time.perf_counter()
+                try:
+                    request = json.loads(line)
+                    if request.get("shutdown"):
+                        reply = {"status": "shutting down"}
+                        self.server.stop = True
+                    else:
+                        reply = handle(request)
+                except Exception:
+                    Lager.error(f"Request {line!r} failed:\n"
+                                f"{traceback.format_exc()}")
+                    reply = {"status": "failed",
+                             "error": traceback.format_exc(),
+                             "seconds": time.perf_counter() - start}
+                self.wfile.write(json.dumps(reply, default=str).encode()
+                                 + b"\n")
+                self.wfile.flush()
+                if self.server.stop:
+                    return
+
+    with socketserver.UnixStreamServer(socket_path, Handler) as server:
+        server.stop = False
+        Lager.info(f"Listening on {socket_path}")
+        try:
+            while not server.stop:
+                server.handle_request()
+        finally:
+            os.remove(socket_path)
+    Lager.info(f"Stopped listening on {socket_path}")
+
+
+def send_request(socket_path, request, timeout=None):
+    """Send one request to a daemon and wait for its reply.
+
+    Inputs:
+    socket_path: str or pathlib.Path, the socket the daemon listens on.
+    request: dict, the request, see the module docstring.
+    timeout: float, seconds to wait for the reply. None to wait for as long
+             as the fit takes.
+
+    Returns:
+    dict, the reply.
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(str(socket_path))
+        sock.sendall(json.dumps(request).encode() + b"\n")
+        with sock.makefile("rb") as f:
+            return json.loads(f.readline())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Send a fit request to a campari daemon and print the "
+                    "reply.")
+    parser.add_argument("socket", help="The socket the daemon listens on.")
+    parser.add_argument("request", help="The request, as JSON.")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="Seconds to wait for the reply.")
+    args = parser.parse_args()
+    print(json.dumps(send_request(args.socket, json.loads(args.request),
+                                  timeout=args.timeout), indent=2))
+
+
+if __name__ == "__main__":
+    main()
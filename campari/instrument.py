@@ -0,0 +1,226 @@
+"""Timers and counters for the stages of a fit, to see where the time of a
+slow object goes.
+
+Nothing is recorded unless start_recording has been called; until then stage
+returns a shared do-nothing context manager, and count and note return
+straight away.
+
+    start_recording()
+    with stage("solve"):
+        X, istop, itn = solve_lsqr(...)
+    count("lsqr_iterations", itn)
+    report = stop_recording()
+
+The report is a dict with the seconds spent in each stage (added up if a
+stage is entered more than once), the counters, and the notes (e.g. the shape
+of the design matrix). There is one recording per process, threads (e.g. the
+epoch workers) add to it.
+
+With start_recording(memory=True), the memory of each stage is recorded too,
+under "memory": the peak memory allocated by Python and numpy during the
+stage (from tracemalloc) above what was allocated when it started, the
+change in the resident set size of the process, the process's peak resident
+set size so far, and the sites (file:line in campari where possible) of the
+largest allocations made in the stage that are still held when it ends.
+Allocations made in other processes (e.g. epoch_executor process) are not
+seen. tracemalloc slows everything down, so only turn this on to find out
+where the memory goes.
+"""
+
+# Standard Library
+import contextlib
+import os
+import resource
+import sysconfig
+import threading
+import time
+import tracemalloc
+
+_NOT_RECORDING = contextlib.nullcontext()
+_record = None
+_lock = threading.Lock()
+# Whether tracemalloc was started by start_recording, and so should be
+# stopped by stop_recording.
+_started_tracing = False
+# How many frames of each allocation tracemalloc keeps, enough to get from
+# inside numpy back to campari.
+_TRACE_FRAMES = 16
+
+
+def start_recording(memory=False, top=10):
+    """Start recording, dropping anything recorded so far.
+
+    Inputs:
+    memory: bool, whether to record the memory of each stage too.
+    top: int, how many of the largest allocations of each stage to list.
+    """
+    global _record, _started_tracing
+    _record = {"stages": {}, "counters": {}, "notes": {}}
+    if memory:
+        _record["memory"] = {}
+        _record["notes"]["memory_top"] = top
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(_TRACE_FRAMES)
+            _started_tracing = True
+
+
+def stop_recording():
+    """Stop recording.
+
+    Returns:
+    dict, the report, see the module docstring. None if nothing was being
+    recorded.
+    """
+    global _record, _started_tracing
+    record, _record = _record, None
+    if _started_tracing:
+        tracemalloc.stop()
+        _started_tracing = False
+    return record
+
+
+def recording():
+    """Whether anything is being recorded."""
+    return _record is not None
+
+
+def stage(name):
+    """A context manager that adds the time spent in it to stage name."""
+    if _record is None:
+        return _NOT_RECORDING
+    return _timed(_record, name)
+
+
+@contextlib.contextmanager
+def _timed(record, name):
+    memory = "memory" in record and tracemalloc.is_tracing()
+    if memory:
+        snapshot = _snapshot()
+        traced, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        rss = rss_mb()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        with _lock:
+            record["stages"][name] = record["stages"].get(name, 0) + seconds
+        if memory:
+            _record_memory(record, name, snapshot, traced, rss)
+
+
+def _snapshot():
+    return tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__),
+         tracemalloc.Filter(False, __file__)])
+
+
+def _record_memory(record, name, snapshot, traced, rss):
+    """Add the memory of one pass through a stage to the record."""
+    traced_after, peak = tracemalloc.get_traced_memory()
+    largest = []
+    for stat in _snapshot().compare_to(snapshot, "traceback"):
+        if stat.size_diff <= 0 or len(largest) == record["notes"]["memory_top"]:
+            continue
+        largest.append({"site": allocation_site(stat.traceback),
+                        "mb": stat.size_diff / 2**20,
+                        "blocks": stat.count_diff})
+    with _lock:
+        stats = record["memory"].setdefault(
+            name, {"peak_mb": 0, "retained_mb": 0, "rss_delta_mb": 0,
+                   "max_rss_mb": 0, "largest": []})
+        stats["peak_mb"] = max(stats["peak_mb"], (peak - traced) / 2**20)
+        stats["retained_mb"] += (traced_after - traced) / 2**20
+        stats["rss_delta_mb"] += rss_mb() - rss
+        stats["max_rss_mb"] = max_rss_mb()
+        stats["largest"] = sorted(stats["largest"] + largest,
+                                  key=lambda alloc: -alloc["mb"])[
+                                      :record["notes"]["memory_top"]]
+
+
+def allocation_site(traceback):
+    """file:line of the innermost campari frame of a tracemalloc traceback,
+    or if none is in campari, of the innermost frame outside the installed
+    packages and the standard library (e.g. not inside numpy.ones).
+    """
+    # tracemalloc tracebacks run from the outermost to the innermost frame.
+    frames = list(reversed(traceback))
+    campari_dir = os.path.dirname(__file__)
+    library_dirs = tuple({sysconfig.get_path("stdlib"),
+                          sysconfig.get_path("purelib"),
+                          sysconfig.get_path("platlib")})
+    frame = next((f for f in frames if f.filename.startswith(campari_dir)),
+                 None) or \
+        next((f for f in frames if not f.filename.startswith(library_dirs)),
+             frames[0])
+    return f"{frame.filename}:{frame.lineno}"
+
+
+def rss_mb():
+    """The resident set size of this process in MB, 0 if it can not be
+    read (it is read from /proc, so only on Linux).
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except OSError:
+        return 0
+    return pages * os.sysconf("SC_PAGE_SIZE") / 2**20
+
+
+def max_rss_mb():
+    """The peak resident set size of this process so far, in MB."""
+    # ru_maxrss is in kilobytes on Linux (and bytes on macOS).
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def count(name, n=1):
+    """Add n to the counter name."""
+    if _record is None:
+        return
+    with _lock:
+        _record["counters"][name] = _record["counters"].get(name, 0) + int(n)
+
+
+def note(name, value):
+    """Record value (anything JSON serializable) under name."""
+    if _record is None:
+        return
+    with _lock:
+        _record["notes"][name] = value
+
+
+def current_report():
+    """A copy of what has been recorded so far, without stopping. None if
+    nothing is being recorded.
+    """
+    if _record is None:
+        return None
+    with _lock:
+        return {key: dict(value) for key, value in _record.items()}
+
+
+def memory_summary(summaries):
+    """The memory of each stage over a batch of objects.
+
+    Inputs:
+    summaries: list of dicts, the summaries of the objects (see
+               RomanASP.process_object). Those with a report with memory
+               are used.
+
+    Returns:
+    dict, for each stage, the mean and largest peak_mb, the ID of the
+    object with the largest, and the largest max_rss_mb.
+    """
+    stages = {}
+    for summary in summaries:
+        memory = (summary.get("report") or {}).get("memory", {})
+        for name, stats in memory.items():
+            stages.setdefault(name, []).append((stats["peak_mb"], summary["ID"],
+                                                stats["max_rss_mb"]))
+    return {name: {"mean_peak_mb": sum(s[0] for s in values) / len(values),
+                   "max_peak_mb": max(values)[0],
+                   "max_peak_ID": max(values)[1],
+                   "max_rss_mb": max(s[2] for s in values)}
+            for name, values in stages.items()}
@@ -0,0 +1,203 @@
+"""A manifest of the objects in a batch run, so that a run that is cut
+short (e.g. at the end of a SLURM allocation) can be picked up where it left
+off.
+
+The manifest is an SQLite file with one row per (ID, band, config hash), with
+its status (pending, running, done or failed), the number of attempts, the
+error of the last failed attempt, the time it took and which host and process
+ran it. Objects are claimed one at a time in a write transaction, so several
+processes, on one node or several nodes sharing the file, can take work from
+the same manifest. (SQLite relies on file locking for this, which not every
+network filesystem gets right. On Perlmutter, put the manifest on $SCRATCH or
+the CFS, not in /tmp of one node.)
+"""
+
+# Standard Library
+import hashlib
+import json
+import os
+import socket
+import sqlite3
+import time
+
+# SN-PIT
+from snpit_utils.logger import SNLogger as Lager
+
+STATUSES = ("pending", "running", "done", "failed")
+
+
+def settings_hash(settings):
+    """A short hash of the settings an object is run with, so that runs with
+    different settings get their own rows in the manifest.
+
+    Inputs:
+    settings: dict, the settings. Values that are not JSON serializable are
+              hashed by their str().
+
+    Returns:
+    str, the first 12 hex digits of the sha1 of the settings.
+    """
+    text = json.dumps(settings, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()[:12]
+
+
+def open_manifest(path):
+    """Open (and create if needed) the manifest at path.
+
+    Inputs:
+    path: str or pathlib.Path, the SQLite file.
+
+    Returns:
+    sqlite3.Connection, in autocommit mode, so that transactions are only
+    opened explicitly.
+    """
+    conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+    conn.execute("""CREATE TABLE IF NOT EXISTS objects (
+                        id TEXT NOT NULL,
+                        band TEXT NOT NULL,
+                        config_hash TEXT NOT NULL,
+                        status TEXT NOT NULL DEFAULT 'pending',
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        error TEXT,
+                        seconds REAL,
+                        worker TEXT,
+                        started REAL,
+                        finished REAL,
+                        PRIMARY KEY (id, band, config_hash))""")
+    return conn
+
+
+def add_to_manifest(path, IDs, band, config_hash):
+    """Add objects to the manifest as pending. Objects that are already in it
+    (with the same band and config hash) keep their status.
+
+    Inputs:
+    path: str or pathlib.Path, the manifest file.
+    IDs: list of object IDs.
+    band: str, the band.
+    config_hash: str, from settings_hash.
+
+    Returns:
+    int, the number of objects added.
+    """
+    conn = open_manifest(path)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        before = conn.total_changes
+        conn.executemany("INSERT OR IGNORE INTO objects (id, band, config_hash)"
+                         " VALUES (?, ?, ?)",
+                         [(str(ID), band, config_hash) for ID in IDs])
+        added = conn.total_changes - before
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    return added
+
+
+def claim_next(path, band, config_hash, max_attempts=3, stale_after=None):
+    """Claim the next object to run, and mark it as running.
+
+    Pending objects come first, then failed ones that have been tried fewer
+    than max_attempts times.
+
+    Inputs:
+    path: str or pathlib.Path, the manifest file.
+    band: str, the band.
+    config_hash: str, from settings_hash.
+    max_attempts: int, how many times an object is tried before it is left
+                  as failed.
+    stale_after: float, if given, objects that have been running for longer
+                 than this many seconds are assumed to have been cut off
+                 (e.g. their job ran out of time) and can be claimed again.
+                 Do not set this shorter than the longest object takes if
+                 other jobs are still running. Stale objects that have
+                 already been tried max_attempts times are marked as failed,
+                 with a "stale" error, instead of being left as running.
+
+    Returns:
+    str, the ID of the claimed object, or None if there is nothing left to
+    run.
+    """
+    now = time.time()
+    stale_before = -1 if stale_after is None else now - stale_after
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    conn = open_manifest(path)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute("""UPDATE objects
+                        SET status = 'failed', error = ?, finished = ?
+                        WHERE band = ? AND config_hash = ? AND attempts >= ?
+                              AND status = 'running' AND started < ?""",
+                     (f"stale: still running after {stale_after} s, its job "
+                      "was probably cut off", now, band, config_hash,
+                      max_attempts, stale_before))
+        row = conn.execute(
+            """SELECT id FROM objects
+               WHERE band = ? AND config_hash = ? AND attempts < ? AND
+                     (status = 'pending' OR status = 'failed' OR
+                      (status = 'running' AND started < ?))
+               ORDER BY status != 'pending', attempts, rowid
+               LIMIT 1""",
+            (band, config_hash, max_attempts, stale_before)).fetchone()
+        if row is not None:
+            conn.execute("""UPDATE objects
+                            SET status = 'running', attempts = attempts + 1,
+                                worker = ?, started = ?, finished = NULL
+                            WHERE id = ? AND band = ? AND config_hash = ?""",
+                         (worker, now, row[0], band, config_hash))
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+
+    if row is None:
+        return None
+    Lager.debug(f"{worker} claimed {row[0]} from {path}")
+    return row[0]
+
+
+def mark_finished(path, ID, band, config_hash, succeeded, error=None,
+                  seconds=None):
+    """Record the outcome of running an object.
+
+    Inputs:
+    path: str or pathlib.Path, the manifest file.
+    ID: the object ID.
+    band: str, the band.
+    config_hash: str, from settings_hash.
+    succeeded: bool, whether the object ran successfully.
+    error: str, the error if it did not.
+    seconds: float, how long it took.
+    """
+    conn = open_manifest(path)
+    try:
+        conn.execute("""UPDATE objects
+                        SET status = ?, error = ?, seconds = ?, finished = ?
+                        WHERE id = ? AND band = ? AND config_hash = ?""",
+                     ("done" if succeeded else "failed", error, seconds,
+                      time.time(), str(ID), band, config_hash))
+    finally:
+        conn.close()
+
+
+def manifest_status(path, band, config_hash):
+    """Count the objects in the manifest by status.
+
+    Inputs:
+    path: str or pathlib.Path, the manifest file.
+    band: str, the band.
+    config_hash: str, from settings_hash.
+
+    Returns:
+    dict, the number of objects with each status.
+    """
+    conn = open_manifest(path)
+    try:
+        rows = conn.execute("""SELECT status, COUNT(*) FROM objects
+                               WHERE band = ? AND config_hash = ?
+                               GROUP BY status""",
+                            (band, config_hash)).fetchall()
+    finally:
+        conn.close()
+    counts = dict.fromkeys(STATUSES, 0)
+    counts.update(rows)
+    return counts
@@ -0,0 +1,212 @@
+"""Metrics of a running batch, for monitoring long campaigns.
+
+The metrics are made from the summaries of the objects finished so far (see
+RomanASP.process_object), and written both as JSON and in the Prometheus
+text exposition format, e.g. for the textfile collector of a node exporter:
+
+    campari_objects_total{band="Y106",status="succeeded"} 118
+    campari_stage_seconds{band="Y106",stage="solve",quantile="0.9"} 41.2
+
+The stage times, cache hits, PSF draws and lsqr iterations come from the
+instrument reports, so they are only there for objects fit while recording
+(RomanASP turns the recording on when metrics are written). The memory of a
+worker is the largest peak resident set size its objects reported.
+
+During a batch, a MetricsWriter rewrites the metrics every interval seconds,
+whether or not any object has finished since.
+"""
+
+# Standard Library
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+# SN-PIT
+from snpit_utils.logger import SNLogger as Lager
+
+QUANTILES = [0.5, 0.9, 0.99]
+
+
+def batch_metrics(summaries, elapsed, band, workers=1):
+    """The metrics of a batch from the summaries of its finished objects.
+
+    Inputs:
+    summaries: list of dicts, the summaries of the finished objects.
+    elapsed: float, seconds since the batch started.
+    band: str, the band of the batch.
+    workers: int, number of worker processes.
+
+    Returns:
+    dict with the number of objects succeeded and failed, objects per hour,
+    the QUANTILES, sum and count of the seconds spent in each stage and of
+    the lsqr iterations, the hits, misses and hit rate of each cache, the
+    number of PSF draws, and the peak RSS in MB of each worker (by pid).
+    """
+    reports = [s["report"] for s in summaries if s.get("report")]
+    num_failed = sum(s["status"] == "failed" for s in summaries)
+    stages = {}
+    for report in reports:
+        for name, seconds in report["stages"].items():
+            stages.setdefault(name, []).append(seconds)
+    caches = {}
+    for report in reports:
+        for name, cache in report.get("caches", {}).items():
+            totals = caches.setdefault(name, {"hits": 0, "misses": 0})
+            totals["hits"] += cache["hits"]
+            totals["misses"] += cache["misses"]
+    for cache in caches.values():
+        lookups = cache["hits"] + cache["misses"]
+        cache["hit_rate"] = cache["hits"] / lookups if lookups else None
+    worker_rss = {}
+    for summary in summaries:
+        if summary.get("max_rss_mb") is not None:
+            pid = str(summary["pid"])
+            worker_rss[pid] = max(worker_rss.get(pid, 0),
+                                  summary["max_rss_mb"])
+    return {"band": band, "workers": workers, "updated": time.time(),
+            "elapsed_seconds": elapsed,
+            "objects_succeeded": len(summaries) - num_failed,
+            "objects_failed": num_failed,
+            "objects_per_hour": 3600 * len(summaries) / elapsed
+            if elapsed > 0 else None,
+            "stage_seconds": {name: distribution(seconds)
+                              for name, seconds in stages.items()},
+            "lsqr_iterations": distribution(
+                [r["counters"]["lsqr_iterations"] for r in reports
+                 if "lsqr_iterations" in r["counters"]]),
+            "psf_draws": sum(r["counters"].get("psf_draws", 0)
+                             for r in reports),
+            "caches": caches, "worker_max_rss_mb": worker_rss}
+
+
+def distribution(values):
+    """The QUANTILES, sum and count of values, as in a Prometheus summary."""
+    quantiles = np.quantile(values, QUANTILES) if len(values) else \
+        [None] * len(QUANTILES)
+    return {"quantiles": {str(q): None if v is None else float(v)
+                          for q, v in zip(QUANTILES, quantiles)},
+            "sum": float(np.sum(values)), "count": len(values)}
+
+
+def prometheus_text(metrics):
+    """metrics (see batch_metrics) in the Prometheus text exposition
+    format."""
+    band = f'band="{metrics["band"]}"'
+    lines = []
+
+    def family(name, kind, help_text, samples):
+        lines.append(f"# HELP campari_{name} {help_text}")
+        lines.append(f"# TYPE campari_{name} {kind}")
+        for suffix, labels, value in samples:
+            if value is not None:
+                labels = ",".join([band] + labels)
+                lines.append(f"campari_{name}{suffix}{{{labels}}} "
+                             f"{_number(value)}")
+
+    def summary_samples(dist, labels):
+        return [("", labels + [f'quantile="{q}"'], v)
+                for q, v in dist["quantiles"].items()] + \
+            [("_sum", labels, dist["sum"]), ("_count", labels, dist["count"])]
+
+    family("objects_total", "counter", "Objects finished, by status.",
+           [("", ['status="succeeded"'], metrics["objects_succeeded"]),
+            ("", ['status="failed"'], metrics["objects_failed"])])
+    family("objects_per_hour", "gauge",
+           "Objects finished per hour since the batch started.",
+           [("", [], metrics["objects_per_hour"])])
+    family("elapsed_seconds", "gauge", "Seconds since the batch started.",
+           [("", [], metrics["elapsed_seconds"])])
+    family("workers", "gauge", "Number of worker processes.",
+           [("", [], metrics["workers"])])
+    family("stage_seconds", "summary", "Seconds spent in each stage of a fit.",
+           [sample for name, dist in metrics["stage_seconds"].items()
+            for sample in summary_samples(dist, [f'stage="{name}"'])])
+    family("lsqr_iterations", "summary", "lsqr iterations of a fit.",
+           summary_samples(metrics["lsqr_iterations"], []))
+    family("psf_draws_total", "counter", "PSFs drawn.",
+           [("", [], metrics["psf_draws"])])
+    family("cache_hits_total", "counter", "Cache hits, by cache.",
+           [("", [f'cache="{name}"'], cache["hits"])
+            for name, cache in metrics["caches"].items()])
+    family("cache_misses_total", "counter", "Cache misses, by cache.",
+           [("", [f'cache="{name}"'], cache["misses"])
+            for name, cache in metrics["caches"].items()])
+    family("cache_hit_ratio", "gauge", "Fraction of cache lookups that hit.",
+           [("", [f'cache="{name}"'], cache["hit_rate"])
+            for name, cache in metrics["caches"].items()])
+    family("worker_max_rss_bytes", "gauge",
+           "Peak resident set size of each worker process.",
+           [("", [f'pid="{pid}"'], mb * 2**20)
+            for pid, mb in metrics["worker_max_rss_mb"].items()])
+    family("metrics_updated_timestamp_seconds", "gauge",
+           "When these metrics were written.",
+           [("", [], metrics["updated"])])
+    return "\n".join(lines) + "\n"
+
+
+def _number(value):
+    """value as Prometheus reads it, whole numbers without a decimal point."""
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class MetricsWriter(threading.Thread):
+    """A thread that writes the metrics of a batch to prefix (see
+    write_metrics) every interval seconds, until stop is called.
+
+    The summaries of the finished objects are given to add, from any thread.
+    """
+
+    def __init__(self, prefix, interval, band, workers=1):
+        super().__init__(name="campari-metrics-writer", daemon=True)
+        self.prefix = prefix
+        self.interval = interval
+        self.band = band
+        self.workers = workers
+        self.started = time.perf_counter()
+        self.summaries = []
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def add(self, summary):
+        with self._lock:
+            self.summaries.append(summary)
+
+    def write(self):
+        with self._lock:
+            summaries = list(self.summaries)
+        write_metrics(batch_metrics(summaries,
+                                    time.perf_counter() - self.started,
+                                    self.band, self.workers), self.prefix)
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            # A full or unreachable disk should not stop the next writes.
+            try:
+                self.write()
+            except OSError as e:
+                Lager.warning(f"Could not write the metrics to "
+                              f"{self.prefix}: {e}")
+
+    def stop(self):
+        """Stop the thread and write the metrics once more."""
+        self._stopped.set()
+        self.join()
+        self.write()
+
+
+def write_metrics(metrics, prefix):
+    """Write metrics to <prefix>.json and <prefix>.prom.
+
+    Each file is written next to itself and then renamed over the old one,
+    so that a scraper never reads a half written file.
+    """
+    for suffix, text in [(".json", json.dumps(metrics, indent=2)),
+                         (".prom", prometheus_text(metrics))]:
+        path = f"{prefix}{suffix}"
+        with open(f"{path}.tmp", "w") as f:
+            f.write(text)
+        os.replace(f"{path}.tmp", path)
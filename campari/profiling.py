@@ -0,0 +1,183 @@
+"""Profiles of single fits, to see which functions the time of a slow object
+goes to.
+
+    with profiled("cprofile", debug_dir / f"{identifier}_{band}_{psftype}"):
+        run_one_object(...)
+
+writes, next to the other debug outputs of the object, the profile in
+collapsed-stack format, one line per stack with its frames from the
+outermost to the innermost separated by ";" and then its weight,
+
+    <module> (RomanASP.py:1);process_object (RomanASP.py:641);... 1234
+
+which flamegraph.pl, speedscope or inferno turn into a flame graph. There are
+two modes:
+
+cprofile: every call is traced with cProfile, and the profile is also saved
+          as <prefix>_profile.pstats, to be read with pstats or snakeviz.
+          This slows the fit down a lot (more so the galsim and
+          numpy-heavy parts, which make many small calls), and only sees
+          the thread the fit was started in. cProfile only keeps who called
+          whom, not whole stacks, so the stacks of the collapsed profile
+          are made by splitting the time of each function between its
+          callers in proportion to the time it spent under each of them.
+          The weights are in microseconds.
+sample: the stacks of all the threads are sampled every interval seconds by
+        a background thread. This costs little (a few percent at the
+        default interval), so it can be left on for a whole batch, but
+        only sees what is running often enough to be sampled. The weights
+        are numbers of samples. Only the collapsed profile is saved.
+
+Neither sees what runs in other processes (e.g. the epoch_executor process
+workers).
+"""
+
+# Standard Library
+import collections
+import contextlib
+import cProfile
+import os
+import pstats
+import sys
+import threading
+
+PROFILE_MODES = ["cprofile", "sample"]
+
+
+@contextlib.contextmanager
+def profiled(mode, prefix, interval=0.005):
+    """Profile what runs in the with block, see the module docstring.
+
+    Inputs:
+    mode: str, "cprofile" or "sample".
+    prefix: str or pathlib.Path, the profile is saved as
+            <prefix>_profile.pstats (cprofile only) and
+            <prefix>_profile.collapsed.
+    interval: float, seconds between samples in sample mode.
+    """
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"profile must be one of {PROFILE_MODES}, "
+                         f"not {mode}.")
+    if mode == "cprofile":
+        # cProfile only sees the calls made after it is enabled, so the
+        # stacks it has start below the with block. They are put under the
+        # stack of the with block (frame 2, below this generator and
+        # contextlib), as in sample mode.
+        outer = ";".join(_stack(sys._getframe(2)))
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(f"{prefix}_profile.pstats")
+            stacks = collapse_pstats(pstats.Stats(profiler))
+            write_collapsed({f"{outer};{stack}": weight
+                             for stack, weight in stacks.items()},
+                            f"{prefix}_profile.collapsed")
+    else:
+        sampler = StackSampler(interval)
+        sampler.start()
+        try:
+            yield
+        finally:
+            sampler.stop()
+            write_collapsed(sampler.stacks, f"{prefix}_profile.collapsed")
+
+
+class StackSampler(threading.Thread):
+    """A thread that counts the stacks of the other threads every interval
+    seconds, until stop is called.
+    """
+
+    def __init__(self, interval):
+        super().__init__(name="campari-profile-sampler", daemon=True)
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id != self.ident:
+                    self.stacks[";".join(_stack(frame))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+
+def _stack(frame):
+    """The frames of a stack, from the outermost to frame."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(frame_name(code.co_filename, code.co_firstlineno,
+                                code.co_name))
+        frame = frame.f_back
+    return names[::-1]
+
+
+def frame_name(filename, lineno, function):
+    """How a function is shown in a collapsed stack."""
+    # ";" separates the frames, and the weight follows the last space.
+    return f"{function} ({os.path.basename(filename)}:{lineno})".replace(";", ":")
+
+
+def collapse_pstats(stats, max_depth=100, min_fraction=1e-4):
+    """Stacks, with the time spent in each, made from a cProfile profile.
+
+    Starting from the functions that nobody called, the time of each
+    function is split between the stacks that lead to it in proportion to
+    the time it spent under each of its callers (see the module docstring).
+
+    Inputs:
+    stats: pstats.Stats.
+    max_depth: int, stacks deeper than this are cut off there.
+    min_fraction: float, stacks with less than this fraction of the total
+                  time are left out.
+
+    Returns:
+    collections.Counter, the microseconds spent in each stack (in the
+    innermost function itself, not in what it called).
+    """
+    # stats.stats[function] = (primitive calls, calls, own time, cumulative
+    # time, {caller: (..., cumulative time under that caller)}).
+    callees = collections.defaultdict(list)
+    for function, (_, _, _, _, callers) in stats.stats.items():
+        for caller, caller_stats in callers.items():
+            callees[caller].append((function, caller_stats[3]))
+    roots = [function for function, row in stats.stats.items() if not row[4]]
+    total = sum(stats.stats[function][3] for function in roots)
+    stacks = collections.Counter()
+
+    def walk(function, share, path, names):
+        # share: the fraction of the calls to function that went through
+        # path.
+        own = stats.stats[function][2]
+        names = names + [frame_name(*function)]
+        stacks[";".join(names)] += own * share * 1e6
+        if len(names) == max_depth:
+            return
+        for callee, seconds in callees[function]:
+            callee_cumulative = stats.stats[callee][3]
+            # The time of recursive calls is already in function's own and
+            # cumulative time.
+            if callee in path or callee_cumulative <= 0:
+                continue
+            callee_share = share * min(1, seconds / callee_cumulative)
+            if callee_share * callee_cumulative >= min_fraction * total:
+                walk(callee, callee_share, path | {callee}, names)
+
+    for function in roots:
+        walk(function, 1, {function}, [])
+    return stacks
+
+
+def write_collapsed(stacks, path):
+    """Write stacks (a dict of stack: weight) in collapsed-stack format,
+    heaviest first, leaving out those that round to 0."""
+    with open(path, "w") as f:
+        for stack, weight in sorted(stacks.items(), key=lambda s: -s[1]):
+            if round(weight) > 0:
+                f.write(f"{stack} {round(weight)}\n")
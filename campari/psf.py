@@ -0,0 +1,451 @@
+"""Drawing the PSFs of the model: the background grid points and the
+supernova in each image.
+
+roman_imsim and snappl.psf are only imported by the functions that use them,
+so that importing campari (e.g. for --help or for the solvers alone) does
+not.
+"""
+
+# Standard Library
+import functools
+import hashlib
+import os
+import pathlib
+import pickle
+import threading
+
+# Common Library
+import galsim
+import numpy as np
+from galsim import roman
+
+# SN-PIT
+from snpit_utils.logger import SNLogger as Lager
+
+# Campari
+from campari.instrument import count
+from campari.solver import fine_lattice_offset, regular_grid_geometry
+
+# The apertures loaded or built by the persistent aperture cache in this
+# process, and how many were loaded (hits) or had to be built (misses).
+_apertures = {}
+_aperture_stats = {"hits": 0, "misses": 0}
+
+
+def construct_psf_background(ra, dec, wcs, x_loc, y_loc, stampsize,
+                             psf=None, pixel=False,
+                             util_ref=None, band=None, dtype=np.float64):
+
+    """Constructs the background model around a certain image (x,y) location
+    and a given array of RA and DECs.
+    Inputs:
+    ra, dec: arrays of floats, RA and DEC values for the grid
+    wcs: the wcs of the image, if the image is a cutout, this MUST be the wcs
+        of the cutout. A snappl.wcs.BaseWCS object.
+    x_loc, y_loc: floats,the pixel location of the image in the FULL image,
+        i.e. x y location in the SCA.
+    stampsize: int, the size of the stamp being used
+    band: str, the bandpass being used
+    psf: Here you can provide a PSF to use, if you don't provide one, you must
+        provide a util_ref, and this function will calculate the Roman PSF
+        instead.
+    pixel: bool, If True, use a pixel tophat function to convolve the PSF with,
+        otherwise use a delta function. Does not seem to hugely affect results.
+    util_ref: A roman_imsim.utils.roman_utils object, which is used to
+        calculate the PSF. If you provide this, you don't need to provide a PSF
+        and the Roman PSF will be calculated. Note
+        that this needs to be for the correct SCA/Pointing combination.
+    dtype: numpy dtype of the returned array. The PSFs are always drawn in
+        double precision, this only sets how they are stored.
+
+    Returns:
+    A numpy array of the PSFs at each grid point, with the shape
+    (stampsize*stampsize, npoints)
+    """
+
+    assert util_ref is not None or psf is not None, "you must provide at \
+        least util_ref or psf"
+    assert util_ref is not None or band is not None, "you must provide at \
+        least util_ref or band"
+
+    # This is the WCS galsim uses to draw the PSF.
+    galsim_wcs = wcs.get_galsim_wcs()
+    x, y = wcs.world_to_pixel(ra, dec)
+
+    # With plus ones here I recover the values pre-refactor!
+
+    if psf is None:
+        # How different are these two methods? TODO XXX
+        pupil_bin = 8
+        # psf = util_ref.getPSF(x_loc, y_loc, pupil_bin=pupil_bin)
+        psf = galsim.roman.getPSF(1, band, pupil_bin=pupil_bin, wcs=galsim_wcs)
+
+    bpass = roman.getBandpasses()[band]
+
+    psfs = np.zeros((stampsize * stampsize, np.size(x)), dtype=dtype)
+
+    sed = galsim.SED(galsim.LookupTable([100, 2600], [1, 1],
+                     interpolant="linear"),
+                     wave_type="nm", flux_type="fphotons")
+
+    if pixel:
+        point = galsim.Pixel(0.1)*sed
+    else:
+        point = galsim.DeltaFunction()
+        point *= sed
+
+    point = point.withFlux(1, bpass)
+    oversampling_factor = 1
+    convolvedpsf = galsim.Convolve(point, psf)
+    stamp = galsim.Image(stampsize*oversampling_factor,
+                         stampsize*oversampling_factor, wcs=galsim_wcs)
+    # Loop over the grid points, draw a PSF at each one, and append to a list.
+    for a, ij in enumerate(zip(x.flatten(), y.flatten())):
+        if a % 50 == 0:
+            Lager.debug(f"Drawing PSF {a} of {np.size(x)}")
+        i, j = ij
+        psfs[:, a] = convolvedpsf.drawImage(bpass, method="no_pixel",
+                                            center=galsim.PositionD(i, j),
+                                            use_true_center=True, image=stamp,
+                                            wcs=galsim_wcs).array.flatten()
+        count("psf_draws")
+
+    return psfs
+
+
+def construct_psf_kernel(wcs, x_loc, y_loc, size, oversample, offset,
+                         psf=None, pixel=False, util_ref=None, band=None):
+    """Constructs an oversampled PSF kernel for the FFT background operator.
+
+    If the PSF does not vary across the cutout, every background model column
+    is a shifted copy of the same PSF. Instead of drawing one stamp per grid
+    point, we draw one stamp per sub-pixel phase (oversample**2 of them) and
+    interleave them into a single kernel sampled on a lattice that is
+    oversample times finer than the image pixels. Because the stamps are drawn
+    with construct_psf_background, the kernel uses exactly the same drawing
+    conventions as the explicit design matrix.
+
+    Inputs:
+    wcs: the wcs of the cutout, a snappl.wcs.BaseWCS object.
+    x_loc, y_loc: floats, the pixel location of the cutout in the SCA.
+    size: int, the size of the cutout. The kernel covers displacements of up
+          to size pixels in every direction.
+    oversample: int, the number of kernel samples per image pixel.
+    offset: tuple of floats, (dx, dy) the sub-pixel offset of the grid
+            lattice, see fine_lattice_offset.
+    psf, pixel, util_ref, band: passed on to construct_psf_background.
+
+    Returns:
+    kernel: 2D numpy array of floats of shape
+            ((2*size + 1)*oversample, (2*size + 1)*oversample). Element
+            [jy, jx] is the PSF at a displacement of
+            ((jx + kernel_min)/oversample - dx, (jy + kernel_min)/oversample - dy)
+            pixels between an image pixel and a grid point.
+    kernel_min: int, the fine lattice index of the first kernel element.
+    """
+    stampsize = 2 * size + 1
+    phase = np.arange(oversample) / oversample
+    # One source per sub-pixel phase, all placed near the middle of the stamp.
+    px, py = np.meshgrid(size + offset[0] + phase, size + offset[1] + phase)
+    ra, dec = wcs.pixel_to_world(px.flatten(), py.flatten())
+    stamps = construct_psf_background(ra, dec, wcs, x_loc, y_loc, stampsize,
+                                      psf=psf, pixel=pixel,
+                                      util_ref=util_ref, band=band)
+
+    # Pixel (nx, ny) of the stamp drawn for phase (a, b) is a displacement of
+    # (nx - size)*oversample - a on the fine lattice, so the phases are
+    # interleaved in reverse order.
+    stamps = stamps.reshape(stampsize, stampsize, oversample, oversample)
+    stamps = stamps[:, :, ::-1, ::-1].transpose(0, 2, 1, 3)
+    kernel = stamps.reshape(stampsize * oversample, stampsize * oversample)
+    kernel_min = -size * oversample - (oversample - 1)
+
+    return kernel, kernel_min
+
+
+def install_aperture_cache(cache_dir, preload=False):
+    """Keep the pupil plane apertures that galsim.roman.getPSF builds in
+    cache_dir, so that other processes load them instead of building them
+    again. Building one takes seconds, loading it takes milliseconds.
+
+    This replaces galsim.roman.roman_psfs._make_aperture, so it applies to
+    every Roman PSF drawn in this process, by campari or by roman_imsim. The
+    apertures are keyed by all of its arguments (SCA, pupil plane type,
+    pupil_bin, wavelength and gsparams) and the galsim version. Installing
+    it again with another cache_dir replaces the first one.
+
+    Inputs:
+    cache_dir: str or pathlib.Path, the directory to keep the apertures in.
+               Several processes can share it.
+    preload: bool, if True, load all the apertures already in cache_dir now,
+             e.g. when a worker process starts, rather than when they are
+             first used.
+
+    Returns:
+    int, the number of apertures preloaded.
+    """
+    from galsim.roman import roman_psfs
+    cache_dir = pathlib.Path(cache_dir)
+    cache_dir.mkdir(exist_ok=True, parents=True)
+    make_aperture = getattr(roman_psfs._make_aperture, "uncached",
+                            roman_psfs._make_aperture)
+
+    def cached_make_aperture(*args, **kwargs):
+        key = hashlib.sha1(f"{galsim.__version__} {args!r} "
+                           f"{sorted(kwargs.items())!r}".encode()).hexdigest()
+        if key in _apertures:
+            _aperture_stats["hits"] += 1
+            return _apertures[key]
+        path = cache_dir / f"aperture_{key}.pkl"
+        if path.exists():
+            _aperture_stats["hits"] += 1
+            with open(path, "rb") as f:
+                aper = pickle.load(f)
+        else:
+            _aperture_stats["misses"] += 1
+            aper = make_aperture(*args, **kwargs)
+            # Written under another name and then renamed, so that other
+            # processes never load half a file.
+            tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp_path, "wb") as f:
+                pickle.dump(aper, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        _apertures[key] = aper
+        return aper
+
+    # So that galsim.roman.roman_psfs._make_aperture.clear() still works.
+    cached_make_aperture.clear = _apertures.clear
+    cached_make_aperture.uncached = make_aperture
+    roman_psfs._make_aperture = cached_make_aperture
+
+    num_loaded = 0
+    if preload:
+        for path in cache_dir.glob("aperture_*.pkl"):
+            with open(path, "rb") as f:
+                _apertures[path.stem[len("aperture_"):]] = pickle.load(f)
+            num_loaded += 1
+    Lager.debug(f"Keeping the galsim Roman apertures in {cache_dir}, "
+                f"preloaded {num_loaded}.")
+    return num_loaded
+
+
+# The roman_utils and snappl PSF objects keep state between draws, so they
+# are not shared between threads: get_roman_utils and get_psf_object are
+# given the thread they are for, and each thread of the epoch pool (see
+# map_in_order) gets its own objects.
+@functools.lru_cache(maxsize=256)
+def get_roman_utils(config_file, visit, sca, thread=None):
+    """Cached roman_imsim.utils.roman_utils object for one pointing and SCA,
+    for use in thread (threading.get_ident()).
+    """
+    from roman_imsim.utils import roman_utils
+    return roman_utils(config_file=config_file, visit=visit, sca=sca)
+
+
+@functools.lru_cache(maxsize=256)
+def get_psf_object(pointing, SCA, stampsize, photOps, thread=None):
+    """Cached snappl PSF object for one pointing and SCA, for use in thread
+    (threading.get_ident()).
+    """
+    from snappl.psf import PSF
+    return PSF.get_psf_object("ou24PSF_slow", pointing=pointing, sca=SCA,
+                              size=stampsize, include_photonOps=photOps)
+
+
+def construct_psf_source(x, y, pointing, SCA, stampsize=25, x_center=None,
+                         y_center=None, sed=None, flux=1, photOps=True):
+    """Constructs the PSF around the point source (x,y) location, allowing for
+        some offset from the center.
+    Inputs:
+    x, y: ints, pixel coordinates where the cutout is centered in the SCA
+    pointing, SCA: ints, the pointing and SCA of the image
+    stampsize = int, size of cutout image used
+    x_center and y_center: floats, x and y location of the object in the SCA.
+    sed: galsim.sed.SED object, the SED of the source
+    flux: float, If you are using this function to build a model grid point,
+        this should be 1. If you are using this function to build a model of
+        a source, this should be the flux of the source.
+    Outputs:
+    psf_image: numpy array of floats of size stampsize**2, the image
+                of the PSF at the (x,y) location.
+    """
+    if not isinstance(x, int) or not isinstance(y, int):
+        raise TypeError(f"x and y must be integers, not {type(x), type(y)}")
+    Lager.debug(f"ARGS IN PSF SOURCE: \n x, y: {x, y} \n" +
+                f" Pointing, SCA: {pointing, SCA} \n" +
+                f" stamp size: {stampsize} \n" +
+                f" x_center, y_center: {x_center, y_center} \n" +
+                f" sed: {sed} \n" +
+                f" flux: {flux}")
+
+    assert sed is not None, "You must provide an SED for the source"
+
+    if not photOps:
+        # While I want to do this sometimes, it is very rare that you actually
+        # want to do this. Thus if it was accidentally on while doing a normal
+        # run, I'd want to know.
+        Lager.warning("NOT USING PHOTON OPS IN PSF SOURCE")
+
+    psf_object = get_psf_object(pointing, SCA, stampsize, photOps,
+                                threading.get_ident())
+    psf_image = psf_object.get_stamp(x0=x, y0=y, x=x_center, y=y_center,
+                                     flux=1., seed=None)
+    count("psf_draws")
+
+    return psf_image.flatten()
+
+
+def construct_epoch_model(sca_wcs, cutout_wcs, ra, dec, ra_grid, dec_grid,
+                          size, band, grid_type, psf=None, pixel=False,
+                          util_ref=None, tds_file=None, pointing=None,
+                          SCA=None, sed=None, galsim_wcs=None,
+                          source_phot_ops=True,
+                          draw_method_for_non_roman_psf="no_pixel",
+                          oversample=None, dtype=np.float64):
+    """Build the model of one image: the background grid columns and, if the
+    SN is in the image, its PSF. The images do not depend on each other, so
+    run_one_object can build these in parallel.
+
+    Inputs:
+    sca_wcs: the WCS of the whole SCA.
+    cutout_wcs: the WCS of the cutout.
+    ra, dec: floats, the location of the object.
+    ra_grid, dec_grid: 1D arrays, the locations of the grid points.
+    size: int, the size of the cutout.
+    band: str, the Roman filter.
+    grid_type: str, the type of grid, "none" for no background model.
+    psf: galsim PSF to use in place of the Roman PSF, None for the Roman PSF.
+    pixel: bool, passed on to construct_psf_background.
+    util_ref: a roman_utils object. If tds_file is given, it is looked up
+              with get_roman_utils instead.
+    tds_file, pointing, SCA: the roman_imsim config file, pointing and SCA of
+                             the image.
+    sed: galsim SED of the SN, None if the SN is not in this image.
+    galsim_wcs: the galsim WCS of the cutout, to draw the SN when not using
+                the Roman PSF.
+    source_phot_ops: bool, whether to use photon ops for the SN PSF.
+    draw_method_for_non_roman_psf: str, galsim drawImage method for the SN
+                                   when not using the Roman PSF.
+    oversample: int, if given, the oversampled PSF kernel for the FFT
+                operator is built instead of the background columns.
+    dtype: numpy dtype of the background columns.
+
+    Returns:
+    background_model_array: 2D array of shape (size^2, number of grid
+                            points), with no columns if there is no grid or
+                            the FFT operator is used.
+    psf_source_array: 1D array of length size^2, the SN PSF, or None if sed
+                      is None.
+    kernel, kernel_min, start: see construct_psf_kernel and
+                               fine_lattice_offset, None if oversample is
+                               None.
+    """
+    object_x, object_y = sca_wcs.world_to_pixel(ra, dec)
+    if tds_file is not None:
+        util_ref = get_roman_utils(tds_file, pointing, SCA,
+                                   threading.get_ident())
+
+    # If no grid, we still need something that can be concatenated in the
+    # linear algebra steps, so we initialize an empty array by default.
+    background_model_array = np.empty((size**2, 0), dtype=dtype)
+    kernel, kernel_min, start = None, None, None
+    if oversample is not None:
+        # The grid part of the model is applied matrix-free, so we only
+        # need one oversampled PSF kernel per image.
+        origin, _, _, _ = regular_grid_geometry(ra_grid, dec_grid, cutout_wcs)
+        start, offset = fine_lattice_offset(origin, oversample)
+        kernel, kernel_min = \
+            construct_psf_kernel(cutout_wcs, object_x, object_y, size,
+                                 oversample, offset, psf=psf, pixel=pixel,
+                                 util_ref=util_ref, band=band)
+    elif grid_type != "none":
+        background_model_array = \
+            construct_psf_background(ra_grid, dec_grid, cutout_wcs, object_x,
+                                     object_y, size, psf=psf, pixel=pixel,
+                                     util_ref=util_ref, band=band,
+                                     dtype=dtype)
+
+    if sed is None:
+        return background_model_array, None, kernel, kernel_min, start
+
+    if psf is None:
+        # object_x and object_y are the exact coords of the SN in the SCA
+        # frame. x and y are the pixels the image has been cut out on, and
+        # hence must be ints. In snappl, centers of pixels occur at integers,
+        # so the center of the lower left pixel is (0,0). Therefore, if you
+        # are at (0.2, 0.2), you are in the lower left pixel, but at
+        # (0.6, 0.6), you have crossed into the next pixel, which is (1,1).
+        # So we need to round everything between -0.5 and 0.5 to 0, and
+        # everything between 0.5 and 1.5 to 1, etc. This code below does
+        # that, and follows how snappl does it. For more detail, see the
+        # docstring of get_stamp in the PSF class definition of snappl.
+        x = int(np.floor(object_x + 0.5))
+        y = int(np.floor(object_y + 0.5))
+        Lager.debug(f"x, y, object_x, object_y, {x, y, object_x, object_y}")
+        psf_source_array = \
+            construct_psf_source(x, y, pointing, SCA, stampsize=size,
+                                 x_center=object_x, y_center=object_y,
+                                 sed=sed, photOps=source_phot_ops)
+    else:
+        bandpass = galsim.roman.getBandpasses()[band]
+        stamp = galsim.Image(size, size, wcs=galsim_wcs)
+        profile = galsim.DeltaFunction()*sed
+        profile = profile.withFlux(1, bandpass)
+        convolved = galsim.Convolve(profile, psf)
+        psf_source_array = \
+            convolved.drawImage(bandpass,
+                                method=draw_method_for_non_roman_psf,
+                                image=stamp, wcs=galsim_wcs,
+                                center=(object_x, object_y),
+                                use_true_center=True, add_to_image=False)
+        psf_source_array = psf_source_array.array.flatten()
+        count("psf_draws")
+
+    return background_model_array, psf_source_array, kernel, kernel_min, \
+        start
+
+
+def getPSF_Image(self, stamp_size, x=None, y=None, x_center=None,
+                 y_center=None, pupil_bin=8, sed=None, oversampling_factor=1,
+                 include_photonOps=False, n_phot=1e6, pixel=False, flux=1):
+
+    if pixel:
+        point = galsim.Pixel(1)*sed
+        Lager.debug("Building a Pixel shaped PSF source")
+    else:
+        point = galsim.DeltaFunction()*sed
+
+    # Note the +1s in galsim.PositionD below; galsim uses 1-indexed pixel positions,
+    # whereas snappl uses 0-indexed pixel positions
+    x_center += 1
+    y_center += 1
+    x += 1
+    y += 1
+
+    point = point.withFlux(flux, self.bpass)
+    local_wcs = self.getLocalWCS(x, y)
+    wcs = galsim.JacobianWCS(dudx=local_wcs.dudx/oversampling_factor,
+                             dudy=local_wcs.dudy/oversampling_factor,
+                             dvdx=local_wcs.dvdx/oversampling_factor,
+                             dvdy=local_wcs.dvdy/oversampling_factor)
+    stamp = galsim.Image(stamp_size*oversampling_factor,
+                         stamp_size*oversampling_factor, wcs=wcs)
+
+    if not include_photonOps:
+        Lager.debug(f'in getPSF_Image: {self.bpass}, {x_center}, {y_center}')
+
+        psf = galsim.Convolve(point, self.getPSF(x, y, pupil_bin))
+        return psf.drawImage(self.bpass, image=stamp, wcs=wcs,
+                             method="no_pixel",
+                             center=galsim.PositionD(x_center, y_center),
+                             use_true_center=True)
+
+    photon_ops = [self.getPSF(x, y, pupil_bin)] + self.photon_ops
+    Lager.debug(f"Using {n_phot:e} photons in getPSF_Image")
+    result = point.drawImage(self.bpass, wcs=wcs, method="phot",
+                             photon_ops=photon_ops, rng=self.rng,
+                             n_photons=int(n_phot), maxN=int(n_phot),
+                             poisson_flux=False,
+                             center=galsim.PositionD(x_center, y_center),
+                             use_true_center=True, image=stamp)
+    return result
@@ -11,7 +11,6 @@ from astropy.nddata import Cutout2D
 from astropy.utils.exceptions import AstropyWarning
 from astropy.wcs import WCS
 from erfa import ErfaWarning
-from roman_imsim.utils import roman_utils
 
 from snpit_utils.config import Config
 from snpit_utils.logger import SNLogger as Lager
@@ -178,6 +177,8 @@ def simulate_images(num_total_images, num_detect_images, ra, dec,
     images = imagelist
     Lager.debug(f"images shape: {images[0].shape}")
     Lager.debug(f"images length {len(images)}")
+    # roman_imsim is slow to import, so only import it when it is needed.
+    from roman_imsim.utils import roman_utils
     file_path = pathlib.Path( Config.get().value( "photometry.campari.galsim.tds_file" ) )
     util_ref = roman_utils(config_file=file_path,
                            visit=base_pointing, sca=base_sca)
@@ -252,6 +253,7 @@ def simulate_supernova(snx, sny, stamp, flux, sed, band, sim_psf,
                                    use_true_center=True)
         return result.array
 
+    from roman_imsim.utils import roman_utils
     config_file = pathlib.Path( Config.get().value( "photometry.campari.galsim.tds_file" ) )
     util_ref = roman_utils(config_file=config_file, visit=base_pointing,
                            sca=base_sca)
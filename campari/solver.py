@@ -0,0 +1,1521 @@
+"""Solving for the scene model: building the design matrix as an operator,
+out of core or in float32, the lsqr solvers, two stage and batched fits,
+incremental normal equations, warm starts, and the cost model of a fit.
+
+This needs numpy, scipy and astropy (the incremental state is saved as an
+astropy Table), and snpit_utils for logging, but not galsim, snappl or
+roman_imsim.
+"""
+
+# Standard Library
+import hashlib
+import pathlib
+
+# Common Library
+import numpy as np
+import scipy.sparse as sp
+from astropy.table import Table
+from numpy.linalg import LinAlgError
+from scipy.fft import next_fast_len
+from scipy.linalg import solve_triangular
+
+# SN-PIT
+from snpit_utils.logger import SNLogger as Lager
+
+
+def prep_data_for_fit(images, sn_matrix, wgt_matrix, dtype=np.float64):
+    """This function takes the data from the images and puts it into the form
+    such that we can analytically solve for the best fit using linear algebra.
+
+    n = total number of images
+    s = image size (so the image is s x s)
+    d = number of detection images
+
+    Inputs:
+    images: list of snappl Image objects. List of length n objects.
+    sn_matrix: list of np arrays of SN models. List of length d of sxs arrays.
+    wgt_matrix: list of np arrays of weights. List of length n of sxs arrays.
+    dtype: numpy dtype of the outputs, float32 halves their memory footprint.
+
+    Outputs:
+    images: 1D array of image data. Length n*s^2
+    err: 1D array of error data. Length n*s^2
+    sn_matrix: A 2D array of SN models, with the SN models placed in the
+                correct rows and columns, see comment below. Shape (n*s^2, n)
+    wgt_matrix: 1D array of weights. Length n*s^2
+    """
+    Lager.debug("Prep data for fit")
+    size_sq = images[0].image_shape[0]**2
+    tot_num = len(images)
+    det_num = len(sn_matrix)
+
+    # Flatten into 1D arrays
+    err = np.concatenate([im.noise.flatten() for im in images]).astype(dtype)
+    image_data = np.concatenate([im.data.flatten() for im in images])
+    image_data = image_data.astype(dtype)
+
+    # The final design matrix for our fit should have dimensions:
+    # (total number of pixels in all images, number of model components)
+    # Then, the first s^2 rows of the matrix correspond to the first image,
+    # the next s^2 rows to the second image, etc.,  where s is the size of the
+    # image. For the SN model, the flux in each image is ostensibly different.
+    # Therefore we need a unique flux for each image, and we don't want the
+    # flux of the supernova in one image to affect the flux in another image.
+    # Therefore, we need to place the supernova model in the correct image
+    # (i.e. the correct rows of the design matrix) and zero out all of the
+    # others. We'll do this by initializing a matrix of zeros, and then filling
+    # in the SN model in the correct place in the loop below:
+
+    psf_zeros = np.zeros((np.size(image_data), tot_num), dtype=dtype)
+    for i in range(det_num):
+        sn_index = tot_num - det_num + i  # We only want to edit SN columns.
+        psf_zeros[
+            (sn_index) * size_sq:  # Fill in rows s^2 * image number...
+            (sn_index + 1) * size_sq,  # ... to s^2 * (image number + 1) ...
+            sn_index] = sn_matrix[i]  # ...in the correct column.
+    sn_matrix = np.vstack(psf_zeros)
+    wgt_matrix = np.array(wgt_matrix)
+    wgt_matrix = np.hstack(wgt_matrix).astype(dtype)
+
+    return image_data, err, sn_matrix, wgt_matrix
+
+
+def psf_only_photometry(sn_matrix, images, wgt_matrix, num_total_images,
+                        x0=None):
+    """With no background grid and the sky already subtracted, every image
+    only constrains its own SN flux, so the fit splits into one weighted PSF
+    fit per detection image. This solves all of them at once in closed form,
+    without building the design matrix:
+
+    flux = sum(w^2 psi d) / sum(w^2 psi^2), sigma^2 = 1 / sum(w psi^2)
+
+    These are the weights the full fit uses (lsqr is given w*A and w*d, the
+    covariance is inv(A^T diag(w) A)), so the results are the same. Where
+    the full fit has nothing to go on, they are what it gives too: an image
+    with no SN column (before detection) or whose PSF has no weight (e.g.
+    it is off the cutout or masked) keeps its x0 flux, which lsqr never
+    moves, and gets a zero uncertainty, as from the pseudo-inverse of the
+    singular covariance.
+
+    n = total number of images
+    s = image size (so the image is s x s)
+    d = number of detection images
+
+    Inputs:
+    sn_matrix: list of np arrays of SN models. List of length d of s^2 arrays,
+               for the last d images.
+    images: 1D array of image data. Length n*s^2
+    wgt_matrix: 1D array of weights. Length n*s^2
+    num_total_images: int, n.
+    x0: 1D array of length n or None, the SN fluxes lsqr would be started
+        from (zero if None).
+
+    Returns:
+    X: 1D array of length n, the SN flux in each image.
+    sigma_flux: 1D array of length d, the uncertainty on the fluxes.
+    model: 1D array of length n*s^2, the model images.
+    """
+    det_num = len(sn_matrix)
+    size_sq = np.size(images) // num_total_images
+    first_sn = num_total_images - det_num
+
+    psf = np.reshape(sn_matrix, (det_num, size_sq)).astype(np.float64)
+    data = images.reshape(num_total_images, size_sq)[first_sn:]
+    wgt = wgt_matrix.reshape(num_total_images, size_sq)[first_sn:]
+
+    X = np.zeros(num_total_images) if x0 is None \
+        else np.array(x0, dtype=np.float64)
+    solve_norm = np.sum(wgt**2 * psf**2, axis=1)
+    cov_norm = np.sum(wgt * psf**2, axis=1)
+    fitted = solve_norm > 0
+    X[first_sn:][fitted] = np.sum(wgt**2 * psf * data, axis=1)[fitted] / \
+        solve_norm[fitted]
+    sigma_flux = np.zeros(det_num)
+    sigma_flux[cov_norm > 0] = 1 / np.sqrt(cov_norm[cov_norm > 0])
+
+    model = np.zeros((num_total_images, size_sq))
+    model[first_sn:] = X[first_sn:, np.newaxis] * psf
+
+    return X, sigma_flux, model.ravel()
+
+
+def regular_grid_geometry(ra_grid, dec_grid, wcs, max_oversample=8,
+                          atol=1e-3):
+    """Find where a regular model grid lands on an image.
+
+    The FFT background operator needs the grid to be a regular lattice that
+    is aligned with the pixel axes of every image, i.e. the images may be
+    shifted with respect to each other but not rotated.
+
+    Inputs:
+    ra_grid, dec_grid: 1D numpy arrays of floats, a grid built by
+                       make_regular_grid.
+    wcs: snappl.wcs.BaseWCS object, the wcs of the cutout.
+    max_oversample: int, the largest oversampling of the pixel lattice we
+                    are willing to use to represent the grid spacing.
+    atol: float, how far (in pixels) grid points may be from a perfect
+          lattice.
+
+    Returns:
+    origin: tuple of floats, (x, y) pixel location of the first grid point.
+    spacing: float, the grid spacing in pixels.
+    oversample: int, the smallest oversampling such that the grid spacing is
+                an integer number of fine lattice steps.
+    grid_width: int, the number of grid points along each axis.
+    """
+    grid_width = int(np.rint(np.sqrt(np.size(ra_grid))))
+    if grid_width**2 != np.size(ra_grid):
+        raise ValueError("The FFT background operator requires a square "
+                         "regular grid.")
+
+    xx, yy = wcs.world_to_pixel(ra_grid, dec_grid)
+    xx = np.asarray(xx, dtype=float).reshape(grid_width, grid_width)
+    yy = np.asarray(yy, dtype=float).reshape(grid_width, grid_width)
+    origin = (xx[0, 0], yy[0, 0])
+    spacing = xx[0, 1] - xx[0, 0] if grid_width > 1 else 1.0
+
+    steps = np.arange(grid_width) * spacing
+    ideal_x = origin[0] + steps[np.newaxis, :]
+    ideal_y = origin[1] + steps[:, np.newaxis]
+    misfit = max(np.max(np.abs(xx - ideal_x)), np.max(np.abs(yy - ideal_y)))
+    if misfit > atol:
+        raise ValueError("The model grid is not aligned with the pixel axes "
+                         f"of this image (off by {misfit:.2e} pixels). The "
+                         "FFT background operator does not support rotated "
+                         "images.")
+
+    for oversample in range(1, max_oversample + 1):
+        if np.abs(spacing * oversample - np.rint(spacing * oversample)) < \
+           atol / grid_width:
+            break
+    else:
+        raise ValueError(f"Grid spacing {spacing} cannot be represented on a "
+                         f"lattice oversampled up to {max_oversample} times.")
+
+    return origin, spacing, oversample, grid_width
+
+
+def fine_lattice_offset(origin, oversample):
+    """Split a grid origin into a fine lattice index and a sub-pixel remainder.
+
+    Inputs:
+    origin: tuple of floats, (x, y) pixel location of the first grid point.
+    oversample: int, the number of fine lattice steps per pixel.
+
+    Returns:
+    start: tuple of ints, the fine lattice index at or below the origin.
+    offset: tuple of floats, the remaining offset in pixels, each in
+            [0, 1/oversample).
+    """
+    start = tuple(int(np.floor(o * oversample)) for o in origin)
+    offset = tuple(o - s / oversample for o, s in zip(origin, start))
+    return start, offset
+
+
+def build_fft_design_operator(kernels, kernel_min, starts, spacing,
+                              oversample, grid_width, size, sn_matrix,
+                              num_total_images, fit_background=False):
+    """Build a matrix-free version of the design matrix for a regular grid.
+
+    The galaxy part of the model in each image is the grid amplitudes
+    convolved with the PSF, so instead of storing one PSF stamp per grid point
+    (which is what construct_psf_background does), we upsample the grid
+    amplitudes onto a lattice oversample times finer than the pixels, convolve
+    with an oversampled kernel using FFTs, and read off the pixel values. The
+    adjoint does the same in reverse, which is all lsqr needs.
+
+    The columns of the operator are ordered exactly as the explicit
+    psf_matrix in run_one_object: grid points, then (if fit_background) one
+    sky level per image, then one SN flux per image.
+
+    Inputs:
+    kernels: list of 2D numpy arrays, one kernel per image, built by
+             construct_psf_kernel with the offsets from fine_lattice_offset.
+    kernel_min: int, the fine lattice index of the first kernel element.
+    starts: list of tuples of ints, per image fine lattice index of the first
+            grid point, from fine_lattice_offset.
+    spacing: float, grid spacing in pixels.
+    oversample: int, fine lattice steps per pixel.
+    grid_width: int, number of grid points along each axis.
+    size: int, the cutout size.
+    sn_matrix: list of 1D numpy arrays, the SN PSF stamps for the detection
+               images (which are the last len(sn_matrix) images).
+    num_total_images: int, the number of images.
+    fit_background: bool, if True include a constant sky level column per
+                    image.
+
+    Returns:
+    A scipy.sparse.linalg.LinearOperator of shape
+    (num_total_images*size**2, number of model components).
+    """
+    step = int(np.rint(spacing * oversample))
+    num_grid = grid_width**2
+    num_bg = num_total_images if fit_background else 0
+    num_sky_and_grid = num_grid + num_bg
+    first_sn = num_total_images - len(sn_matrix)
+    size_sq = size**2
+
+    upsampled_width = step * (grid_width - 1) + 1
+    conv_width = upsampled_width + kernels[0].shape[0] - 1
+    fft_shape = [next_fast_len(conv_width, real=True)] * 2
+
+    kernel_ffts = np.array([np.fft.rfft2(k, s=fft_shape) for k in kernels])
+
+    # Fine lattice locations of the image pixels, per image. Pixels that fall
+    # outside the lattice would only see the (truncated) PSF wings.
+    pixel_index = []
+    for start in starts:
+        jx = np.arange(size) * oversample - start[0] - kernel_min
+        jy = np.arange(size) * oversample - start[1] - kernel_min
+        pixel_index.append((jy, jx))
+    for jy, jx in pixel_index:
+        if np.min(jx) < 0 or np.min(jy) < 0 or np.max(jx) >= fft_shape[1] \
+           or np.max(jy) >= fft_shape[0]:
+            raise ValueError("The PSF kernel does not cover the whole cutout,"
+                             " the grid is too far from the image.")
+
+    def matvec(x):
+        x = np.asarray(x).ravel()
+        upsampled = np.zeros(fft_shape)
+        upsampled[:upsampled_width:step, :upsampled_width:step] = \
+            x[:num_grid].reshape(grid_width, grid_width)
+        convolved = np.fft.irfft2(np.fft.rfft2(upsampled) * kernel_ffts,
+                                  s=fft_shape)
+        model = np.empty((num_total_images, size_sq))
+        for i, (jy, jx) in enumerate(pixel_index):
+            model[i] = convolved[i][np.ix_(jy, jx)].ravel()
+        if fit_background:
+            model += x[num_grid:num_sky_and_grid, np.newaxis]
+        for i, stamp in enumerate(sn_matrix):
+            model[first_sn + i] += x[num_sky_and_grid + first_sn + i] * stamp
+        return model.ravel()
+
+    def rmatvec(y):
+        y = np.asarray(y).ravel().reshape(num_total_images, size_sq)
+        scattered = np.zeros([num_total_images] + fft_shape)
+        for i, (jy, jx) in enumerate(pixel_index):
+            scattered[i][np.ix_(jy, jx)] = y[i].reshape(size, size)
+        correlated = np.fft.irfft2(np.fft.rfft2(scattered)
+                                   * np.conj(kernel_ffts), s=fft_shape)
+        out = np.zeros(num_sky_and_grid + num_total_images)
+        out[:num_grid] = np.sum(correlated[:, :upsampled_width:step,
+                                           :upsampled_width:step],
+                                axis=0).ravel()
+        if fit_background:
+            out[num_grid:num_sky_and_grid] = np.sum(y, axis=1)
+        for i, stamp in enumerate(sn_matrix):
+            out[num_sky_and_grid + first_sn + i] = np.dot(stamp,
+                                                          y[first_sn + i])
+        return out
+
+    shape = (num_total_images * size_sq, num_sky_and_grid + num_total_images)
+    return sp.linalg.LinearOperator(shape, matvec=matvec, rmatvec=rmatvec,
+                                    dtype=float)
+
+
+def normal_matrix_from_operator(operator, wgt_matrix, chunk_size=256):
+    """Compute psf_matrix.T @ diag(wgt_matrix) @ psf_matrix for a design
+    matrix that is only available as a LinearOperator.
+
+    Inputs:
+    operator: scipy.sparse.linalg.LinearOperator, the (unweighted) design
+              matrix.
+    wgt_matrix: 1D numpy array of floats, the weight of each pixel.
+    chunk_size: int, how many columns to push through the operator at once.
+
+    Returns:
+    2D numpy array of floats, shape (operator.shape[1], operator.shape[1]).
+    """
+    num_params = operator.shape[1]
+    normal = np.empty((num_params, num_params))
+    for start in range(0, num_params, chunk_size):
+        stop = min(start + chunk_size, num_params)
+        unit = np.zeros((num_params, stop - start))
+        unit[np.arange(start, stop), np.arange(stop - start)] = 1
+        columns = operator.matmat(unit)
+        normal[:, start:stop] = operator.rmatmat(wgt_matrix[:, np.newaxis]
+                                                 * columns)
+    return normal
+
+
+def sky_indicator_block(num_total_images, size, dtype=np.float64):
+    """The sky columns of the design matrix, one per image, which are one in
+    the rows of that image's pixels and zero everywhere else.
+
+    Inputs:
+    num_total_images: int, the number of images.
+    size: int, the cutout size.
+    dtype: numpy dtype of the ones.
+
+    Returns:
+    scipy.sparse.csr_matrix of shape (num_total_images*size**2,
+    num_total_images), with one stored element per row.
+    """
+    num_rows = num_total_images * size**2
+    return sp.csr_matrix((np.ones(num_rows, dtype=dtype),
+                          np.repeat(np.arange(num_total_images), size**2),
+                          np.arange(num_rows + 1)),
+                         shape=(num_rows, num_total_images))
+
+
+def sky_design_operator(psf_matrix, sky_block, num_grid, wgt_matrix=None):
+    """The design matrix with the sky columns, without building them densely.
+
+    Inputs:
+    psf_matrix: 2D numpy array, the grid columns followed by the SN columns.
+    sky_block: scipy.sparse matrix, the sky columns, see
+               sky_indicator_block.
+    num_grid: int, the number of grid columns.
+    wgt_matrix: 1D numpy array of floats or None. If given, the operator is
+                diag(wgt_matrix) @ the design matrix, which is what lsqr is
+                run on.
+
+    Returns:
+    scipy.sparse.linalg.LinearOperator, with the columns in the same order
+    as the dense design matrix: grid points, one sky level per image, then
+    one SN flux per image.
+    """
+    num_rows = psf_matrix.shape[0]
+    num_sky = sky_block.shape[1]
+    num_cols = psf_matrix.shape[1] + num_sky
+    if wgt_matrix is None:
+        wgt_matrix = np.ones(num_rows)
+
+    def matmat(x):
+        x = np.asarray(x)
+        dense_x = np.concatenate([x[:num_grid], x[num_grid + num_sky:]])
+        out = psf_matrix @ dense_x + sky_block @ x[num_grid:num_grid + num_sky]
+        return wgt_matrix[:, np.newaxis] * out
+
+    def rmatmat(y):
+        y = wgt_matrix[:, np.newaxis] * np.asarray(y)
+        dense = psf_matrix.T @ y
+        return np.concatenate([dense[:num_grid], sky_block.T @ y,
+                               dense[num_grid:]])
+
+    return sp.linalg.LinearOperator(
+        (num_rows, num_cols), dtype=float,
+        matvec=lambda x: matmat(np.reshape(x, (-1, 1))).ravel(),
+        rmatvec=lambda y: rmatmat(np.reshape(y, (-1, 1))).ravel(),
+        matmat=matmat, rmatmat=rmatmat)
+
+
+def sky_normal_matrix(psf_matrix, sky_block, num_grid, wgt_matrix):
+    """psf_matrix.T @ diag(wgt_matrix) @ psf_matrix for the design matrix of
+    sky_design_operator, with the sky columns worked out from the sums over
+    each image rather than from dense columns.
+
+    Inputs:
+    psf_matrix, sky_block, num_grid: see sky_design_operator.
+    wgt_matrix: 1D numpy array of floats, the weight of each pixel.
+
+    Returns:
+    2D numpy array of floats, with the columns ordered as in
+    sky_design_operator.
+    """
+    weighted = wgt_matrix[:, np.newaxis] * psf_matrix
+    dense = psf_matrix.T @ weighted
+    cross = sky_block.T @ weighted
+    sky = np.diag(sky_block.T @ wgt_matrix)
+    normal = np.block([[dense, cross.T], [cross, sky]])
+    num_dense = psf_matrix.shape[1]
+    # From [grid, SN, sky] to [grid, sky, SN].
+    order = np.concatenate([np.arange(num_grid),
+                            num_dense + np.arange(sky_block.shape[1]),
+                            np.arange(num_grid, num_dense)])
+    return normal[np.ix_(order, order)]
+
+
+def allocate_design_matrix(directory, shape, dtype=np.float64):
+    """Create a zero-filled design matrix backed by a file on disk.
+
+    Used by the out-of-core mode of run_one_object so that the size of a fit
+    is limited by disk space rather than memory. Most file systems store the
+    untouched (zero) parts of the file sparsely.
+
+    Inputs:
+    directory: str or pathlib.Path, where to put the file.
+    shape: tuple of ints, (number of pixels, number of model components).
+    dtype: numpy dtype of the matrix.
+
+    Returns:
+    numpy.memmap of the requested shape, opened for reading and writing.
+    """
+    directory = pathlib.Path(directory)
+    directory.mkdir(exist_ok=True, parents=True)
+    path = directory / "psf_matrix.dat"
+    Lager.debug(f"Allocating a {shape} design matrix in {path}")
+    return np.memmap(path, dtype=dtype, mode="w+", shape=shape)
+
+
+def default_chunk_rows(num_columns, chunk_bytes=64 * 2**20):
+    """Number of design matrix rows to hold in memory at once."""
+    return max(1, int(chunk_bytes // (8 * max(num_columns, 1))))
+
+
+def chunked_design_operator(psf_matrix, wgt_matrix=None, chunk_rows=None):
+    """Wrap a (possibly memory-mapped) design matrix in a LinearOperator that
+    only ever reads chunk_rows rows of it at a time.
+
+    Inputs:
+    psf_matrix: 2D array-like, e.g. a numpy.memmap from
+                allocate_design_matrix.
+    wgt_matrix: 1D numpy array of floats or None. If given, the operator is
+                diag(wgt_matrix) @ psf_matrix, which is what lsqr is run on.
+    chunk_rows: int, rows per chunk. Defaults to default_chunk_rows.
+
+    Returns:
+    scipy.sparse.linalg.LinearOperator with the shape of psf_matrix.
+    """
+    num_rows, num_cols = psf_matrix.shape
+    chunk_rows = default_chunk_rows(num_cols) if chunk_rows is None \
+        else chunk_rows
+    if wgt_matrix is None:
+        wgt_matrix = np.ones(num_rows)
+
+    def matvec(x):
+        x = np.asarray(x).ravel()
+        out = np.empty(num_rows)
+        for start in range(0, num_rows, chunk_rows):
+            stop = min(start + chunk_rows, num_rows)
+            out[start:stop] = wgt_matrix[start:stop] * \
+                (psf_matrix[start:stop] @ x)
+        return out
+
+    def rmatvec(y):
+        y = np.asarray(y).ravel()
+        out = np.zeros(num_cols)
+        for start in range(0, num_rows, chunk_rows):
+            stop = min(start + chunk_rows, num_rows)
+            out += psf_matrix[start:stop].T @ (wgt_matrix[start:stop]
+                                               * y[start:stop])
+        return out
+
+    return sp.linalg.LinearOperator((num_rows, num_cols), matvec=matvec,
+                                    rmatvec=rmatvec, dtype=float)
+
+
+def chunked_normal_matrix(psf_matrix, wgt_matrix, chunk_rows=None):
+    """Compute psf_matrix.T @ diag(wgt_matrix) @ psf_matrix reading only
+    chunk_rows rows of psf_matrix at a time.
+
+    Inputs:
+    psf_matrix: 2D array-like, e.g. a numpy.memmap.
+    wgt_matrix: 1D numpy array of floats, the weight of each pixel.
+    chunk_rows: int, rows per chunk. Defaults to default_chunk_rows.
+
+    Returns:
+    2D numpy array of floats, shape (psf_matrix.shape[1], psf_matrix.shape[1])
+    """
+    num_rows, num_cols = psf_matrix.shape
+    chunk_rows = default_chunk_rows(num_cols) if chunk_rows is None \
+        else chunk_rows
+    normal = np.zeros((num_cols, num_cols))
+    for start in range(0, num_rows, chunk_rows):
+        stop = min(start + chunk_rows, num_rows)
+        chunk = np.asarray(psf_matrix[start:stop])
+        normal += chunk.T @ (wgt_matrix[start:stop, np.newaxis] * chunk)
+    return normal
+
+
+def lsqr_with_refinement(psf_matrix, wgt_matrix, images, x0=None,
+                         single_tol=1e-6, max_refinements=5, rtol=1e-12,
+                         rcond=1e-13, iter_lim=300000, conlim=1e10,
+                         chunk_rows=None, precondition=False,
+                         flux_columns=None, flux_rtol=None):
+    """Solve the weighted least squares problem for a single precision design
+    matrix, refining the answer in double precision.
+
+    lsqr is run with single precision matrix products, to a loose tolerance.
+    The answer is then refined: the residual and gradient are accumulated in
+    double precision (upcasting psf_matrix a chunk of rows at a time) and the
+    correction is solved for with the double precision normal matrix. The
+    background grid makes the problem rank deficient, so the normal matrix is
+    pseudo-inverted. The corrections therefore never touch the null space
+    component of the lsqr answer, which is kept as is.
+
+    Inputs:
+    psf_matrix: 2D float32 array-like (may be a numpy.memmap), the design
+                matrix.
+    wgt_matrix: 1D numpy array of floats, the weight of each pixel.
+    images: 1D numpy array of floats, the pixel values.
+    x0: 1D numpy array of floats or None, the initial guess.
+    single_tol: float, atol and btol of the single precision lsqr.
+    max_refinements: int, maximum number of refinement steps.
+    rtol: float, stop refining once the correction is smaller than this
+          fraction of the solution.
+    rcond: float, eigenvalues of the normal matrix smaller than rcond times
+           the largest are treated as zero.
+    iter_lim, conlim: passed to scipy.sparse.linalg.lsqr.
+    chunk_rows: int, rows of psf_matrix upcast at once.
+    precondition, flux_columns, flux_rtol: passed to solve_lsqr for the
+        single precision lsqr. The refinement converges to the same answer
+        either way, they only change how the single precision lsqr gets
+        there.
+
+    Returns:
+    X: 1D numpy array of float64, the solution.
+    itn: int, the number of single precision lsqr iterations.
+    """
+    single_wgt = np.asarray(wgt_matrix, dtype=np.float32)
+    double_wgt = np.asarray(wgt_matrix, dtype=np.float64)
+
+    def single_matvec(x):
+        x = np.asarray(x, dtype=np.float32).ravel()
+        return (single_wgt * (psf_matrix @ x)).astype(np.float64)
+
+    def single_rmatvec(y):
+        y = np.asarray(y, dtype=np.float32).ravel()
+        return (psf_matrix.T @ (single_wgt * y)).astype(np.float64)
+
+    def single_matmat(x):
+        x = np.asarray(x, dtype=np.float32)
+        return (single_wgt[:, np.newaxis] * (psf_matrix @ x)).astype(
+            np.float64)
+
+    single = sp.linalg.LinearOperator(psf_matrix.shape, matvec=single_matvec,
+                                      rmatvec=single_rmatvec,
+                                      matmat=single_matmat, dtype=np.float64)
+    double = chunked_design_operator(psf_matrix, double_wgt,
+                                     chunk_rows=chunk_rows)
+    rhs = np.asarray(images, dtype=np.float64) * double_wgt
+
+    X, istop, itn = solve_lsqr(single, rhs, x0=x0, precondition=precondition,
+                               flux_columns=flux_columns, flux_rtol=flux_rtol,
+                               atol=single_tol, btol=single_tol,
+                               iter_lim=iter_lim, conlim=conlim)
+    Lager.debug(f"float32 lsqr: stop condition {istop}, iterations {itn}")
+
+    # lsqr solves with the weights applied to both sides, so the normal
+    # matrix it converges to uses the squared weights.
+    normal = chunked_normal_matrix(psf_matrix, double_wgt**2,
+                                   chunk_rows=chunk_rows)
+    eigenvalues, eigenvectors = np.linalg.eigh(normal)
+    keep = eigenvalues > rcond * eigenvalues.max()
+    eigenvalues, eigenvectors = eigenvalues[keep], eigenvectors[:, keep]
+    for refinement in range(max_refinements):
+        gradient = double.rmatvec(rhs - double.matvec(X))
+        correction = eigenvectors @ (eigenvectors.T @ gradient / eigenvalues)
+        X = X + correction
+        change = np.linalg.norm(correction) / max(np.linalg.norm(X),
+                                                  np.finfo(float).tiny)
+        Lager.debug(f"Refinement {refinement}: relative change {change:.2e}")
+        if change <= rtol:
+            break
+
+    return X, itn
+
+
+def column_norms(matrix, chunk_size=256):
+    """The 2-norm of each column of a design matrix.
+
+    Inputs:
+    matrix: 2D numpy array (may be a numpy.memmap) or
+            scipy.sparse.linalg.LinearOperator.
+    chunk_size: int, how many columns to push through a LinearOperator at
+                once. Arrays are read default_chunk_rows rows at a time.
+
+    Returns:
+    1D numpy array of floats, one per column.
+    """
+    num_rows, num_cols = matrix.shape
+    squares = np.zeros(num_cols)
+    if isinstance(matrix, sp.linalg.LinearOperator):
+        for start in range(0, num_cols, chunk_size):
+            stop = min(start + chunk_size, num_cols)
+            unit = np.zeros((num_cols, stop - start))
+            unit[np.arange(start, stop), np.arange(stop - start)] = 1
+            squares[start:stop] = np.sum(matrix.matmat(unit)**2, axis=0)
+    else:
+        chunk_rows = default_chunk_rows(num_cols)
+        for start in range(0, num_rows, chunk_rows):
+            chunk = np.asarray(matrix[start:start + chunk_rows],
+                               dtype=np.float64)
+            squares += np.sum(chunk**2, axis=0)
+    return np.sqrt(squares)
+
+
+def lsqr_flux_stopping(operator, rhs, flux_columns, x0=None, flux_rtol=1e-6,
+                       patience=10, iter_lim=300000, scale=None):
+    """LSQR (Paige & Saunders 1982) that stops once the SN fluxes stop
+    changing, rather than on the residual tolerances.
+
+    The iterations are the same as scipy.sparse.linalg.lsqr's. After each
+    one, the SN fluxes are compared with the previous iteration's, and the
+    solve stops once their change has been below flux_rtol of their size
+    for patience iterations in a row.
+
+    Inputs:
+    operator: 2D numpy array or scipy.sparse.linalg.LinearOperator, the
+              (weighted, possibly preconditioned) design matrix.
+    rhs: 1D numpy array, the (weighted) pixel values.
+    flux_columns: 1D numpy array of ints, the SN flux columns.
+    x0: 1D numpy array or None, initial guess.
+    flux_rtol: float, the relative change in the SN fluxes that counts as
+               converged.
+    patience: int, how many converged iterations in a row are needed.
+    iter_lim: int, the maximum number of iterations.
+    scale: 1D numpy array or None. If the operator is right preconditioned
+           by diag(scale), the fluxes compared are scale * x.
+
+    Returns:
+    X: 1D numpy array, the solution.
+    istop: int, 1 if the fluxes converged, 0 if an exact solution was
+           found, 7 if iter_lim was reached. (Following scipy's istop.)
+    itn: int, the number of iterations.
+    """
+    operator = sp.linalg.aslinearoperator(operator)
+    scale = np.ones(operator.shape[1]) if scale is None else scale
+    X = np.zeros(operator.shape[1]) if x0 is None \
+        else np.array(x0, dtype=float)
+    u = rhs - operator.matvec(X)
+    beta = np.linalg.norm(u)
+    if beta == 0:
+        return X, 0, 0
+    u = u / beta
+    v = operator.rmatvec(u)
+    alpha = np.linalg.norm(v)
+    if alpha == 0:
+        return X, 0, 0
+    v = v / alpha
+    w = v.copy()
+    phibar, rhobar = beta, alpha
+
+    flux = scale[flux_columns] * X[flux_columns]
+    converged_for = 0
+    for itn in range(1, iter_lim + 1):
+        # Golub-Kahan bidiagonalization step.
+        u = operator.matvec(v) - alpha * u
+        beta = np.linalg.norm(u)
+        if beta > 0:
+            u = u / beta
+            v = operator.rmatvec(u) - beta * v
+            alpha = np.linalg.norm(v)
+            if alpha > 0:
+                v = v / alpha
+
+        # Plane rotation to eliminate beta.
+        rho = np.hypot(rhobar, beta)
+        c, s = rhobar / rho, beta / rho
+        theta = s * alpha
+        rhobar = -c * alpha
+        phi = c * phibar
+        phibar = s * phibar
+
+        X = X + (phi / rho) * w
+        w = v - (theta / rho) * w
+
+        new_flux = scale[flux_columns] * X[flux_columns]
+        change = np.linalg.norm(new_flux - flux)
+        flux = new_flux
+        if change <= flux_rtol * max(np.linalg.norm(flux),
+                                     np.finfo(float).tiny):
+            converged_for += 1
+        else:
+            converged_for = 0
+        if converged_for >= patience:
+            return X, 1, itn
+        if beta == 0 or alpha == 0:
+            return X, 0, itn
+
+    return X, 7, iter_lim
+
+
+def solve_lsqr(weighted_psf_matrix, rhs, x0=None, precondition=False,
+               flux_columns=None, flux_rtol=None, atol=1e-12, btol=1e-12,
+               iter_lim=300000, conlim=1e10):
+    """Solve the weighted least squares problem with lsqr, optionally right
+    preconditioned and optionally stopping on the SN flux change.
+
+    The design matrix columns differ a lot in scale (unit flux PSF stamps,
+    all-ones sky columns, weights), which makes lsqr's iteration count very
+    configuration dependent. precondition scales every column of the
+    weighted matrix to unit norm, and the scaling is undone on the result.
+    This is also Jacobi preconditioning of the normal matrix, whose diagonal
+    holds the squared column norms.
+
+    Inputs:
+    weighted_psf_matrix: 2D numpy array (may be a numpy.memmap) or
+                         scipy.sparse.linalg.LinearOperator, the design
+                         matrix with the weights applied.
+    rhs: 1D numpy array, the weighted pixel values.
+    x0: 1D numpy array or None, initial guess.
+    precondition: bool, whether to equilibrate the columns.
+    flux_columns: 1D numpy array of ints, the SN flux columns. Needed if
+                  flux_rtol is given.
+    flux_rtol: float or None. If given, stop once the SN fluxes change by
+               less than this (relative) between iterations, see
+               lsqr_flux_stopping. If None, use atol and btol.
+    atol, btol, iter_lim, conlim: passed to scipy.sparse.linalg.lsqr.
+
+    Returns:
+    X: 1D numpy array, the solution.
+    istop: int, the reason lsqr stopped.
+    itn: int, the number of iterations.
+    """
+    operator = sp.linalg.aslinearoperator(weighted_psf_matrix)
+    scale = None
+    if precondition:
+        norms = column_norms(weighted_psf_matrix)
+        # Columns that are zero everywhere (the SN columns of pre-detection
+        # images) are left alone.
+        scale = np.where(norms > 0, 1 / np.where(norms > 0, norms, 1), 1)
+        operator = operator @ sp.linalg.aslinearoperator(sp.diags(scale))
+        if x0 is not None:
+            x0 = x0 / scale
+
+    if flux_rtol is None:
+        Y, istop, itn = sp.linalg.lsqr(operator, rhs, x0=x0, atol=atol,
+                                       btol=btol, iter_lim=iter_lim,
+                                       conlim=conlim)[:3]
+    else:
+        Y, istop, itn = lsqr_flux_stopping(operator, rhs, flux_columns,
+                                           x0=x0, flux_rtol=flux_rtol,
+                                           iter_lim=iter_lim, scale=scale)
+
+    X = Y if scale is None else scale * Y
+    return X, istop, itn
+
+
+def solve_epoch_against_host(epoch_matrix, grid_matrix, host, image,
+                             wgt_matrix):
+    """Fit a single detection epoch with the host galaxy model held fixed.
+
+    Inputs:
+    epoch_matrix: 2D numpy array, shape (s^2, k). The columns being fit for
+                  this epoch, the SN PSF first and then (optionally) the sky.
+    grid_matrix: 2D numpy array, shape (s^2, g). This epoch's background grid
+                 columns.
+    host: 1D numpy array of length g, the frozen grid amplitudes.
+    image: 1D numpy array of length s^2, the pixel values.
+    wgt_matrix: 1D numpy array of length s^2, the pixel weights.
+
+    Returns:
+    coeffs: 1D numpy array of length k, the fitted values.
+    cov: 2D numpy array, shape (k, k), their covariance for a perfectly
+         known host.
+    sensitivity: 2D numpy array, shape (k, g), the change in coeffs per unit
+                 decrease of each host amplitude. Used to propagate the
+                 host model uncertainty.
+    """
+    # Same weighting as the joint lsqr solve: weights applied to both sides.
+    estimator = np.linalg.pinv(epoch_matrix * wgt_matrix[:, np.newaxis]) \
+        * wgt_matrix
+    coeffs = estimator @ (image - grid_matrix @ host)
+    cov = np.linalg.pinv(epoch_matrix.T @ (wgt_matrix[:, np.newaxis]
+                                           * epoch_matrix))
+    sensitivity = estimator @ grid_matrix
+
+    return coeffs, cov, sensitivity
+
+
+def two_stage_fit(psf_matrix, images, wgt_matrix, num_total_images,
+                  num_detect_images, size, num_grid, fit_background,
+                  x0=None):
+    """Fit the host galaxy grid from the pre-detection images alone, then fit
+    each detection epoch independently against that frozen host model.
+
+    Instead of one joint solve over every epoch, this does one solve over
+    the pre-detection images (grid amplitudes and, if fit_background, their
+    skies) and then a tiny solve per detection epoch (SN flux and, if
+    fit_background, sky). The cost of the per-epoch solves is linear in the
+    number of epochs.
+
+    The host uncertainty is propagated into the SN flux covariance. Since
+    every epoch uses the same host model, this term also correlates the
+    fluxes of different epochs.
+
+    Inputs:
+    psf_matrix: 2D array-like (may be a numpy.memmap), the design matrix
+                built by run_one_object, with columns [grid, sky (only if
+                fit_background), SN] and one block of s^2 rows per image,
+                pre-detection images first.
+    images: 1D numpy array of the pixel values.
+    wgt_matrix: 1D numpy array of the pixel weights.
+    num_total_images: int, the total number of images.
+    num_detect_images: int, the number of detection images.
+    size: int, the cutout size s.
+    num_grid: int, the number of background grid points.
+    fit_background: bool, whether there is a sky column per image.
+    x0: 1D numpy array of length num_grid or None, initial guess for the
+        grid amplitudes.
+
+    Returns:
+    X: 1D numpy array, the solution in the same layout as the joint fit.
+    flux_cov: 2D numpy array of the covariance of the SN fluxes, including
+              the host model uncertainty.
+    """
+    num_nondetect_images = num_total_images - num_detect_images
+    if num_nondetect_images == 0 or num_detect_images == 0:
+        raise ValueError("The two stage fit needs both pre-detection and "
+                         "detection images.")
+    pixels = size**2
+    num_bg_columns = num_grid
+    if fit_background:
+        num_bg_columns += num_total_images
+
+    # Stage one: the host, from the pre-detection images only.
+    host_rows = slice(0, num_nondetect_images * pixels)
+    host_columns = np.arange(num_grid)
+    if fit_background:
+        host_columns = np.concatenate([host_columns,
+                                       num_grid +
+                                       np.arange(num_nondetect_images)])
+    host_matrix = np.asarray(psf_matrix[host_rows],
+                             dtype=np.float64)[:, host_columns]
+    host_wgt = np.asarray(wgt_matrix[host_rows], dtype=np.float64)
+    host_images = np.asarray(images[host_rows], dtype=np.float64)
+    if x0 is not None:
+        x0 = np.concatenate([x0, np.zeros(np.size(host_columns) - num_grid)])
+    lsqr = sp.linalg.lsqr(host_matrix * host_wgt[:, np.newaxis],
+                          host_images * host_wgt, x0=x0, atol=1e-12,
+                          btol=1e-12, iter_lim=300000, conlim=1e10)
+    host_X, istop, itn = lsqr[:3]
+    Lager.debug(f"Host fit: stop condition {istop}, iterations {itn}")
+    host_inv_cov = host_matrix.T @ (host_wgt[:, np.newaxis] * host_matrix)
+    try:
+        host_cov = np.linalg.inv(host_inv_cov)
+    except LinAlgError:
+        host_cov = np.linalg.pinv(host_inv_cov)
+    grid_cov = host_cov[:num_grid, :num_grid]
+
+    X = np.zeros(psf_matrix.shape[1])
+    X[host_columns] = host_X
+    host = X[:num_grid]
+
+    # Stage two: each detection epoch on its own.
+    flux_var = np.zeros(num_detect_images)
+    flux_sensitivity = np.zeros((num_detect_images, num_grid))
+    for k, i in enumerate(range(num_nondetect_images, num_total_images)):
+        rows = slice(i * pixels, (i + 1) * pixels)
+        block = np.asarray(psf_matrix[rows], dtype=np.float64)
+        epoch_columns = [num_bg_columns + i]
+        if fit_background:
+            epoch_columns.append(num_grid + i)
+        coeffs, cov, sensitivity = \
+            solve_epoch_against_host(block[:, epoch_columns],
+                                     block[:, :num_grid], host,
+                                     np.asarray(images[rows],
+                                                dtype=np.float64),
+                                     np.asarray(wgt_matrix[rows],
+                                                dtype=np.float64))
+        X[epoch_columns] = coeffs
+        flux_var[k] = cov[0, 0]
+        flux_sensitivity[k] = sensitivity[0]
+
+    host_term = flux_sensitivity @ grid_cov @ flux_sensitivity.T
+    Lager.debug(f"Host model flux variance: {np.diag(host_term)}")
+    flux_cov = np.diag(flux_var) + host_term
+
+    return X, flux_cov
+
+
+def factor_design_matrix(psf_matrix, wgt_matrix, rcond=1e-12):
+    """Factor the weighted design matrix once, so that many pixel vectors
+    (noise realizations, bootstrap resamplings) can be fit against it
+    cheaply with solve_factored.
+
+    This uses a thin SVD of diag(wgt_matrix) @ psf_matrix, the matrix lsqr
+    is run on. The background grid makes it rank deficient, so singular
+    values below rcond times the largest are dropped, giving the minimum
+    norm solution that lsqr converges to from a zero initial guess.
+
+    Inputs:
+    psf_matrix: 2D numpy array, the design matrix.
+    wgt_matrix: 1D numpy array, the pixel weights.
+    rcond: float, relative cutoff for small singular values.
+
+    Returns:
+    dict with the truncated factors "U", "s" and "Vt", and "wgt_matrix".
+    """
+    wgt_matrix = np.asarray(wgt_matrix, dtype=np.float64)
+    weighted = np.asarray(psf_matrix, dtype=np.float64) * \
+        wgt_matrix[:, np.newaxis]
+    U, s, Vt = np.linalg.svd(weighted, full_matrices=False)
+    keep = s > rcond * s.max()
+    Lager.debug(f"Kept {np.sum(keep)} of {np.size(s)} singular values.")
+    return {"U": U[:, keep], "s": s[keep], "Vt": Vt[keep],
+            "wgt_matrix": wgt_matrix}
+
+
+def solve_factored(factorization, images):
+    """Solve for one or many pixel vectors with a factored design matrix.
+
+    Inputs:
+    factorization: dict, from factor_design_matrix.
+    images: numpy array of the pixel values, shape (n_pixels,) or
+            (n_pixels, K) for K stacked realizations.
+
+    Returns:
+    X: numpy array of the solutions, shape (n_params,) or (n_params, K).
+       The SN fluxes are the last num_detect_images rows.
+    """
+    wgt_matrix = factorization["wgt_matrix"]
+    rhs = images * (wgt_matrix if images.ndim == 1
+                    else wgt_matrix[:, np.newaxis])
+    coeffs = factorization["U"].T @ rhs
+    coeffs = coeffs / (factorization["s"] if images.ndim == 1
+                       else factorization["s"][:, np.newaxis])
+    return factorization["Vt"].T @ coeffs
+
+
+def residual_bootstrap_images(model, wgt_matrix, images, num_draws,
+                              rng=None):
+    """Make residual bootstrap resamplings of a fitted set of images.
+
+    The weighted residuals (the quantity the fit minimizes) of the pixels
+    with non-zero weight are resampled with replacement and added back to
+    the model. Fitting these with solve_factored gives bootstrap SN fluxes
+    without rebuilding the design matrix.
+
+    Inputs:
+    model: 1D numpy array, the model pixel values of the fit.
+    wgt_matrix: 1D numpy array, the pixel weights.
+    images: 1D numpy array, the pixel values that were fit.
+    num_draws: int, the number of resamplings.
+    rng: numpy.random.Generator or None.
+
+    Returns:
+    2D numpy array, shape (n_pixels, num_draws).
+    """
+    rng = np.random.default_rng() if rng is None else rng
+    used = wgt_matrix > 0
+    weighted_residuals = (wgt_matrix * (images - model))[used]
+    resampled = np.tile(model[:, np.newaxis], (1, num_draws))
+    draws = rng.choice(weighted_residuals, size=(np.sum(used), num_draws))
+    resampled[used] += draws / wgt_matrix[used, np.newaxis]
+    return resampled
+
+
+def jackknife_epoch_fluxes(psf_matrix, wgt_matrix, images, num_total_images,
+                           num_detect_images, size):
+    """SN fluxes with each epoch left out in turn.
+
+    Rather than refitting from scratch, the rows of the left out epoch are
+    downdated from the normal equations of the full fit, and the columns
+    that only that epoch constrains (its sky and SN flux) are dropped.
+
+    Inputs:
+    psf_matrix: 2D numpy array, the design matrix, one block of size^2 rows
+                per image, SN flux columns last.
+    wgt_matrix: 1D numpy array, the pixel weights.
+    images: 1D numpy array, the pixel values.
+    num_total_images: int, the total number of images.
+    num_detect_images: int, the number of detection images.
+    size: int, the cutout size.
+
+    Returns:
+    2D numpy array, shape (num_total_images, num_detect_images). Row e holds
+    the fluxes with epoch e left out, NaN for that epoch's own flux.
+    """
+    wgt_matrix = np.asarray(wgt_matrix, dtype=np.float64)
+    weighted = np.asarray(psf_matrix, dtype=np.float64) * \
+        wgt_matrix[:, np.newaxis]
+    weighted_images = wgt_matrix * np.asarray(images, dtype=np.float64)
+    normal = weighted.T @ weighted
+    rhs = weighted.T @ weighted_images
+    num_params = np.shape(psf_matrix)[1]
+    pixels = size**2
+
+    # Which columns each epoch constrains.
+    constrains = np.array([np.any(weighted[e * pixels:(e + 1) * pixels] != 0,
+                                  axis=0) for e in range(num_total_images)])
+
+    fluxes = np.full((num_total_images, num_detect_images), np.nan)
+    for e in range(num_total_images):
+        rows = slice(e * pixels, (e + 1) * pixels)
+        block = weighted[rows]
+        left_out_normal = normal - block.T @ block
+        left_out_rhs = rhs - block.T @ weighted_images[rows]
+        keep = np.any(np.delete(constrains, e, axis=0), axis=0)
+        X = np.full(num_params, np.nan)
+        X[keep] = np.linalg.lstsq(left_out_normal[np.ix_(keep, keep)],
+                                  left_out_rhs[keep], rcond=None)[0]
+        fluxes[e] = X[-num_detect_images:]
+    return fluxes
+
+
+def batch_solve(psf_matrices, wgt_matrices, images):
+    """Solve many small, independent fits (e.g. stars with grid_type none)
+    in one call, instead of one lsqr per object.
+
+    If every design matrix has the same shape, the weighted normal
+    equations are stacked and solved with one batched numpy.linalg call.
+    Otherwise the objects are put in one block diagonal sparse system and
+    solved with a single lsqr. Either way, the weighting matches
+    run_one_object: weights applied to both sides for the solution, and
+    once for the covariance.
+
+    Inputs:
+    psf_matrices: list of 2D numpy arrays, each object's design matrix.
+    wgt_matrices: list of 1D numpy arrays, each object's pixel weights.
+    images: list of 1D numpy arrays, each object's pixel values.
+
+    Returns:
+    X: list of 1D numpy arrays, each object's solution.
+    cov: list of 2D numpy arrays, each object's covariance.
+    """
+    shapes = {np.shape(matrix) for matrix in psf_matrices}
+    if len(shapes) == 1:
+        A = np.asarray(psf_matrices, dtype=np.float64)
+        w = np.asarray(wgt_matrices, dtype=np.float64)[:, :, np.newaxis]
+        b = np.asarray(images, dtype=np.float64)[:, :, np.newaxis]
+        solve_normal = np.swapaxes(A, 1, 2) @ (w**2 * A)
+        solve_rhs = np.swapaxes(A, 1, 2) @ (w**2 * b)
+        cov_normal = np.swapaxes(A, 1, 2) @ (w * A)
+        # Pre-detection SN columns are all zero, which makes some of these
+        # singular. Only those objects fall back to the pseudo-inverse.
+        X = _batched_solve(solve_normal, solve_rhs)[:, :, 0]
+        cov = _batched_solve(cov_normal)
+        return list(X), list(cov)
+
+    weighted = sp.block_diag([sp.csr_matrix(np.asarray(matrix) *
+                                            np.asarray(wgt)[:, np.newaxis])
+                              for matrix, wgt in zip(psf_matrices,
+                                                     wgt_matrices)],
+                             format="csr")
+    rhs = np.concatenate([np.asarray(image) * np.asarray(wgt)
+                          for image, wgt in zip(images, wgt_matrices)])
+    lsqr = sp.linalg.lsqr(weighted, rhs, atol=1e-12, btol=1e-12,
+                          iter_lim=300000, conlim=1e10)
+    Lager.debug(f"Batch lsqr: stop condition {lsqr[1]}, iterations "
+                f"{lsqr[2]}")
+    splits = np.cumsum([np.shape(matrix)[1] for matrix in psf_matrices])[:-1]
+    X = np.split(lsqr[0], splits)
+    cov = []
+    for matrix, wgt in zip(psf_matrices, wgt_matrices):
+        cov_normal = matrix.T @ (np.asarray(wgt)[:, np.newaxis] * matrix)
+        try:
+            cov.append(np.linalg.inv(cov_normal))
+        except LinAlgError:
+            cov.append(np.linalg.pinv(cov_normal))
+    return X, cov
+
+
+def _batched_solve(normal, rhs=None):
+    """Solve a stack of normal equations, or invert them if rhs is None.
+
+    numpy.linalg.solve and inv fail for the whole stack if any member is
+    singular, so the singular members (found from the sign of their
+    determinant, which is 0 when the LU factorization hits a zero pivot)
+    are done with the pseudo-inverse and the others with one batched call.
+    """
+    sign, _ = np.linalg.slogdet(normal)
+    singular = sign == 0
+    regular = ~singular
+    out = np.empty_like(normal if rhs is None else rhs)
+    if np.any(regular):
+        out[regular] = np.linalg.inv(normal[regular]) if rhs is None else \
+            np.linalg.solve(normal[regular], rhs[regular])
+    for i in np.flatnonzero(singular):
+        pinv = np.linalg.pinv(normal[i])
+        out[i] = pinv if rhs is None else pinv @ rhs[i]
+    return out
+
+
+def new_normal_state(num_grid, fit_background):
+    """Create the normal equation state of an object with no images yet.
+
+    The state holds everything needed to re-solve the fit without the design
+    matrix, as triangular factors rather than the normal matrices
+    themselves: R and Q^T b of the QR factorization of the weighted design
+    matrix lsqr solves (weights applied to both sides), and R of the design
+    matrix with the square root of the weights, whose R^T R is the normal
+    matrix the covariance is computed from (weights applied once). Its
+    columns are laid out like the joint fit, [grid, sky per image (only if
+    fit_background), SN per image], with the images in the order they were
+    added.
+
+    Inputs:
+    num_grid: int, the number of background grid points.
+    fit_background: bool, whether there is a sky column per image.
+
+    Returns:
+    dict, the state.
+    """
+    return {"solve_factor": np.zeros((0, num_grid)),
+            "solve_rhs": np.zeros(0),
+            "cov_factor": np.zeros((0, num_grid)),
+            "num_grid": num_grid,
+            "fit_background": fit_background,
+            "num_images": 0}
+
+
+def update_normal_state(state, psf_matrix, images, wgt_matrix,
+                        num_new_images, chunk_rows=None):
+    """Add new images to a normal equation state.
+
+    A new image's rows of the design matrix are only non zero in the grid
+    columns and its own sky and SN columns, so this is an exact update: the
+    old factors are padded with zeros in the new columns, the new rows are
+    stacked under them, and the stack is factored again (a QR update by
+    adding rows, Golub & Van Loan 6.5). The cost scales with the new images
+    and the number of columns, not with the images already in the state.
+
+    Inputs:
+    state: dict, from new_normal_state or a previous update.
+    psf_matrix: 2D array-like (may be a numpy.memmap or float32), the design
+                matrix of the new images only, columns laid out as
+                [grid, sky per new image (only if fitting the sky), SN per
+                new image].
+    images: 1D numpy array, the pixel values of the new images.
+    wgt_matrix: 1D numpy array, the pixel weights of the new images.
+    num_new_images: int, the number of new images.
+    chunk_rows: int, rows of psf_matrix factored in at once.
+
+    Returns:
+    state: dict, the updated state.
+    new_columns: 1D numpy array of ints, where the columns of psf_matrix
+                 are in the updated state.
+    """
+    num_grid = state["num_grid"]
+    fit_background = state["fit_background"]
+    num_old = state["num_images"]
+    num_images = num_old + num_new_images
+
+    old_columns = [np.arange(num_grid)]
+    new_columns = [np.arange(num_grid)]
+    sn_start = num_grid
+    if fit_background:
+        old_columns.append(num_grid + np.arange(num_old))
+        new_columns.append(num_grid + num_old + np.arange(num_new_images))
+        sn_start += num_images
+    old_columns.append(sn_start + np.arange(num_old))
+    new_columns.append(sn_start + num_old + np.arange(num_new_images))
+    old_columns = np.concatenate(old_columns)
+    new_columns = np.concatenate(new_columns)
+    num_columns = sn_start + num_images
+
+    if chunk_rows is None:
+        chunk_rows = default_chunk_rows(num_columns)
+    wgt_matrix = np.asarray(wgt_matrix, dtype=np.float64)
+    images = np.asarray(images, dtype=np.float64)
+    updated = dict(state, num_images=num_images)
+    # The right hand side is factored as one more column, the top of its
+    # column of R is then Q^T b.
+    for key, wgt, rhs in (("solve_factor", wgt_matrix, wgt_matrix * images),
+                          ("cov_factor", np.sqrt(wgt_matrix), None)):
+        num_stacked = num_columns + (rhs is not None)
+        factor = np.zeros((state[key].shape[0], num_stacked))
+        factor[:, old_columns] = state[key]
+        if rhs is not None:
+            factor[:, -1] = state["solve_rhs"]
+        for start in range(0, np.shape(psf_matrix)[0], chunk_rows):
+            stop = min(start + chunk_rows, np.shape(psf_matrix)[0])
+            rows = np.zeros((stop - start, num_stacked))
+            rows[:, new_columns] = wgt[start:stop, np.newaxis] * \
+                np.asarray(psf_matrix[start:stop], dtype=np.float64)
+            if rhs is not None:
+                rows[:, -1] = rhs[start:stop]
+            factor = np.linalg.qr(np.vstack([factor, rows]), mode="r")
+        if rhs is not None:
+            updated["solve_rhs"] = factor[:, -1]
+            factor = factor[:, :-1]
+        updated[key] = factor
+
+    return updated, new_columns
+
+
+def solve_normal_state(state):
+    """Solve a normal equation state.
+
+    The solution comes from the triangular factor of the weighted design
+    matrix, not from its normal matrix, so the condition number is that of
+    the fit itself (as for lsqr), not its square.
+
+    Inputs:
+    state: dict, from update_normal_state.
+
+    Returns:
+    X: 1D numpy array, the solution.
+    cov: 2D numpy array, its covariance.
+    sn_columns: 1D numpy array of ints, the SN flux column of each image.
+    """
+    # The grid makes this rank deficient, lstsq picks the minimum norm
+    # solution like lsqr does when started from zero.
+    X = np.linalg.lstsq(state["solve_factor"], state["solve_rhs"],
+                        rcond=None)[0]
+    # cov = inv(R^T R) = inv(R) inv(R)^T.
+    cov_factor = state["cov_factor"]
+    try:
+        if cov_factor.shape[0] != cov_factor.shape[1]:
+            raise LinAlgError("Fewer weighted pixels than columns.")
+        inverse = solve_triangular(cov_factor, np.eye(cov_factor.shape[1]))
+    except LinAlgError:
+        inverse = np.linalg.pinv(cov_factor)
+    cov = inverse @ inverse.T
+    sn_start = state["num_grid"]
+    if state["fit_background"]:
+        sn_start += state["num_images"]
+    sn_columns = sn_start + np.arange(state["num_images"])
+
+    return X, cov, sn_columns
+
+
+def save_normal_state(path, state, exposures, ra_grid, dec_grid, settings):
+    """Save a normal equation state, with the exposures and the grid it was
+    built from, so a later run only needs to add new exposures.
+
+    Inputs:
+    path: str or pathlib.Path, the .npz file to write.
+    state: dict, from update_normal_state.
+    exposures: astropy.table.Table, the exposures in the state, in order.
+    ra_grid, dec_grid: 1D numpy arrays, the background grid.
+    settings: dict of scalars, the fit settings the state is only valid
+              for.
+    """
+    path = pathlib.Path(path)
+    path.parent.mkdir(exist_ok=True, parents=True)
+    columns = {}
+    for name in exposures.colnames:
+        column = np.asarray(exposures[name])
+        if column.dtype == object:
+            column = column.astype(str)
+        columns[f"exposures_{name}"] = column
+    np.savez(path, ra_grid=ra_grid, dec_grid=dec_grid, **state, **columns,
+             **{f"setting_{key}": value for key, value in settings.items()})
+    Lager.debug(f"Saved normal equation state to {path}")
+
+
+def load_normal_state(path):
+    """Load a normal equation state written by save_normal_state.
+
+    Inputs:
+    path: str or pathlib.Path, the .npz file.
+
+    Returns:
+    state: dict, the normal equation state.
+    exposures: astropy.table.Table, the exposures in the state.
+    ra_grid, dec_grid: 1D numpy arrays, the background grid.
+    settings: dict, the fit settings the state was built with.
+    """
+    state = {}
+    exposures = Table()
+    settings = {}
+    with np.load(path) as f:
+        for key in f.files:
+            if key.startswith("exposures_"):
+                exposures[key[len("exposures_"):]] = f[key]
+            elif key.startswith("setting_"):
+                settings[key[len("setting_"):]] = f[key].item()
+            elif key in ("ra_grid", "dec_grid"):
+                continue
+            elif f[key].ndim == 0:
+                state[key] = f[key].item()
+            else:
+                state[key] = f[key]
+        ra_grid = f["ra_grid"]
+        dec_grid = f["dec_grid"]
+
+    return state, exposures, ra_grid, dec_grid, settings
+
+
+def warm_start_path(cache_dir, ID, band, grid_settings):
+    """The warm start cache file for an object, band and grid settings.
+
+    Inputs:
+    cache_dir: str or pathlib.Path, the cache directory.
+    ID: int, the object ID.
+    band: str, the band.
+    grid_settings: dict, everything that decides the background grid.
+
+    Returns:
+    pathlib.Path of the .npz cache file.
+    """
+    settings = ",".join(f"{key}={grid_settings[key]}"
+                        for key in sorted(grid_settings))
+    digest = hashlib.sha1(settings.encode()).hexdigest()[:12]
+    return pathlib.Path(cache_dir) / f"{ID}_{band}_{digest}_warm_start.npz"
+
+
+def save_warm_start(path, X, ra_grid, dec_grid, exposures, fit_background,
+                    iterations=-1):
+    """Save a solution so it can seed lsqr the next time this object is run.
+
+    Inputs:
+    path: str or pathlib.Path, from warm_start_path.
+    X: 1D numpy array, the solution, laid out as [grid, sky per image (only
+       if fit_background), SN per image].
+    ra_grid, dec_grid: 1D numpy arrays, the background grid.
+    exposures: astropy.table.Table, the exposures, in the order of X.
+    fit_background: bool, whether X has a sky column per image.
+    iterations: int, the lsqr iterations it took, -1 if not known.
+    """
+    path = pathlib.Path(path)
+    path.parent.mkdir(exist_ok=True, parents=True)
+    np.savez(path, X=X, ra_grid=ra_grid, dec_grid=dec_grid,
+             pointing=np.asarray(exposures["Pointing"]),
+             sca=np.asarray(exposures["SCA"]), fit_background=fit_background,
+             iterations=iterations)
+    Lager.debug(f"Saved warm start to {path}")
+
+
+def warm_start_guess(path, ra_grid, dec_grid, exposures, fit_background,
+                     grid_guess, flux_guess, match_radius=0.01):
+    """Build an lsqr initial guess from a cached solution.
+
+    Grid points are matched by position and images by (Pointing, SCA).
+    Whatever is not in the cache (new grid points, new images, or a sky
+    that was not fit before) gets the usual default guess.
+
+    Inputs:
+    path: str or pathlib.Path, a file written by save_warm_start.
+    ra_grid, dec_grid: 1D numpy arrays, this run's background grid.
+    exposures: astropy.table.Table, this run's exposures, in order.
+    fit_background: bool, whether this run fits a sky per image.
+    grid_guess: 1D numpy array, the default guess for the grid.
+    flux_guess: float, the default guess for the SN fluxes.
+    match_radius: float, grid points closer than this (in arcseconds) are
+                  considered the same.
+
+    Returns:
+    x0: 1D numpy array, laid out as [grid, sky per image (only if
+        fit_background), SN per image].
+    iterations: int, the lsqr iterations of the cached fit, -1 if not
+                known.
+    """
+    num_grid = np.size(ra_grid)
+    num_images = len(exposures)
+    with np.load(path) as f:
+        cached = {key: f[key] for key in f.files}
+    cached_num_grid = np.size(cached["ra_grid"])
+    cached_num_images = np.size(cached["pointing"])
+
+    grid = np.array(grid_guess, dtype=float)
+    if num_grid > 0 and cached_num_grid > 0:
+        cos_dec = np.cos(np.deg2rad(np.mean(dec_grid)))
+        separation = np.hypot((ra_grid[:, np.newaxis] - cached["ra_grid"])
+                              * cos_dec,
+                              dec_grid[:, np.newaxis] - cached["dec_grid"])
+        nearest = np.argmin(separation, axis=1)
+        matched = separation[np.arange(num_grid), nearest] * 3600 < \
+            match_radius
+        grid[matched] = cached["X"][nearest[matched]]
+    else:
+        matched = np.zeros(num_grid, dtype=bool)
+
+    sky = np.zeros(num_images)
+    flux = np.full(num_images, float(flux_guess))
+    cached_index = {key: i for i, key in
+                    enumerate(zip(cached["pointing"].tolist(),
+                                  cached["sca"].tolist()))}
+    cached_sn_start = cached_num_grid
+    if cached["fit_background"]:
+        cached_sn_start += cached_num_images
+    num_matched_images = 0
+    for i, key in enumerate(zip(np.asarray(exposures["Pointing"]).tolist(),
+                                np.asarray(exposures["SCA"]).tolist())):
+        if key not in cached_index:
+            continue
+        num_matched_images += 1
+        j = cached_index[key]
+        flux[i] = cached["X"][cached_sn_start + j]
+        if cached["fit_background"]:
+            sky[i] = cached["X"][cached_num_grid + j]
+
+    Lager.debug(f"Warm start matched {np.sum(matched)} of {num_grid} grid "
+                f"points and {num_matched_images} of {num_images} images.")
+    parts = [grid, sky, flux] if fit_background else [grid, flux]
+
+    return np.concatenate(parts), int(cached["iterations"])
+
+
+# The terms of the run time model in estimate_cost, and their default
+# coefficients in seconds. The linear algebra ones are from
+# benchmarks/float32_refinement.py, the PSF drawing ones are rough, fit your
+# own with fit_cost_model.
+
+
+COST_MODEL_TERMS = ("object", "images", "image_grid_points", "lsqr",
+                    "dense_covariance", "inverse")
+
+
+DEFAULT_COST_MODEL = (5.0, 1.0, 2e-3, 2e-8, 4e-11, 2e-10)
+
+
+def estimate_cost(num_total_images, num_grid, size, subtract_background,
+                  use_fft_operator=False, out_of_core=False,
+                  use_float32=False, two_stage=False, cost_model=None):
+    """Estimate the size of the fit of one object, the memory it needs and
+    how long it takes, without building anything.
+
+    The run time is linear in the terms of COST_MODEL_TERMS: a constant per
+    object, the number of images (reading them and drawing the SN PSFs),
+    images x grid points (drawing the background PSFs), rows x columns^2
+    (lsqr, as the number of iterations grows with the number of columns),
+    rows^2 x columns (the in-memory covariance, which multiplies by
+    np.diag(wgt_matrix)) and columns^3 (inverting it). The memory is that of
+    the largest arrays of the fit, which is what decides whether it fits in a
+    node, not an exact peak.
+
+    Inputs:
+    num_total_images: int, number of images.
+    num_grid: int, number of background grid points.
+    size: int, cutout size.
+    subtract_background: bool, if False a sky level is fit per image.
+    use_fft_operator, out_of_core, use_float32, two_stage: bool, the solver
+        modes of run_one_object.
+    cost_model: sequence of the coefficients of COST_MODEL_TERMS, defaults
+                to DEFAULT_COST_MODEL.
+
+    Returns:
+    dict with the number of rows and columns of the design matrix, the
+    memory in bytes, the run time in seconds and the terms of the model.
+    """
+    cost_model = DEFAULT_COST_MODEL if cost_model is None else cost_model
+    rows = num_total_images * size**2
+    columns = num_grid + num_total_images
+    if not subtract_background:
+        columns += num_total_images
+    # The normal matrix, its inverse, and the pixel vectors (images, errors,
+    # weights and model) are always held in memory.
+    memory = 3 * 8 * columns**2 + 4 * 8 * rows
+    dense_covariance = 0
+    if use_fft_operator:
+        # The kernels and FFT work arrays, a few images' worth per image.
+        memory += 4 * 8 * rows
+    elif out_of_core:
+        # A chunk of the matrix at a time, see default_chunk_rows.
+        memory += 2 * 8 * default_chunk_rows(columns) * columns
+    elif use_float32 or two_stage:
+        itemsize = 4 if use_float32 else 8
+        # The design matrix and the dense SN block of prep_data_for_fit.
+        memory += itemsize * rows * (columns + num_total_images)
+    elif not subtract_background:
+        # The design matrix without the sky columns (see
+        # sky_design_operator), its weighted copy for the covariance, and
+        # the dense SN block.
+        dense_columns = columns - num_total_images
+        memory += 8 * rows * (2 * dense_columns + num_total_images)
+    else:
+        # The design matrix, its weighted copy, the dense SN block and
+        # np.diag(wgt_matrix) for the covariance.
+        memory += 8 * rows * (2 * columns + num_total_images) + 8 * rows**2
+        dense_covariance = rows**2 * columns
+
+    terms = [1, num_total_images, num_total_images * num_grid,
+             rows * columns**2, dense_covariance, columns**3]
+    return {"rows": rows, "columns": columns, "memory_bytes": memory,
+            "seconds": float(np.dot(terms, cost_model)), "terms": terms}
+
+
+def fit_cost_model(terms, seconds):
+    """Fit the coefficients of the run time model of estimate_cost to the
+    measured run times of some objects (e.g. from the summary of a batch
+    run), with non-negative least squares.
+
+    Inputs:
+    terms: 2D array like, the "terms" of estimate_cost for each object.
+    seconds: 1D array like, the measured run time of each object.
+
+    Returns:
+    tuple of the coefficients of COST_MODEL_TERMS.
+    """
+    terms = np.asarray(terms, dtype=np.float64)
+    # The terms differ by many orders of magnitude, so scale each one to
+    # unit norm for the fit.
+    scale = np.linalg.norm(terms, axis=0)
+    scale[scale == 0] = 1
+    from scipy.optimize import nnls
+    coeffs, _ = nnls(terms / scale, np.asarray(seconds, dtype=np.float64))
+    return tuple(coeffs / scale)
@@ -0,0 +1,526 @@
+"""A small synthetic OpenUniverse 2024 tree, for running campari (tests,
+benchmarks, profiling) away from NERSC and the DCC.
+
+make_dataset writes, under one directory, the files campari and roman_imsim
+read:
+
+    roman_path/RomanTDS/Roman_TDS_obseq_11_6_23.fits   (roman_imsim)
+    roman_path/RomanTDS/Roman_TDS_obseq_11_6_23_radec.fits
+    roman_path/RomanTDS/images/{simple_model,truth}/<band>/<pointing>/
+        Roman_TDS_<...>_<band>_<pointing>_<SCA>.fits.gz
+    roman_path/RomanTDS/truth/<band>/<pointing>/
+        Roman_TDS_index_<band>_<pointing>_<SCA>.txt
+    roman_path/tds.yaml                                 (galsim.tds_file)
+    sn_path/snana_1.parquet, sn_path/snana_1.hdf5, sn_path/pointsource_1.parquet
+    sims_sed_library/starSED/flat_sed.txt.gz
+
+The images are drawn with the Roman PSF and WCS from galsim for each pointing
+and SCA, using campari.simulation, with stars, supernovae (with their host
+galaxies), sky and noise. The supernovae are only in the images between
+their start and end dates. Everything is scaled by the arguments of
+make_dataset, so the same tree can be made bigger for scaling benchmarks.
+
+findAllExposures asks the simdex server which images contain an object.
+start_simdex answers those requests for a synthetic tree, on a local port;
+point photometry.campari.simdex_url at it.
+
+Usage:
+    python -m campari.synthetic make /tmp/ou24 --num-pointings 20
+    python -m campari.synthetic simdex /tmp/ou24/roman_path --port 8765
+"""
+
+# Standard Library
+import argparse
+import datetime
+import gzip
+import http.server
+import json
+import pathlib
+import re
+import threading
+
+# Common Library
+import galsim
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+from astropy.wcs import WCS
+
+# SN-PIT
+from snpit_utils.logger import SNLogger as Lager
+
+# Campari
+from campari.simulation import simulate_galaxy
+
+# The codes of the filters in the roman_imsim observing sequence.
+FILTER_CODES = {"W146": 1, "R062": 2, "Z087": 3, "Y106": 4, "J129": 5,
+                "H158": 6, "F184": 7, "K213": 8}
+EXPTIMES = {"F184": 901.175, "J129": 302.275, "H158": 302.275,
+            "K213": 901.175, "R062": 161.025, "Y106": 302.275,
+            "Z087": 101.7, "W146": 101.7}
+MJD_ORIGIN = datetime.datetime(1858, 11, 17)
+
+TDS_YAML = """\
+# Written by campari.synthetic, for roman_imsim.utils.roman_utils.
+modules:
+    - roman_imsim
+    - galsim.roman
+    - datetime
+image:
+    type: roman_sca
+    wcs:
+        type: RomanWCS
+        SCA: '@image.SCA'
+        ra: {{ type: ObSeqData, field: ra }}
+        dec: {{ type: ObSeqData, field: dec }}
+        pa: {{ type: ObSeqData, field: pa }}
+        mjd: {{ type: ObSeqData, field: mjd }}
+        max_sun_angle: 50
+        force_cvz: True
+    bandpass:
+        type: RomanBandpass
+        name: {{ type: ObSeqData, field: filter }}
+    random_seed:
+        - {{ type: ObSeqData, field: visit }}
+    SCA: 1
+    mjd: {{ type: ObSeqData, field: mjd }}
+    filter: {{ type: ObSeqData, field: filter }}
+    exptime: {{ type: ObSeqData, field: exptime }}
+    draw_method: 'auto'
+    ignore_noise: True
+    stray_light: False
+    thermal_background: False
+    reciprocity_failure: False
+    dark_current: False
+    nonlinearity: False
+    ipc: False
+    read_noise: False
+    sky_subtract: False
+stamp:
+    type: Roman_stamp
+    world_pos:
+        type: SkyCatWorldPos
+    exptime: {{ type: ObSeqData, field: exptime }}
+    photon_ops:
+        -
+            type: ChargeDiff
+gal:
+    type: SkyCatObj
+input:
+    obseq_data:
+        file_name: {obseq_file}
+        visit: 0
+        SCA: '@image.SCA'
+    roman_psf:
+        SCA: '@image.SCA'
+        n_waves: 5
+output:
+    nfiles: 1
+    dir: {image_dir}
+"""
+
+
+def flat_sed():
+    """The flat SED campari assumes when it does not fetch the true one."""
+    return galsim.SED(galsim.LookupTable([100, 2600], [1, 1],
+                                         interpolant="linear"),
+                      wave_type="nm", flux_type="fphotons")
+
+
+def zeropoint(band):
+    """The magnitude of a source that gives one count in an image in band, as
+    in catalog.calc_mag_and_err.
+    """
+    return galsim.roman.getBandpasses()[band].zeropoint + \
+        2.5 * np.log10(EXPTIMES[band] * galsim.roman.collecting_area)
+
+
+def mag_to_flux(mag, band):
+    """The flux, in counts in an image, of a source of AB magnitude mag."""
+    return 10**(-0.4 * (mag - zeropoint(band)))
+
+
+def sn_flux(mjd, peak_mjd, peak_flux, start_mjd, end_mjd):
+    """A simple supernova light curve: a Gaussian rise to the peak and an
+    exponential decline after it, zero outside start_mjd to end_mjd.
+    """
+    mjd = np.asarray(mjd, dtype=float)
+    flux = np.where(mjd < peak_mjd, np.exp(-(mjd - peak_mjd)**2 / (2 * 8**2)),
+                    np.exp(-(mjd - peak_mjd) / 30))
+    return np.where((mjd >= start_mjd) & (mjd <= end_mjd), peak_flux * flux, 0)
+
+
+def pointing_wcs(ra, dec, pa, mjd, SCAs):
+    """The galsim WCS of the SCAs of a pointing, as roman_imsim makes them.
+
+    Returns:
+    dict, a galsim WCS for each SCA.
+    """
+    date = MJD_ORIGIN + datetime.timedelta(days=float(mjd))
+    return galsim.roman.getWCS(
+        world_pos=galsim.CelestialCoord(ra * galsim.degrees,
+                                        dec * galsim.degrees),
+        PA=pa * galsim.degrees, date=date, SCAs=SCAs, PA_is_FPA=True)
+
+
+def plan_pointings(ra, dec, pa, mjds, SCA, image_size, dither, rng):
+    """Boresights of the pointings, such that the middle of the image_size
+    pixels written for SCA is on (ra, dec), give or take a dither.
+
+    Returns:
+    list of (ra, dec) tuples in degrees, one per pointing.
+    """
+    center = galsim.PositionD((image_size + 1) / 2, (image_size + 1) / 2)
+    boresight_ra, boresight_dec = ra, dec
+    # The SCAs are off the boresight, so move it until the image is on
+    # target. It is a small angle, two iterations are plenty.
+    for _ in range(2):
+        wcs = pointing_wcs(boresight_ra, boresight_dec, pa, mjds[0],
+                           [SCA])[SCA]
+        world = wcs.toWorld(center)
+        boresight_ra -= world.ra.deg - ra
+        boresight_dec -= world.dec.deg - dec
+    offsets = rng.uniform(-dither, dither, (len(mjds), 2)) / 3600
+    return [(boresight_ra + dra / np.cos(np.radians(dec)),
+             boresight_dec + ddec) for dra, ddec in offsets]
+
+
+def make_dataset(path, bands=("Y106",), num_pointings=10, SCAs=(1,),
+                 image_size=256, num_sne=2, num_stars=10, hosts=True,
+                 ra=7.5, dec=-44.0, pa=0.0, start_mjd=62000.0, cadence=5.0,
+                 dither=2.0, seed=42):
+    """Write a synthetic OpenUniverse 2024 tree.
+
+    Inputs:
+    path: str or pathlib.Path, the directory to write it in. roman_path,
+          sn_path and sims_sed_library are made inside it.
+    bands: list of str, the bands to make images in. Each pointing is in one
+           band, taking turns.
+    num_pointings: int, the number of pointings in each band.
+    SCAs: list of int, the SCAs imaged in each pointing.
+    image_size: int, the images are the first image_size x image_size pixels
+                of each SCA, 4088 for whole SCAs.
+    num_sne, num_stars: int, the number of supernovae and stars on each SCA.
+    hosts: bool, whether the supernovae have host galaxies. They are the
+           slowest part to draw.
+    ra, dec: float, degrees, where the middle of the first SCA is.
+    pa: float, degrees, the position angle of the focal plane.
+    start_mjd, cadence: float, the date of the first pointing, and the days
+                        between pointings.
+    dither: float, arcseconds, the pointings are shifted by up to this much.
+    seed: int, the random seed.
+
+    Returns:
+    dict with the roman_path, sn_path, sims_sed_library and tds_file to put
+    in the config, and the IDs of the supernovae and stars.
+    """
+    rng = np.random.default_rng(seed)
+    path = pathlib.Path(path)
+    roman_path = path / "roman_path"
+    sn_path = path / "sn_path"
+    sed_library = path / "sims_sed_library"
+    tds_dir = roman_path / "RomanTDS"
+    for directory in [tds_dir, sn_path, sed_library / "starSED"]:
+        directory.mkdir(parents=True, exist_ok=True)
+
+    num_total = num_pointings * len(bands)
+    mjds = start_mjd + cadence * np.arange(num_total)
+    filters = [bands[i % len(bands)] for i in range(num_total)]
+    boresights = plan_pointings(ra, dec, pa, mjds, SCAs[0], image_size,
+                                dither, rng)
+
+    # Place the objects on the first pointing, away from the edges so that
+    # the dithers keep them on the image.
+    first_wcs = pointing_wcs(*boresights[0], pa, mjds[0], list(SCAs))
+    margin = int(2 * dither / galsim.roman.pixel_scale) + 8
+    if image_size <= 2 * margin:
+        raise ValueError(f"image_size must be more than {2 * margin} pixels "
+                         f"for dithers of {dither} arcseconds.")
+    sne, stars = [], []
+    for SCA in SCAs:
+        for kind, number in [(sne, num_sne), (stars, num_stars)]:
+            for x, y in rng.uniform(margin, image_size - margin, (number, 2)):
+                world = first_wcs[SCA].toWorld(galsim.PositionD(x, y))
+                kind.append((world.ra.deg, world.dec.deg))
+
+    sn_table = pd.DataFrame({
+        "id": 20000001 + np.arange(len(sne)),
+        "ra": [s[0] for s in sne], "dec": [s[1] for s in sne],
+        "peak_mjd": rng.uniform(mjds[0] + 0.2 * (mjds[-1] - mjds[0]),
+                                mjds[0] + 0.6 * (mjds[-1] - mjds[0]),
+                                len(sne)).astype(np.float32),
+        "peak_mag_g": rng.uniform(21, 23, len(sne)),
+        "host_mag_g": rng.uniform(20, 22, len(sne))})
+    sn_table["start_mjd"] = np.floor(sn_table["peak_mjd"] - 30)
+    sn_table["end_mjd"] = np.ceil(sn_table["peak_mjd"] + 100)
+    host_offsets = rng.normal(0, 0.5, (len(sne), 2)) / 3600
+    sn_table["host_ra"] = sn_table["ra"] + host_offsets[:, 0] / \
+        np.cos(np.radians(sn_table["dec"]))
+    sn_table["host_dec"] = sn_table["dec"] + host_offsets[:, 1]
+    sn_table["host_sn_sep"] = np.hypot(*host_offsets.T) * 3600
+    sn_table.to_parquet(sn_path / "snana_1.parquet")
+
+    star_table = pd.DataFrame({
+        "id": [str(3000001 + i) for i in range(len(stars))],
+        "ra": [s[0] for s in stars], "dec": [s[1] for s in stars],
+        "object_type": "star",
+        "sed_filepath": "starSED/flat_sed.txt.gz",
+        "magnorm": rng.uniform(18, 22, len(stars))})
+    star_table.to_parquet(sn_path / "pointsource_1.parquet")
+
+    # Flat SEDs, in Angstrom, as campari reads them.
+    lam = np.linspace(1000, 26000, 251)
+    with gzip.open(sed_library / "starSED" / "flat_sed.txt.gz", "wt") as f:
+        f.write("# wavelength(A) flambda\n")
+        f.writelines(f"{wave:.1f} 1.0\n" for wave in lam)
+    import h5py
+    with h5py.File(sn_path / "snana_1.hdf5", "w") as f:
+        for sn in sn_table.itertuples():
+            sed_mjds = np.arange(sn.start_mjd, sn.end_mjd + 1, 5.0)
+            group = f.create_group(str(sn.id))
+            group["lambda"] = lam
+            group["mjd"] = sed_mjds
+            group["flambda"] = np.outer(np.ones_like(sed_mjds),
+                                        np.ones_like(lam))
+
+    # The observing sequences, as roman_imsim and radec2point read them.
+    obseq = fits.BinTableHDU.from_columns([
+        fits.Column("date", "D", array=mjds),
+        fits.Column("exptime", "D", array=[EXPTIMES[b] for b in filters]),
+        fits.Column("ra", "D", array=[b[0] for b in boresights]),
+        fits.Column("dec", "D", array=[b[1] for b in boresights]),
+        fits.Column("pa", "D", array=np.full(num_total, pa)),
+        fits.Column("filter", "J", array=[FILTER_CODES[b] for b in filters])])
+    obseq.writeto(tds_dir / "Roman_TDS_obseq_11_6_23.fits", overwrite=True)
+
+    sca_centers = np.zeros((num_total, 2, 18))
+    for pointing, (mjd, boresight) in enumerate(zip(mjds, boresights)):
+        all_wcs = pointing_wcs(*boresight, pa, mjd, None)
+        for SCA, wcs in all_wcs.items():
+            world = wcs.toWorld(galsim.PositionD(2044.5, 2044.5))
+            sca_centers[pointing, :, SCA - 1] = world.ra.deg, world.dec.deg
+    fits.BinTableHDU.from_columns([
+        fits.Column("RA", "18D", array=sca_centers[:, 0]),
+        fits.Column("DEC", "18D", array=sca_centers[:, 1]),
+        fits.Column("filter", "4A", array=filters),
+        fits.Column("date", "D", array=mjds)]).writeto(
+            tds_dir / "Roman_TDS_obseq_11_6_23_radec.fits", overwrite=True)
+
+    for pointing in range(num_total):
+        _write_pointing(tds_dir, pointing, filters[pointing], mjds[pointing],
+                        boresights[pointing], pa, SCAs, image_size, sn_table,
+                        star_table, hosts, rng)
+
+    tds_file = roman_path / "tds.yaml"
+    tds_file.write_text(TDS_YAML.format(
+        obseq_file=tds_dir / "Roman_TDS_obseq_11_6_23.fits",
+        image_dir=tds_dir / "images" / "truth"))
+
+    Lager.info(f"Wrote {num_total} pointings of {len(SCAs)} SCAs, "
+               f"{len(sne)} supernovae and {len(stars)} stars to {path}")
+    return {"roman_path": str(roman_path), "sn_path": str(sn_path),
+            "sims_sed_library": str(sed_library), "tds_file": str(tds_file),
+            "SNIDs": sn_table["id"].tolist(),
+            "star_IDs": star_table["id"].tolist()}
+
+
+def _write_pointing(tds_dir, pointing, band, mjd, boresight, pa, SCAs,
+                    image_size, sn_table, star_table, hosts, rng):
+    """Draw and write the images and truth files of the SCAs of one
+    pointing.
+    """
+    bandpass = galsim.roman.getBandpasses()[band]
+    all_wcs = pointing_wcs(*boresight, pa, mjd, list(SCAs))
+    sed = flat_sed()
+    sn_fluxes = sn_flux(mjd, sn_table["peak_mjd"],
+                        mag_to_flux(sn_table["peak_mag_g"], band),
+                        sn_table["start_mjd"], sn_table["end_mjd"])
+    sources = [(sn.id, sn.ra, sn.dec, flux, "transient", True)
+               for sn, flux in zip(sn_table.itertuples(), sn_fluxes)
+               if flux > 0]
+    sources += [(int(star.id), star.ra, star.dec,
+                 mag_to_flux(star.magnorm, band), "star", True)
+                for star in star_table.itertuples()]
+    if hosts:
+        sources += [(sn.id + 500000000, sn.host_ra, sn.host_dec,
+                     mag_to_flux(sn.host_mag_g, band), "galaxy", False)
+                    for sn in sn_table.itertuples()]
+
+    for SCA in SCAs:
+        wcs = all_wcs[SCA]
+        model = galsim.ImageF(image_size, image_size, wcs=wcs)
+        psf = galsim.roman.getPSF(SCA, band, pupil_bin=8, n_waves=5, wcs=wcs)
+        truth_rows = []
+        for ID, obj_ra, obj_dec, flux, obj_type, point in sources:
+            pos = wcs.toImage(galsim.CelestialCoord(obj_ra * galsim.degrees,
+                                                    obj_dec * galsim.degrees))
+            if not model.bounds.includes(galsim.PositionI(int(pos.x),
+                                                          int(pos.y))):
+                continue
+            profile = simulate_galaxy(flux, point, band, psf, sed)
+            half = 12 if point else 48
+            bounds = galsim.BoundsI(int(pos.x) - half, int(pos.x) + half,
+                                    int(pos.y) - half, int(pos.y) + half)
+            profile.drawImage(bandpass, image=model[bounds & model.bounds],
+                              method="no_pixel", center=pos,
+                              add_to_image=True)
+            mag = zeropoint(band) - 2.5 * np.log10(flux)
+            truth_rows.append(f"{ID} {obj_ra:.10f} {obj_dec:.10f} "
+                              f"{pos.x:.4f} {pos.y:.4f} "
+                              f"{rng.poisson(flux):.4f} {flux:.4f} "
+                              f"{mag:.4f} {obj_type}\n")
+
+        sky = rng.uniform(80, 120)
+        read_noise = 8
+        noise = np.sqrt(sky + np.clip(model.array, 0, None) + read_noise**2)
+        data = model.array + sky + rng.normal(0, 1, model.array.shape) * noise
+
+        header = galsim.FitsHeader()
+        wcs.writeToFitsHeader(header, model.bounds)
+        header = header.header
+        header["SKY_MEAN"] = sky
+        header["MJD-OBS"] = mjd
+        header["FILTER"] = band
+        header["POINTING"] = pointing
+        header["SCA_NUM"] = SCA
+
+        name = f"{band}/{pointing}/Roman_TDS_{{}}_{band}_{pointing}_{SCA}"
+        for kind, hdus in [
+                ("simple_model", [fits.PrimaryHDU(header=header),
+                                  fits.ImageHDU(data.astype(np.float32),
+                                                header=header, name="SCI"),
+                                  fits.ImageHDU(noise.astype(np.float32),
+                                                name="ERR"),
+                                  fits.ImageHDU(np.zeros(data.shape, np.uint32),
+                                                name="DQ")]),
+                ("truth", [fits.PrimaryHDU(model.array, header=header)])]:
+            image_file = tds_dir / "images" / kind / \
+                f"{name.format(kind)}.fits.gz"
+            image_file.parent.mkdir(parents=True, exist_ok=True)
+            fits.HDUList(hdus).writeto(image_file, overwrite=True)
+
+        truth_file = tds_dir / "truth" / \
+            f"{name.format('index')}.txt"
+        truth_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(truth_file, "w") as f:
+            f.write("object_id ra dec x y realized_flux flux mag obj_type\n")
+            f.writelines(truth_rows)
+
+
+def simdex_index(roman_path, truth="simple_model"):
+    """The images of a synthetic tree, for start_simdex.
+
+    Returns:
+    list of dicts, with the filter, pointing, SCA, date, shape and astropy
+    WCS of each image.
+    """
+    tds_dir = pathlib.Path(roman_path) / "RomanTDS"
+    dates = fits.getdata(tds_dir / "Roman_TDS_obseq_11_6_23.fits")["date"]
+    index = []
+    for image_file in sorted((tds_dir / "images" / truth).glob("*/*/*.fits.gz")):
+        header = fits.getheader(image_file, 1)
+        pointing, SCA = (int(part) for part in
+                         image_file.name.split(".")[0].split("_")[-2:])
+        index.append({"filter": header["FILTER"], "pointing": pointing,
+                      "sca": SCA, "mjd": float(dates[pointing]),
+                      "shape": (header["NAXIS2"], header["NAXIS1"]),
+                      "wcs": WCS(header)})
+    return index
+
+
+def find_images(index, ra, dec):
+    """The images in index that contain (ra, dec), in the format of the
+    simdex findromanimages endpoint.
+    """
+    found = []
+    for image in index:
+        x, y = image["wcs"].world_to_pixel_values(ra, dec)
+        if -0.5 <= x < image["shape"][1] - 0.5 and \
+                -0.5 <= y < image["shape"][0] - 0.5:
+            found.append({key: image[key] for key in
+                          ["filter", "pointing", "sca", "mjd"]})
+    return found
+
+
+def start_simdex(roman_path, port=0, host="127.0.0.1"):
+    """Answer findromanimages requests for a synthetic tree, like the simdex
+    server does, in a background thread.
+
+    Inputs:
+    roman_path: str or pathlib.Path, the roman_path of the tree.
+    port: int, the port to listen on, 0 for any free one.
+    host: str, the address to listen on.
+
+    Returns:
+    server: http.server.ThreadingHTTPServer, call its shutdown() to stop it.
+    url: str, the url to set photometry.campari.simdex_url to.
+    """
+    index = simdex_index(roman_path)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            match = re.search(r"/findromanimages/containing=\(([^,]+),([^)]+)\)",
+                              self.path)
+            if match is None:
+                self.send_error(404, f"Unknown request {self.path}")
+                return
+            body = json.dumps(find_images(index, float(match[1]),
+                                          float(match[2]))).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            Lager.debug(f"simdex: {format % args}")
+
+    server = http.server.ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://{host}:{server.server_address[1]}"
+    Lager.info(f"Serving {len(index)} images of {roman_path} at {url}")
+    return server, url
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Make a synthetic OpenUniverse 2024 tree, or serve the "
+                    "simdex requests for one.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    make = commands.add_parser("make", help="Write a synthetic tree.")
+    make.add_argument("path")
+    make.add_argument("--bands", nargs="+", default=["Y106"])
+    make.add_argument("--num-pointings", type=int, default=10,
+                      help="Pointings in each band.")
+    make.add_argument("--SCAs", type=int, nargs="+", default=[1])
+    make.add_argument("--image-size", type=int, default=256)
+    make.add_argument("--num-sne", type=int, default=2,
+                      help="Supernovae on each SCA.")
+    make.add_argument("--num-stars", type=int, default=10,
+                      help="Stars on each SCA.")
+    make.add_argument("--no-hosts", action="store_true")
+    make.add_argument("--seed", type=int, default=42)
+    simdex = commands.add_parser("simdex", help="Serve simdex requests for "
+                                 "a synthetic tree until interrupted.")
+    simdex.add_argument("roman_path")
+    simdex.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    if args.command == "make":
+        paths = make_dataset(args.path, bands=args.bands,
+                             num_pointings=args.num_pointings, SCAs=args.SCAs,
+                             image_size=args.image_size, num_sne=args.num_sne,
+                             num_stars=args.num_stars, hosts=not args.no_hosts,
+                             seed=args.seed)
+        print(json.dumps(paths, indent=2))
+    else:
+        server, url = start_simdex(args.roman_path, port=args.port)
+        print(f"Set photometry.campari.simdex_url to {url}")
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
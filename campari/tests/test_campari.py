@@ -1,7 +1,13 @@
+import json
 import os
 import pathlib
+import pstats
+import sqlite3
+import subprocess
 import sys
 import tempfile
+import threading
+import time
 import warnings
 
 import astropy.units as u
@@ -16,6 +22,7 @@ from erfa import ErfaWarning
 import matplotlib
 from matplotlib import pyplot as plt
 from roman_imsim.utils import roman_utils
+from scipy.sparse.linalg import aslinearoperator, lsqr
 
 import snappl
 from snappl.image import OpenUniverse2024FITSImage
@@ -23,27 +30,70 @@ from snpit_utils.config import Config
 from snpit_utils.logger import SNLogger as Lager
 
 from campari import RomanASP
+from campari.daemon import send_request, serve
+from campari.instrument import count, memory_summary, note, recording, stage, start_recording, stop_recording
+from campari.manifest import add_to_manifest, claim_next, manifest_status, mark_finished, settings_hash
+from campari.metrics import MetricsWriter, batch_metrics, prometheus_text, write_metrics
+from campari.profiling import profiled
 from campari.AllASPFuncs import (
+    allocate_design_matrix,
+    assemble_epoch_models,
+    batch_solve,
+    build_fft_design_operator,
     calc_mag_and_err,
     calculate_background_level,
+    chunked_design_operator,
+    chunked_normal_matrix,
+    column_norms,
     construct_psf_background,
+    construct_psf_kernel,
     construct_psf_source,
+    cache_stats,
+    estimate_cost,
     extract_sn_from_parquet_file_and_write_to_csv,
     extract_star_from_parquet_file_and_write_to_csv,
+    factor_design_matrix,
     find_parquet,
     findAllExposures,
+    fine_lattice_offset,
+    fit_cost_model,
     get_galsim_SED,
     get_galsim_SED_list,
     get_object_info,
     get_weights,
+    install_aperture_cache,
+    jackknife_epoch_fluxes,
+    load_normal_state,
+    lsqr_with_refinement,
     make_adaptive_grid,
     make_contour_grid,
     make_regular_grid,
+    map_in_order,
+    new_normal_state,
+    NoNewExposures,
+    normal_matrix_from_operator,
     open_parquet,
+    psf_only_photometry,
     radec2point,
+    regular_grid_geometry,
+    residual_bootstrap_images,
+    run_one_object,
     save_lightcurve,
+    save_normal_state,
+    save_warm_start,
+    sky_design_operator,
+    sky_indicator_block,
+    sky_normal_matrix,
+    solve_factored,
+    solve_lsqr,
+    solve_normal_state,
+    two_stage_fit,
+    update_normal_state,
+    warm_start_guess,
+    warm_start_path,
 )
 from campari.simulation import simulate_galaxy, simulate_images, simulate_supernova, simulate_wcs
+from campari.synthetic import make_dataset, start_simdex
 
 warnings.simplefilter("ignore", category=AstropyWarning)
 warnings.filterwarnings("ignore", category=ErfaWarning)
@@ -59,6 +109,99 @@ def sn_path(cfg):
     return cfg.value("photometry.campari.paths.sn_path")
 
 
+def regression_kwargs(cfg, **kwargs):
+    """The run_one_object arguments of test_regression (SN 40120913 in Y106,
+    one pre-detection and one detection image, a contour grid), with kwargs
+    changed. The solver modes are checked against fits with these."""
+    band = "Y106"
+    run_kwargs = {
+        "object_type": "SN", "num_total_images": 2, "num_detect_images": 1,
+        "roman_path": cfg.value("photometry.campari.paths.roman_path"),
+        "sn_path": cfg.value("photometry.campari.paths.sn_path"),
+        "size": 19, "band": band, "fetch_SED": False,
+        "use_real_images": True, "use_roman": True,
+        "subtract_background": True,
+        "make_initial_guess": cfg.value("photometry.campari.make_initial_guess"),
+        "initial_flux_guess": cfg.value("photometry.campari.initial_flux_guess"),
+        "weighting": True, "method": "lsqr", "grid_type": "contour",
+        "pixel": False, "source_phot_ops": False,
+        "lc_start": -np.inf, "lc_end": np.inf, "do_xshift": False,
+        "bg_gal_flux": None, "do_rotation": False,
+        "airy": RomanASP.airy_psf(band), "mismatch_seds": False,
+        "deltafcn_profile": False, "noise": 0, "check_perfection": False,
+        "avoid_non_linearity": False, "sim_gal_ra_offset": 0,
+        "sim_gal_dec_offset": 0,
+        "spacing": cfg.value("photometry.campari.grid_options.spacing"),
+        "percentiles": cfg.value("photometry.campari.grid_options.percentiles")}
+    run_kwargs.update(kwargs)
+    return run_kwargs
+
+
+def fitted_lightcurve(fit):
+    """The flux and its error of each detection of a run_one_object fit, by
+    (Pointing, SCA)."""
+    flux, sigma_flux, exposures = fit[0], fit[1], fit[4]
+    detections = exposures[np.asarray(exposures["DETECTED"], dtype=bool)]
+    return {(int(pointing), int(sca)): (f, e) for pointing, sca, f, e in
+            zip(detections["Pointing"], detections["SCA"], flux, sigma_flux)}
+
+
+def synthetic_scene(rng, num_total_images, num_detect_images, size,
+                    fit_background=True, noise=0):
+    """A small version of run_one_object's problem, for the solver tests: a
+    Gaussian PSF at each point of a grid, shifted a little in each image, a
+    sky level in each image, and a SN in the detection images.
+
+    Returns:
+    psf_matrix: 2D array, columns grid, sky for each image (if
+                fit_background), SN for each image (zero in the
+                pre-detection images).
+    truth: 1D array, the parameters the images were made from.
+    images: 1D array, psf_matrix @ truth plus Gaussian noise of standard
+            deviation noise.
+    wgt_matrix: 1D array of weights, between 0.5 and 1.
+    num_grid: int, the number of grid points.
+    """
+    yy, xx = np.mgrid[0:size, 0:size]
+    grid_x, grid_y = [g.ravel() for g in np.meshgrid(
+        np.arange(2, size - 2, 2.0), np.arange(2, size - 2, 2.0))]
+    num_grid = grid_x.size
+    first_sn = num_total_images - num_detect_images
+
+    def gaussian_psf(x, y):
+        return np.exp(-((xx.ravel()[:, None] - x)**2
+                        + (yy.ravel()[:, None] - y)**2) / 4.5)
+
+    num_sky = num_total_images if fit_background else 0
+    psf_matrix = np.zeros((num_total_images * size**2,
+                           num_grid + num_sky + num_total_images))
+    for i in range(num_total_images):
+        rows = slice(i * size**2, (i + 1) * size**2)
+        shift = rng.random(2) * 0.5
+        psf_matrix[rows, :num_grid] = gaussian_psf(grid_x + shift[0],
+                                                   grid_y + shift[1])
+        if fit_background:
+            psf_matrix[rows, num_grid + i] = 1
+        if i >= first_sn:
+            psf_matrix[rows, num_grid + num_sky + i] = \
+                gaussian_psf(size / 2 - 0.3, size / 2 - 0.6)[:, 0]
+    truth = np.concatenate([rng.random(num_grid) * 100,
+                            rng.random(num_sky) * 10,
+                            np.zeros(first_sn),
+                            rng.random(num_detect_images) * 2000 + 1000])
+    images = psf_matrix @ truth + rng.normal(scale=noise,
+                                             size=psf_matrix.shape[0])
+    wgt_matrix = rng.random(psf_matrix.shape[0]) * 0.5 + 0.5
+    return psf_matrix, truth, images, wgt_matrix, num_grid
+
+
+def weighted_lstsq(psf_matrix, images, wgt_matrix):
+    """The weighted least squares fit the solvers are compared to."""
+    wgt_matrix = np.asarray(wgt_matrix, dtype=np.float64)
+    return np.linalg.lstsq(psf_matrix * wgt_matrix[:, np.newaxis],
+                           images * wgt_matrix, rcond=None)[0]
+
+
 def test_find_parquet(sn_path):
     parq_file_ID = find_parquet(50134575, sn_path)
     assert parq_file_ID == 10430
@@ -368,6 +511,37 @@ def test_regression():
 
 
 
+def test_batch_workers():
+    # Run the regression object and one that does not exist in a pool of
+    # two workers. The bad one should fail without taking the other down.
+    cfg = Config.get()
+    output_dir = pathlib.Path(cfg.value("photometry.campari.paths.output_dir"))
+    curfile = output_dir / "40120913_Y106_romanpsf_lc.ecsv"
+    summary_file = output_dir / "batch_summary_Y106.json"
+    curfile.unlink(missing_ok=True)
+    summary_file.unlink(missing_ok=True)
+
+    output = os.system("python ../RomanASP.py -s 40120913 1 -f Y106 -t 2 -d 1 "
+                       "--workers 2 "
+                       "--photometry-campari-use_roman "
+                       "--photometry-campari-use_real_images "
+                       "--no-photometry-campari-fetch_SED "
+                       "--photometry-campari-grid_options-type contour "
+                       "--photometry-campari-cutout_size 19 "
+                       "--photometry-campari-weighting "
+                       "--photometry-campari-subtract_background "
+                       "--no-photometry-campari-source_phot_ops ")
+    assert output == 0, "The batch run failed. Check the logs"
+    assert curfile.exists()
+
+    with open(summary_file) as f:
+        summary = json.load(f)
+    assert summary["num_succeeded"] == 1
+    assert summary["num_failed"] == 1
+    status = {obj["ID"]: obj["status"] for obj in summary["objects"]}
+    assert status == {40120913: "succeeded", 1: "failed"}
+
+
 def test_get_galsim_SED(sn_path):
     sed = get_galsim_SED(40973149150, 000, sn_path, obj_type="star",
                          fetch_SED=True)
@@ -603,10 +777,12 @@ def test_construct_psf_background( cfg ):
     for wcs in [snappl.wcs.GalsimWCS.from_header(wcs_dict),
                 snappl.wcs.AstropyWCS.from_header(wcs_dict)]:
 
+        start_recording()
         psf_background = construct_psf_background(ra_grid, dec_grid, wcs,
                                                   x_loc=2044, y_loc=2044,
                                                   stampsize=size, band="Y106",
                                                   util_ref=util_ref)
+        assert stop_recording()["counters"] == {"psf_draws": len(ra_grid)}
         test_psf_background = np.load(pathlib.Path(__file__).parent
                                       / "testdata/test_psf_bg.npy")
         np.testing.assert_allclose(psf_background, test_psf_background,
@@ -682,3 +858,1126 @@ def test_construct_psf_source():
 
         assert False, f"PSF source images do not match, a diagnostic " \
                       f"image has been saved to {im_path}. Error: {e}"
+
+
+def test_regular_grid_geometry():
+    wcs_data = np.load(pathlib.Path(__file__).parent
+                       / "testdata/wcs_dict.npz",
+                       allow_pickle=True)
+    wcs_dict = {key: wcs_data[key].item() for key in wcs_data.files}
+    for wcs in [snappl.wcs.GalsimWCS.from_header(wcs_dict),
+                snappl.wcs.AstropyWCS.from_header(wcs_dict)]:
+        ra_grid, dec_grid = make_regular_grid(wcs_dict["CRVAL1"],
+                                              wcs_dict["CRVAL2"], wcs,
+                                              size=11, spacing=0.75)
+        origin, spacing, oversample, grid_width = \
+            regular_grid_geometry(ra_grid, dec_grid, wcs)
+        np.testing.assert_allclose(origin, (1, 1), atol=1e-6)
+        np.testing.assert_allclose(spacing, 0.75, atol=1e-6)
+        assert oversample == 4
+        assert grid_width == 12
+
+
+def test_build_fft_design_operator():
+    # Compare the FFT operator against an explicitly built design matrix,
+    # using a Gaussian PSF that we can evaluate anywhere.
+    def psf(dx, dy):
+        return np.exp(-(dx**2 + dy**2) / (2 * 1.3**2))
+
+    size = 11
+    spacing = 0.75
+    oversample = 4
+    grid_width = 12
+    num_total_images = 4
+    num_detect_images = 2
+    rng = np.random.default_rng(42)
+    origins = [(1 + 0.3 * rng.random(), 1 + 0.3 * rng.random())
+               for _ in range(num_total_images)]
+    sn_matrix = [rng.random(size**2) for _ in range(num_detect_images)]
+
+    kernel_min = -size * oversample - (oversample - 1)
+    fine = (np.arange((2 * size + 1) * oversample) + kernel_min) / oversample
+    kernels = []
+    starts = []
+    for origin in origins:
+        start, offset = fine_lattice_offset(origin, oversample)
+        kernels.append(psf(fine[np.newaxis, :] - offset[0],
+                           fine[:, np.newaxis] - offset[1]))
+        starts.append(start)
+
+    yy, xx = np.mgrid[0:size, 0:size]
+    steps = np.arange(grid_width) * spacing
+    for fit_background in [False, True]:
+        operator = build_fft_design_operator(kernels, kernel_min, starts,
+                                             spacing, oversample, grid_width,
+                                             size, sn_matrix,
+                                             num_total_images,
+                                             fit_background=fit_background)
+        blocks = []
+        for i, origin in enumerate(origins):
+            block = [psf(xx - origin[0] - sx, yy - origin[1] - sy).flatten()
+                     for sy in steps for sx in steps]
+            block = np.array(block).T
+            if fit_background:
+                sky = np.zeros((size**2, num_total_images))
+                sky[:, i] = 1
+                block = np.hstack([block, sky])
+            blocks.append(block)
+        explicit = np.vstack(blocks)
+        sn_columns = np.zeros((num_total_images * size**2, num_total_images))
+        for i, stamp in enumerate(sn_matrix):
+            j = num_total_images - num_detect_images + i
+            sn_columns[j * size**2:(j + 1) * size**2, j] = stamp
+        explicit = np.hstack([explicit, sn_columns])
+
+        assert operator.shape == explicit.shape
+        x = rng.random(explicit.shape[1])
+        y = rng.random(explicit.shape[0])
+        np.testing.assert_allclose(operator.matvec(x), explicit @ x,
+                                   atol=1e-12)
+        np.testing.assert_allclose(operator.rmatvec(y), explicit.T @ y,
+                                   atol=1e-12)
+
+        wgt = rng.random(explicit.shape[0])
+        np.testing.assert_allclose(normal_matrix_from_operator(operator, wgt),
+                                   explicit.T @ np.diag(wgt) @ explicit,
+                                   atol=1e-11)
+
+
+def test_fft_operator_matches_psf_background():
+    # The interleaving of the sub-pixel phases in construct_psf_kernel,
+    # checked against the columns construct_psf_background draws, for an
+    # image that is not rotated.
+    size = 11
+    wcs_dict = {"CTYPE1": "RA---TAN", "CTYPE2": "DEC--TAN",
+                "CRPIX1": 6.0, "CRPIX2": 6.0,
+                "CD1_1": -0.11 / 3600, "CD1_2": 0.0,
+                "CD2_1": 0.0, "CD2_2": 0.11 / 3600,
+                "CUNIT1": "deg", "CUNIT2": "deg",
+                "CRVAL1": 7.7, "CRVAL2": -44.2,
+                "NAXIS1": size, "NAXIS2": size}
+    wcs = snappl.wcs.AstropyWCS.from_header(wcs_dict)
+    psf = galsim.Gaussian(sigma=0.2)
+    ra_grid, dec_grid = make_regular_grid(wcs_dict["CRVAL1"],
+                                          wcs_dict["CRVAL2"], wcs, size=size,
+                                          spacing=0.75)
+    origin, spacing, oversample, grid_width = \
+        regular_grid_geometry(ra_grid, dec_grid, wcs)
+    start, offset = fine_lattice_offset(origin, oversample)
+    kernel, kernel_min = construct_psf_kernel(wcs, 2044, 2044, size,
+                                              oversample, offset, psf=psf,
+                                              band="Y106")
+    operator = build_fft_design_operator([kernel], kernel_min, [start],
+                                         spacing, oversample, grid_width,
+                                         size, [], 1)
+    explicit = construct_psf_background(ra_grid, dec_grid, wcs, 2044, 2044,
+                                        size, psf=psf, band="Y106")
+    columns = operator.matmat(np.eye(operator.shape[1]))[:, :grid_width**2]
+    np.testing.assert_allclose(columns, explicit,
+                               atol=1e-6 * np.max(explicit))
+
+
+def test_fft_operator_matches_lsqr(cfg):
+    # The regression object on a regular grid, with the grid part of the
+    # model applied with FFTs, against the fit with the drawn design matrix.
+    # The kernels match the drawn PSF columns to about 1e-6 (see
+    # test_fft_operator_matches_psf_background), so the fluxes and errors
+    # agree to well within 1e-3.
+    kwargs = regression_kwargs(cfg, grid_type="regular")
+    try:
+        fft_fit = run_one_object(40120913, **kwargs, use_fft_operator=True)
+    except ValueError as e:
+        if "rotated" not in str(e):
+            raise
+        pytest.skip("The images of the regression object are rotated with "
+                    "respect to each other.")
+    fit = run_one_object(40120913, **kwargs)
+    np.testing.assert_allclose(fft_fit[0], fit[0], rtol=1e-3)
+    np.testing.assert_allclose(fft_fit[1], fit[1], rtol=1e-3)
+
+
+def test_out_of_core_design_matrix():
+    rng = np.random.default_rng(42)
+    dense = rng.random((103, 17))
+    wgt = rng.random(103)
+    x = rng.random(17)
+    y = rng.random(103)
+    with tempfile.TemporaryDirectory() as scratch:
+        psf_matrix = allocate_design_matrix(scratch, dense.shape)
+        # Fill it in blocks, as run_one_object does one image at a time.
+        for start in range(0, 103, 10):
+            psf_matrix[start:start + 10] = dense[start:start + 10]
+
+        operator = chunked_design_operator(psf_matrix, wgt, chunk_rows=7)
+        np.testing.assert_allclose(operator.matvec(x), wgt * (dense @ x))
+        np.testing.assert_allclose(operator.rmatvec(y), dense.T @ (wgt * y))
+        np.testing.assert_allclose(chunked_normal_matrix(psf_matrix, wgt,
+                                                         chunk_rows=7),
+                                   dense.T @ np.diag(wgt) @ dense)
+        del psf_matrix
+
+
+def test_out_of_core_matches_lsqr(cfg):
+    # The regression object with its design matrix on disk, against the fit
+    # with it in memory. The matrices are the same, only the order of the
+    # sums in lsqr and the normal matrix differs.
+    kwargs = regression_kwargs(cfg)
+    fit = run_one_object(40120913, **kwargs)
+    out_of_core_fit = run_one_object(40120913, **kwargs, out_of_core=True)
+    for i in [0, 1]:  # flux, sigma_flux
+        np.testing.assert_allclose(out_of_core_fit[i], fit[i], rtol=1e-6)
+    np.testing.assert_allclose(out_of_core_fit[3], fit[3], rtol=1e-6,
+                               atol=1e-6 * np.max(np.abs(fit[3])))
+
+
+def test_lsqr_with_refinement():
+    rng = np.random.default_rng(42)
+    psf_matrix, truth, images, wgt, num_grid = \
+        synthetic_scene(rng, 6, 3, 11, noise=1)
+    psf_matrix = psf_matrix.astype(np.float32)
+    wgt = wgt.astype(np.float32)
+    images = images.astype(np.float32)
+
+    X, itn = lsqr_with_refinement(psf_matrix, wgt, images, chunk_rows=64)
+    assert X.dtype == np.float64
+    assert itn > 0
+
+    # The refined answer is the double precision solution for the single
+    # precision matrix.
+    expected = weighted_lstsq(psf_matrix, images, wgt)
+    np.testing.assert_allclose(X, expected, rtol=1e-9, atol=1e-9)
+
+    # precondition and flux_rtol change the single precision lsqr, not
+    # where the refinement ends up.
+    flux_columns = np.arange(psf_matrix.shape[1] - 3, psf_matrix.shape[1])
+    X, itn = lsqr_with_refinement(psf_matrix, wgt, images, chunk_rows=64,
+                                  precondition=True,
+                                  flux_columns=flux_columns, flux_rtol=1e-4)
+    np.testing.assert_allclose(X, expected, rtol=1e-9, atol=1e-9)
+
+
+def test_float32_fluxes_match_float64():
+    rng = np.random.default_rng(42)
+    psf_matrix, truth, images, wgt, num_grid = \
+        synthetic_scene(rng, 8, 8, 7, fit_background=False, noise=1)
+
+    expected = weighted_lstsq(psf_matrix, images, wgt)
+    X, _ = lsqr_with_refinement(psf_matrix.astype(np.float32),
+                                wgt.astype(np.float32),
+                                images.astype(np.float32))
+    # The tolerance of test_regression.
+    np.testing.assert_allclose(X[-8:], expected[-8:], rtol=3e-7)
+
+
+def test_float32_matches_lsqr(cfg):
+    # The regression object fit with a float32 design matrix and refinement,
+    # against the float64 lsqr fit. The refinement converges to the least
+    # squares fit of the rounded matrix, which lsqr's tolerance and the
+    # rounding keep within 1e-5 of the float64 fluxes; the errors come from
+    # the normal matrix, accumulated in float64 from the rounded matrix.
+    kwargs = regression_kwargs(cfg)
+    fit = run_one_object(40120913, **kwargs)
+    float32_fit = run_one_object(40120913, **kwargs, use_float32=True)
+    np.testing.assert_allclose(float32_fit[0], fit[0], rtol=1e-5)
+    np.testing.assert_allclose(float32_fit[1], fit[1], rtol=1e-4)
+
+
+def test_two_stage_fit():
+    rng = np.random.default_rng(42)
+    size, num_total, num_detect = 11, 6, 3
+    psf_matrix, truth, images, wgt_matrix, num_grid = \
+        synthetic_scene(rng, num_total, num_detect, size)
+
+    X, flux_cov = two_stage_fit(psf_matrix, images, wgt_matrix, num_total,
+                                num_detect, size, num_grid,
+                                fit_background=True)
+    np.testing.assert_allclose(X, truth, rtol=1e-6)
+    assert flux_cov.shape == (num_detect, num_detect)
+    # The shared host model correlates the epochs.
+    assert np.all(flux_cov[~np.eye(num_detect, dtype=bool)] != 0)
+    assert np.all(np.linalg.eigvalsh(flux_cov) > 0)
+
+    with pytest.raises(ValueError):
+        two_stage_fit(psf_matrix, images, wgt_matrix, num_total, num_total,
+                      size, num_grid, fit_background=True)
+
+
+def test_two_stage_matches_lsqr(cfg):
+    # The regression object, with its host fit from the pre-detection image
+    # alone and then frozen, against the joint lsqr fit. The host models
+    # differ, so the fluxes are only expected to agree within their errors.
+    kwargs = regression_kwargs(cfg, num_total_images=3, num_detect_images=2)
+    flux, sigma_flux = run_one_object(40120913, **kwargs)[:2]
+    two_stage_flux, two_stage_sigma = \
+        run_one_object(40120913, **kwargs, two_stage=True)[:2]
+    assert np.all(np.isfinite(two_stage_sigma) & (two_stage_sigma > 0))
+    assert np.all(np.abs(two_stage_flux - flux)
+                  < np.hypot(sigma_flux, two_stage_sigma))
+
+
+def test_incremental_normal_state():
+    rng = np.random.default_rng(42)
+    size = 7
+    pixels = size**2
+    # Three images, then two more, with the SN in all of them.
+    old, _, old_images, old_wgt, num_grid = synthetic_scene(rng, 3, 3, size,
+                                                            noise=1)
+    new, _, new_images, new_wgt, _ = synthetic_scene(rng, 2, 2, size,
+                                                     noise=1)
+    images = np.concatenate([old_images, new_images])
+    wgt = np.concatenate([old_wgt, new_wgt])
+
+    state = new_normal_state(num_grid, fit_background=True)
+    state, _ = update_normal_state(state, old, old_images, old_wgt, 3)
+    state, new_columns = update_normal_state(state, new.astype(np.float32),
+                                             new_images, new_wgt, 2,
+                                             chunk_rows=7)
+    np.testing.assert_array_equal(new_columns, [0, 1, 2, 3, 7, 8, 12, 13])
+
+    # The same fit, done in one go.
+    full = np.zeros((5 * pixels, num_grid + 10))
+    full[:3 * pixels, [0, 1, 2, 3, 4, 5, 6, 9, 10, 11]] = old
+    full[3 * pixels:, new_columns] = new.astype(np.float32)
+    X, cov, sn_columns = solve_normal_state(state)
+    np.testing.assert_allclose(X, weighted_lstsq(full, images, wgt),
+                               rtol=1e-8)
+    np.testing.assert_allclose(cov, np.linalg.inv(full.T @ np.diag(wgt)
+                                                  @ full), rtol=1e-8)
+    np.testing.assert_array_equal(sn_columns, np.arange(9, 14))
+
+    exposures = QTable({"Pointing": [1, 2, 3, 4, 5], "SCA": [1, 1, 2, 2, 3],
+                        "DETECTED": [False, False, True, True, True]})
+    with tempfile.TemporaryDirectory() as state_dir:
+        path = pathlib.Path(state_dir) / "20172782_Y106_state.npz"
+        save_normal_state(path, state, exposures, np.arange(num_grid),
+                          np.arange(num_grid), {"size": 25})
+        loaded, loaded_exposures, ra_grid, dec_grid, settings = \
+            load_normal_state(path)
+    assert settings == {"size": 25}
+    assert loaded["num_images"] == 5 and loaded["fit_background"]
+    np.testing.assert_array_equal(loaded["solve_factor"],
+                                  state["solve_factor"])
+    np.testing.assert_array_equal(loaded_exposures["Pointing"],
+                                  exposures["Pointing"])
+    np.testing.assert_array_equal(ra_grid, np.arange(num_grid))
+
+    # An ill conditioned fit (condition number 1e7) keeps its accuracy,
+    # where solving its normal matrix (condition number 1e14) would not.
+    u, _ = np.linalg.qr(rng.standard_normal((40, 5)))
+    v, _ = np.linalg.qr(rng.standard_normal((5, 5)))
+    matrix = u @ np.diag(np.logspace(0, -7, 5)) @ v.T
+    truth = rng.standard_normal(5)
+    state = new_normal_state(4, fit_background=False)
+    state, _ = update_normal_state(state, matrix, matrix @ truth,
+                                   np.ones(40), 1)
+    X, _, _ = solve_normal_state(state)
+    np.testing.assert_allclose(X, truth, rtol=1e-6)
+
+
+def test_incremental_matches_full_fit(cfg):
+    # Fitting the regression object one night at a time, first with one
+    # detection and then with a second, gives the lightcurve of fitting all
+    # three exposures at once. The contour grid is made from the first
+    # (pre-detection) image, which both runs share. The fluxes and errors
+    # agree to 1e-6, the tolerance of the full fit's lsqr and the rounding
+    # of its normal matrix inverse.
+    union = {"num_total_images": 3, "num_detect_images": 2}
+    full = fitted_lightcurve(
+        run_one_object(40120913, **regression_kwargs(cfg, **union)))
+    with tempfile.TemporaryDirectory() as state_dir:
+        run_one_object(40120913, **regression_kwargs(cfg, state_dir=state_dir))
+        fit = run_one_object(40120913, **regression_kwargs(
+            cfg, **union, state_dir=state_dir))
+        incremental = fitted_lightcurve(fit)
+        with pytest.raises(NoNewExposures):
+            run_one_object(40120913, **regression_kwargs(cfg, **union,
+                                                         state_dir=state_dir))
+    assert incremental.keys() == full.keys()
+    for exposure, (flux, sigma_flux) in full.items():
+        np.testing.assert_allclose(incremental[exposure],
+                                   (flux, sigma_flux), rtol=1e-6)
+
+    # The lightcurve covers all three exposures, the images, model, weights
+    # and cutout WCSs only the one modelled in the second run.
+    images, sumimages, exposures, wgt_matrix, cutout_wcs_list, \
+        new_exposures = fit[2], fit[3], fit[4], fit[7], fit[10], fit[12]
+    assert len(exposures) == 3 and len(new_exposures) == 1
+    assert np.size(images) == np.size(sumimages) == np.size(wgt_matrix) \
+        == 19**2
+    assert len(cutout_wcs_list) == 1
+
+
+def test_warm_start_cache():
+    ra_grid = np.array([10.0, 10.0001, 10.0002])
+    dec_grid = np.array([-20.0, -20.0, -20.0001])
+    exposures = QTable({"Pointing": [1, 2, 3], "SCA": [4, 5, 6]})
+    # Grid, sky per image, SN per image.
+    X = np.array([1, 2, 3, 10, 20, 30, 100, 200, 300], dtype=float)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        settings = {"grid_type": "regular", "spacing": 0.75, "size": 25}
+        path = warm_start_path(cache_dir, 20172782, "Y106", settings)
+        assert path != warm_start_path(cache_dir, 20172782, "Y106",
+                                       dict(settings, spacing=1.0))
+        save_warm_start(path, X, ra_grid, dec_grid, exposures,
+                        fit_background=True, iterations=1234)
+
+        # One grid point moved, one image dropped and one added.
+        new_ra = np.array([10.0, 10.0001, 10.01])
+        new_exposures = QTable({"Pointing": [2, 3, 7], "SCA": [5, 6, 8]})
+        x0, iterations = warm_start_guess(path, new_ra, dec_grid,
+                                          new_exposures, True,
+                                          grid_guess=np.full(3, -1.0),
+                                          flux_guess=3000)
+        assert iterations == 1234
+        np.testing.assert_array_equal(x0, [1, 2, -1, 20, 30, 0,
+                                           200, 300, 3000])
+
+        # Without fitting the sky this time.
+        x0, _ = warm_start_guess(path, new_ra, dec_grid, new_exposures,
+                                 False, grid_guess=np.zeros(3),
+                                 flux_guess=0)
+        np.testing.assert_array_equal(x0, [1, 2, 0, 200, 300, 0])
+
+
+def test_solve_lsqr():
+    rng = np.random.default_rng(42)
+    # Badly scaled columns, like the grid, sky and SN columns.
+    matrix = rng.random((300, 20)) * np.logspace(-3, 2, 20)
+    truth = rng.random(20) * 1000
+    rhs = matrix @ truth + rng.normal(size=300)
+    expected = np.linalg.lstsq(matrix, rhs, rcond=None)[0]
+    flux_columns = np.arange(17, 20)
+
+    np.testing.assert_allclose(column_norms(matrix),
+                               np.linalg.norm(matrix, axis=0))
+    np.testing.assert_allclose(
+        column_norms(aslinearoperator(matrix), chunk_size=7),
+        np.linalg.norm(matrix, axis=0))
+
+    X, _, plain_itn = solve_lsqr(matrix, rhs)
+    np.testing.assert_allclose(X, expected, rtol=1e-6)
+    X, _, preconditioned_itn = solve_lsqr(matrix, rhs, precondition=True)
+    np.testing.assert_allclose(X, expected, rtol=1e-6)
+    assert preconditioned_itn < plain_itn
+
+    X, istop, _ = solve_lsqr(matrix, rhs, precondition=True,
+                             flux_columns=flux_columns, flux_rtol=1e-10)
+    assert istop == 1
+    np.testing.assert_allclose(X[flux_columns], expected[flux_columns],
+                               rtol=1e-7)
+
+
+def test_multi_rhs_solve():
+    rng = np.random.default_rng(42)
+    num_grid, size, num_total, num_detect = 5, 5, 4, 2
+    pixels = size**2
+    # Columns: grid, SN for each image.
+    psf_matrix = np.zeros((num_total * pixels, num_grid + num_total))
+    for i in range(num_total):
+        rows = slice(i * pixels, (i + 1) * pixels)
+        psf_matrix[rows, :num_grid] = rng.random((pixels, num_grid))
+        if i >= num_total - num_detect:
+            psf_matrix[rows, num_grid + i] = rng.random(pixels)
+    wgt = rng.random(num_total * pixels)
+    truth = np.concatenate([rng.random(num_grid) * 100, [0, 0, 1000, 3000]])
+    model = psf_matrix @ truth
+    images = model[:, np.newaxis] + rng.normal(size=(model.size, 10))
+
+    factorization = factor_design_matrix(psf_matrix, wgt)
+    X = solve_factored(factorization, images)
+    assert X.shape == (num_grid + num_total, 10)
+    for k in (0, 9):
+        expected = np.linalg.lstsq(psf_matrix * wgt[:, np.newaxis],
+                                   images[:, k] * wgt, rcond=None)[0]
+        np.testing.assert_allclose(X[:, k], expected, rtol=1e-8, atol=1e-6)
+        np.testing.assert_allclose(solve_factored(factorization,
+                                                  images[:, k]),
+                                   X[:, k])
+
+    resampled = residual_bootstrap_images(psf_matrix @ X[:, 0], wgt,
+                                          images[:, 0], 20, rng=rng)
+    assert resampled.shape == (model.size, 20)
+    assert np.all(np.isfinite(solve_factored(factorization, resampled)))
+
+    # Leaving out a detection epoch drops its SN column.
+    fluxes = jackknife_epoch_fluxes(psf_matrix, wgt, images[:, 0],
+                                    num_total, num_detect, size)
+    keep = np.arange(num_total * pixels) >= pixels
+    expected = np.linalg.lstsq(psf_matrix[keep] * wgt[keep, np.newaxis],
+                               images[keep, 0] * wgt[keep], rcond=None)[0]
+    np.testing.assert_allclose(fluxes[0], expected[-num_detect:], rtol=1e-6)
+    assert np.isnan(fluxes[3, 1]) and np.isfinite(fluxes[3, 0])
+
+
+def test_batch_solve():
+    rng = np.random.default_rng(42)
+
+    def star(num_images, num_detect, pixels=25):
+        # Columns: sky for each image, SN for each image.
+        matrix = np.zeros((num_images * pixels, 2 * num_images))
+        for i in range(num_images):
+            rows = slice(i * pixels, (i + 1) * pixels)
+            matrix[rows, i] = 1
+            if i >= num_images - num_detect:
+                matrix[rows, num_images + i] = rng.random(pixels)
+        return matrix, rng.random(num_images * pixels), \
+            rng.random(num_images * pixels) * 100
+
+    def check(stars, X, cov):
+        for (matrix, wgt, image), x, c in zip(stars, X, cov):
+            expected = np.linalg.lstsq(matrix * wgt[:, np.newaxis],
+                                       image * wgt, rcond=None)[0]
+            np.testing.assert_allclose(x, expected, rtol=1e-6, atol=1e-8)
+            np.testing.assert_allclose(c, np.linalg.pinv(matrix.T @ (
+                wgt[:, np.newaxis] * matrix)), rtol=1e-6, atol=1e-8)
+
+    # Same shapes: one batched dense solve.
+    stars = [star(3, 2) for _ in range(5)]
+    X, cov = batch_solve(*zip(*stars))
+    assert len(X) == len(cov) == 5
+    check(stars, X, cov)
+
+    # Only the singular (not yet detected in every image) objects fall back
+    # to the pseudo-inverse, the others are solved exactly.
+    stars = [star(3, 3), star(3, 1), star(3, 3)]
+    X, cov = batch_solve(*zip(*stars))
+    check(stars, X, cov)
+    for (matrix, wgt, image), x in zip(stars[::2], X[::2]):
+        np.testing.assert_allclose(x, np.linalg.solve(
+            matrix.T @ (wgt[:, np.newaxis]**2 * matrix),
+            matrix.T @ (wgt**2 * image)), rtol=1e-12)
+
+    # Different shapes: one block diagonal sparse solve.
+    stars = [star(3, 2), star(4, 4), star(2, 1)]
+    X, cov = batch_solve(*zip(*stars))
+    assert [x.size for x in X] == [6, 8, 4]
+    check(stars, X, cov)
+
+
+def test_psf_only_photometry():
+    rng = np.random.default_rng(42)
+    num_total_images, num_detect_images, size = 5, 3, 7
+    first_sn = num_total_images - num_detect_images
+    sn_matrix = [rng.random(size**2) for _ in range(num_detect_images)]
+    images = rng.random(num_total_images * size**2) * 100
+    wgt_matrix = rng.random(num_total_images * size**2)
+
+    # The SN only part of the design matrix run_one_object builds.
+    psf_matrix = np.zeros((num_total_images * size**2, num_total_images))
+    for i, stamp in enumerate(sn_matrix):
+        psf_matrix[(first_sn + i) * size**2:(first_sn + i + 1) * size**2,
+                   first_sn + i] = stamp
+    expected = lsqr(psf_matrix * wgt_matrix.reshape(-1, 1),
+                    images * wgt_matrix, atol=1e-12, btol=1e-12)[0]
+    cov = np.linalg.pinv(psf_matrix.T @ np.diag(wgt_matrix) @ psf_matrix)
+
+    X, sigma_flux, model = psf_only_photometry(sn_matrix, images, wgt_matrix,
+                                               num_total_images)
+    np.testing.assert_allclose(X, expected, rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(sigma_flux,
+                               np.sqrt(np.diag(cov)[first_sn:]), rtol=1e-10)
+    np.testing.assert_allclose(model, psf_matrix @ X, rtol=1e-12)
+
+    # Started from an initial guess, as with make_initial_guess, and with a
+    # detection whose PSF has no weight. lsqr leaves the fluxes of the
+    # columns it can not move at the guess, and the covariance is singular,
+    # so run_one_object pseudo-inverts it.
+    x0 = np.full(num_total_images, 3000.0)
+    wgt_matrix[first_sn * size**2:(first_sn + 1) * size**2] = 0
+    expected, _, _ = solve_lsqr(psf_matrix * wgt_matrix.reshape(-1, 1),
+                                images * wgt_matrix, x0=x0)
+    normal = psf_matrix.T @ np.diag(wgt_matrix) @ psf_matrix
+    with pytest.raises(np.linalg.LinAlgError):
+        np.linalg.inv(normal)
+    cov = np.linalg.pinv(normal)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        X, sigma_flux, model = psf_only_photometry(sn_matrix, images,
+                                                   wgt_matrix,
+                                                   num_total_images, x0=x0)
+    assert X[first_sn] == 3000 and sigma_flux[0] == 0
+    np.testing.assert_allclose(X, expected, rtol=1e-10)
+    np.testing.assert_allclose(sigma_flux,
+                               np.sqrt(np.diag(cov)[first_sn:]), rtol=1e-10)
+    np.testing.assert_allclose(model, psf_matrix @ X, rtol=1e-12)
+
+
+def test_closed_form_matches_lsqr(cfg):
+    # The regression object without a grid, fit in closed form and with
+    # lsqr. The pre-detection flux is initial_flux_guess in both, the rest
+    # agree to lsqr's tolerance.
+    kwargs = regression_kwargs(cfg, grid_type="none")
+    fit = run_one_object(40120913, **kwargs)
+    closed_form_fit = run_one_object(40120913, **kwargs, closed_form=True)
+    for index in [0, 1, 9]:  # flux, sigma_flux, X
+        np.testing.assert_allclose(closed_form_fit[index], fit[index],
+                                   rtol=1e-8)
+    np.testing.assert_allclose(closed_form_fit[3], fit[3], rtol=1e-8,
+                               atol=1e-8 * np.max(np.abs(fit[3])))
+    with pytest.raises(ValueError, match="closed_form"):
+        run_one_object(40120913, **regression_kwargs(cfg), closed_form=True)
+
+
+def test_sky_design_operator():
+    rng = np.random.default_rng(7)
+    num_total_images, num_grid, size = 6, 10, 5
+    rows = num_total_images * size**2
+
+    # The sky columns as run_one_object used to build them, a column at a
+    # time for each image.
+    blocks = []
+    for i in range(num_total_images):
+        block = np.empty((size**2, 0))
+        for j in range(num_total_images):
+            bg = np.ones(size**2) if i == j else np.zeros(size**2)
+            block = np.concatenate([block, bg.reshape(-1, 1)], axis=1)
+        blocks.append(block)
+    old_sky = np.vstack(blocks)
+    sky_block = sky_indicator_block(num_total_images, size)
+    np.testing.assert_array_equal(sky_block.toarray(), old_sky)
+
+    grid = rng.random((rows, num_grid))
+    sn = rng.random((rows, num_total_images))
+    psf_matrix = np.hstack([grid, old_sky, sn])
+    wgt_matrix = rng.random(rows)
+    operator = sky_design_operator(np.hstack([grid, sn]), sky_block,
+                                   num_grid, wgt_matrix)
+    weighted = psf_matrix * wgt_matrix.reshape(-1, 1)
+    assert operator.shape == psf_matrix.shape
+    x = rng.random(psf_matrix.shape[1])
+    y = rng.random(rows)
+    np.testing.assert_allclose(operator.matvec(x), weighted @ x, rtol=1e-12)
+    np.testing.assert_allclose(operator.rmatvec(y), weighted.T @ y,
+                               rtol=1e-12)
+    np.testing.assert_allclose(operator.matmat(np.eye(psf_matrix.shape[1])),
+                               weighted, rtol=1e-12)
+    np.testing.assert_allclose(
+        sky_normal_matrix(np.hstack([grid, sn]), sky_block, num_grid,
+                          wgt_matrix),
+        psf_matrix.T @ np.diag(wgt_matrix) @ psf_matrix, rtol=1e-12)
+
+
+def test_map_in_order():
+    kwargs_list = [{"shape": 3, "fill_value": i} for i in range(10)]
+    serial = list(map_in_order(np.full, kwargs_list))
+    np.testing.assert_array_equal(serial, np.repeat(np.arange(10), 3)
+                                  .reshape(10, 3))
+    for executor in ["thread", "process"]:
+        parallel = list(map_in_order(np.full, kwargs_list, workers=3,
+                                     executor=executor))
+        np.testing.assert_array_equal(parallel, serial)
+
+    with pytest.raises(ValueError):
+        list(map_in_order(np.full, kwargs_list, workers=2, executor="gpu"))
+
+
+def test_manifest():
+    config_hash = settings_hash({"size": 19, "grid_type": "contour"})
+    assert config_hash != settings_hash({"size": 25, "grid_type": "contour"})
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = pathlib.Path(tmpdir) / "manifest.sqlite"
+        assert add_to_manifest(path, [1, 2, 3], "Y106", config_hash) == 3
+        # Adding them again (e.g. rerunning the same batch) changes nothing.
+        assert add_to_manifest(path, [1, 2, 3], "Y106", config_hash) == 0
+
+        assert claim_next(path, "Y106", config_hash) == "1"
+        mark_finished(path, 1, "Y106", config_hash, True, seconds=1.0)
+        assert claim_next(path, "Y106", config_hash) == "2"
+        mark_finished(path, 2, "Y106", config_hash, False, error="Oops")
+        # 3 is claimed and then cut off, before it finishes.
+        assert claim_next(path, "Y106", config_hash) == "3"
+        assert manifest_status(path, "Y106", config_hash) == \
+            {"pending": 0, "running": 1, "done": 1, "failed": 1}
+
+        # The failed one is retried until it has been tried max_attempts
+        # times, the running one is only run again once it is stale.
+        assert claim_next(path, "Y106", config_hash, max_attempts=2) == "2"
+        mark_finished(path, 2, "Y106", config_hash, False, error="Oops")
+        assert claim_next(path, "Y106", config_hash, max_attempts=2) is None
+        assert claim_next(path, "Y106", config_hash, max_attempts=2,
+                          stale_after=0) == "3"
+        mark_finished(path, 3, "Y106", config_hash, True)
+        assert manifest_status(path, "Y106", config_hash) == \
+            {"pending": 0, "running": 0, "done": 2, "failed": 1}
+
+        # Other bands and settings are kept apart.
+        assert claim_next(path, "J129", config_hash) is None
+
+        # A stale object that has used up its attempts is failed, not left
+        # running for ever.
+        add_to_manifest(path, [4], "Y106", config_hash)
+        assert claim_next(path, "Y106", config_hash, max_attempts=1) == "4"
+        assert claim_next(path, "Y106", config_hash, max_attempts=1,
+                          stale_after=0) is None
+        assert manifest_status(path, "Y106", config_hash)["failed"] == 2
+        conn = sqlite3.connect(path)
+        error, = conn.execute("SELECT error FROM objects WHERE id = '4'"
+                              ).fetchone()
+        conn.close()
+        assert error.startswith("stale")
+
+
+def test_cost_model(monkeypatch):
+    # 40 images of 25x25 with 144 grid points, as in
+    # benchmarks/float32_refinement.py.
+    dense = estimate_cost(40, 144, 25, True)
+    assert dense["rows"] == 40 * 25**2
+    assert dense["columns"] == 144 + 40
+    assert estimate_cost(40, 144, 25, False)["columns"] == 144 + 80
+    # The in-memory covariance needs a rows x rows matrix, the other modes
+    # do not.
+    assert dense["memory_bytes"] > 8 * dense["rows"]**2
+    for mode in ["use_float32", "out_of_core", "use_fft_operator"]:
+        assert estimate_cost(40, 144, 25, True, **{mode: True})[
+            "memory_bytes"] < dense["memory_bytes"] / 20
+
+    # The cost model can be recovered from run times that follow it.
+    rng = np.random.default_rng(42)
+    coeffs = np.array([2.0, 0.5, 1e-3, 1e-8, 5e-11, 1e-10])
+    terms = [estimate_cost(n, g, s, True)["terms"] for n, g, s in
+             zip(rng.integers(5, 100, 30), rng.integers(0, 300, 30),
+                 rng.choice([11, 19, 25], 30))]
+    np.testing.assert_allclose(fit_cost_model(terms, np.dot(terms, coeffs)),
+                               coeffs, rtol=1e-6)
+
+    plans = [{"ID": 1, "seconds": 10, "memory_bytes": 1 * 2**30,
+              "memory_bytes_out_of_core": 2**28},
+             {"ID": 2, "seconds": 100, "memory_bytes": 8 * 2**30,
+              "memory_bytes_out_of_core": 2**28},
+             {"ID": 3, "seconds": 50, "memory_bytes": 8 * 2**30,
+              "memory_bytes_out_of_core": 4 * 2**30}]
+    IDs, object_kwargs = RomanASP.schedule_objects([1, 2, 3, 4], plans,
+                                                   memory_budget_gb=2)
+    # Longest first, 3 does not fit even out of core, 4 was not planned.
+    assert IDs == [2, 1, 4]
+    assert object_kwargs == {2: {"out_of_core": True,
+                                 "use_fft_operator": False,
+                                 "use_float32": False, "two_stage": False}}
+
+    # Plans made with the default cost model are scheduled with a warning.
+    warnings_logged = []
+    monkeypatch.setattr("campari.RomanASP.Lager.warning",
+                        warnings_logged.append)
+    RomanASP.schedule_objects([1, 2], [dict(plan, calibrated=True)
+                                       for plan in plans])
+    assert warnings_logged == []
+    RomanASP.schedule_objects([1, 2], plans)
+    assert "uncalibrated" in warnings_logged[0]
+
+
+def test_cluster_objects():
+    # 1, 3 and 4 share exposures, 2 and 5 share one, 6 shares none and 7 was
+    # not planned.
+    exposures = {1: [[10, 1], [11, 1], [12, 2]],
+                 2: [[20, 5]],
+                 3: [[10, 1], [11, 1]],
+                 4: [[12, 2], [13, 2]],
+                 5: [[20, 5], [21, 5]],
+                 6: [[30, 9]]}
+    plans = [{"ID": ID, "exposures": e} for ID, e in exposures.items()]
+    clusters = RomanASP.cluster_objects([1, 2, 3, 4, 5, 6, 7], plans, 3)
+    # 3 shares the most with 1, and nothing with 4, so 4 starts its own.
+    assert clusters == [[1, 3], [2, 5], [4], [6], [7]]
+    assert RomanASP.cluster_objects([1, 4, 3], plans, 3) == [[1, 3], [4]]
+    assert RomanASP.cluster_objects([1, 4, 3], plans, 1) == [[1], [4], [3]]
+
+
+def test_daemon():
+    def handle(request):
+        if request["ID"] < 0:
+            raise ValueError("No such object.")
+        return {"ID": request["ID"], "status": "succeeded",
+                "lightcurve": {"flux": [request["ID"] * 2.0]}}
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = pathlib.Path(tmpdir) / "campari.sock"
+        thread = threading.Thread(target=serve, args=(path, handle))
+        thread.start()
+        while not path.exists():
+            time.sleep(0.01)
+
+        reply = send_request(path, {"ID": 21}, timeout=10)
+        assert reply["lightcurve"]["flux"] == [42.0]
+        # A failed request is replied to, and the daemon carries on.
+        reply = send_request(path, {"ID": -1}, timeout=10)
+        assert reply["status"] == "failed"
+        assert "No such object." in reply["error"]
+        assert send_request(path, {"ID": 1}, timeout=10)["status"] == \
+            "succeeded"
+
+        assert send_request(path, {"shutdown": True}, timeout=10)["status"] \
+            == "shutting down"
+        thread.join(timeout=10)
+        assert not thread.is_alive()
+        assert not path.exists()
+
+
+def test_deferred_imports():
+    # Importing the entry point should not import the packages that only
+    # plotting, catalog downloads or simulations need.
+    deferred = ["matplotlib", "h5py", "requests", "roman_imsim",
+                "scipy.interpolate"]
+    code = "import sys, campari.RomanASP; " \
+        f"print([m for m in {deferred!r} if m in sys.modules])"
+    out = subprocess.run([sys.executable, "-c", code], check=True,
+                         capture_output=True, text=True)
+    assert out.stdout.strip().splitlines()[-1] == "[]"
+
+    # The plotting functions can still be imported from AllASPFuncs.
+    from campari.AllASPFuncs import plot_images
+    from campari.plotting import plot_images as plotting_plot_images
+    assert plot_images is plotting_plot_images
+
+
+def test_import_time_budget():
+    # benchmarks/import_time.py exits with an error if importing the entry
+    # point takes longer than the budget, or imports a deferred package.
+    script = pathlib.Path(__file__).parents[2] / "benchmarks/import_time.py"
+    out = subprocess.run([sys.executable, str(script), "--module",
+                          "campari.RomanASP", "--repeats", "3",
+                          "--budget", "3"], capture_output=True, text=True)
+    assert out.returncode == 0, out.stdout + out.stderr
+
+
+def test_aperture_cache():
+    roman_psfs = galsim.roman.roman_psfs
+    with tempfile.TemporaryDirectory() as tmpdir:
+        try:
+            install_aperture_cache(tmpdir)
+            before = cache_stats()["apertures"]
+            psf = galsim.roman.getPSF(1, "Y106", pupil_bin=8)
+            assert len(list(pathlib.Path(tmpdir).glob("aperture_*.pkl"))) == 1
+            # A new process (here, one with an empty in-memory cache) loads
+            # the aperture instead of building it again.
+            roman_psfs._make_aperture.clear()
+            assert install_aperture_cache(tmpdir, preload=True) == 1
+            cached_psf = galsim.roman.getPSF(1, "Y106", pupil_bin=8)
+            after = cache_stats()["apertures"]
+            assert after["misses"] - before["misses"] == 1
+            assert after["hits"] - before["hits"] == 1
+
+            bpass = galsim.roman.getBandpasses()["Y106"]
+            star = galsim.DeltaFunction() * galsim.SED("vega.txt", "nm",
+                                                       "flambda")
+            kwargs = {"bandpass": bpass, "nx": 15, "ny": 15, "scale": 0.11}
+            np.testing.assert_array_equal(
+                galsim.Convolve(star, psf).drawImage(**kwargs).array,
+                galsim.Convolve(star, cached_psf).drawImage(**kwargs).array)
+        finally:
+            roman_psfs._make_aperture = getattr(roman_psfs._make_aperture,
+                                                "uncached",
+                                                roman_psfs._make_aperture)
+
+
+def test_synthetic_dataset():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        paths = make_dataset(tmpdir, num_pointings=4, image_size=64,
+                             num_sne=1, num_stars=2, hosts=False, dither=0.5,
+                             seed=1)
+        SNID = paths["SNIDs"][0]
+        parq = find_parquet(SNID, paths["sn_path"], obj_type="SN")
+        assert find_parquet(paths["star_IDs"][0], paths["sn_path"],
+                            obj_type="star") == 1
+        ra, dec, pointing, sca, start, end, peak = \
+            get_object_info(SNID, parq, "Y106", paths["sn_path"],
+                            paths["roman_path"], "SN")
+        assert sca[0] == 1
+
+        server, url = start_simdex(paths["roman_path"])
+        try:
+            explist = findAllExposures(SNID, ra, dec, peak[0], start[0],
+                                       end[0], "Y106", return_list=True,
+                                       roman_path=paths["roman_path"],
+                                       server_url=url)
+        finally:
+            server.shutdown()
+        # The object is on every pointing, and the magnitudes in the truth
+        # files are those of calc_mag_and_err.
+        assert len(explist) == 4
+        one_count, _, _ = calc_mag_and_err(np.ones(1), np.zeros(1), "Y106")
+        np.testing.assert_allclose(explist["zeropoint"], one_count[0],
+                                   atol=1e-3)
+
+        image = OpenUniverse2024FITSImage(
+            f"{paths['roman_path']}/RomanTDS/images/simple_model/Y106/0/"
+            "Roman_TDS_simple_model_Y106_0_1.fits.gz", None, 1)
+        data, noise, flags = image.get_data(which="all")
+        assert data.shape == noise.shape == (64, 64)
+
+
+def test_instrument():
+    # Nothing is recorded unless asked for.
+    with stage("solve"):
+        count("psf_draws", 10)
+    assert stop_recording() is None
+
+    start_recording()
+    for _ in range(2):
+        with stage("solve"):
+            time.sleep(0.01)
+    count("psf_draws", 10)
+    count("psf_draws", 5)
+    note("design_matrix_shape", [100, 3])
+    report = stop_recording()
+    assert report["stages"]["solve"] >= 0.02
+    assert report["counters"] == {"psf_draws": 15}
+    assert report["notes"] == {"design_matrix_shape": [100, 3]}
+    assert stop_recording() is None
+
+
+def test_assemble_epoch_models_stage(monkeypatch):
+    size = 5
+
+    def slow_epoch_model(ra_grid, grid_type):
+        time.sleep(0.2)
+        return np.ones((size**2, np.size(ra_grid))), np.ones(size**2), \
+            None, None, None
+    monkeypatch.setattr("campari.AllASPFuncs.construct_epoch_model",
+                        slow_epoch_model)
+    epoch_kwargs = [{"ra_grid": np.zeros(4), "grid_type": "regular"}] * 3
+
+    # The models are built while they are taken from map_in_order, which
+    # has to be in the psfs stage.
+    start_recording()
+    psf_matrix, sn_matrix, psf_kernels, _, _ = \
+        assemble_epoch_models(epoch_kwargs, [], size)
+    report = stop_recording()
+    assert report["stages"]["psfs"] >= 0.6
+    assert len(psf_matrix) == len(sn_matrix) == 3
+    assert psf_kernels == []
+
+    start_recording()
+    assemble_epoch_models(epoch_kwargs, [], size, epoch_workers=3)
+    report = stop_recording()
+    assert report["stages"]["psfs"] >= 0.2
+
+
+def test_epoch_workers_match_serial(cfg):
+    # Each thread of the epoch pool draws with its own roman_utils and PSF
+    # objects, so building the models in threads gives the same fit, to the
+    # bit, as building them one after another. With a process pool, the PSF
+    # draws of the workers are still counted.
+    kwargs = regression_kwargs(cfg, num_total_images=3, num_detect_images=2)
+    start_recording()
+    serial = run_one_object(40120913, **kwargs)
+    serial_counters = stop_recording()["counters"]
+    threaded = run_one_object(40120913, **kwargs, epoch_workers=3,
+                              epoch_executor="thread")
+    for i in [0, 1, 3, 9]:  # flux, sigma_flux, sumimages, X
+        np.testing.assert_array_equal(threaded[i], serial[i])
+
+    start_recording()
+    run_one_object(40120913, **kwargs, epoch_workers=3,
+                   epoch_executor="process")
+    counters = stop_recording()["counters"]
+    assert counters["psf_draws"] == serial_counters["psf_draws"] > 0
+
+
+def test_memory_profile():
+    start_recording(memory=True)
+    with stage("prep"):
+        kept = np.ones(2**20)
+    with stage("covariance"):
+        spike = np.ones((1024, 1024))
+        del spike
+    report = stop_recording()
+    memory = report["memory"]
+    assert memory["prep"]["retained_mb"] == pytest.approx(8, abs=0.5)
+    assert memory["prep"]["largest"][0]["mb"] == pytest.approx(8, abs=0.1)
+    assert "test_campari.py" in memory["prep"]["largest"][0]["site"]
+    # The spike is gone by the end of the stage, but it is its peak.
+    assert memory["covariance"]["peak_mb"] >= 8
+    assert memory["covariance"]["retained_mb"] < 1
+    assert kept.sum() == 2**20
+
+    summary = memory_summary([{"ID": 1, "report": report},
+                              {"ID": 2, "report": None}])
+    assert summary["covariance"]["max_peak_ID"] == 1
+    assert summary["covariance"]["max_peak_mb"] >= 8
+
+
+def test_assemble_epoch_models_memory(monkeypatch):
+    size = 5
+
+    def epoch_model(ra_grid, grid_type):
+        # A transient 8 MB, as drawing the PSFs would use.
+        scratch = np.ones(2**20)
+        return np.ones((size**2, np.size(ra_grid))) * scratch[0], None, \
+            None, None, None
+    monkeypatch.setattr("campari.AllASPFuncs.construct_epoch_model",
+                        epoch_model)
+    start_recording(memory=True)
+    assemble_epoch_models([{"ra_grid": np.zeros(4), "grid_type": "regular"}]
+                          * 3, [], size)
+    report = stop_recording()
+    summary = memory_summary([{"ID": 1, "report": report}])
+    assert summary["psfs"]["max_peak_mb"] >= 8
+
+
+def _busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_profiled():
+    with tempfile.TemporaryDirectory() as debug_dir:
+        prefix = pathlib.Path(debug_dir) / "40120913_Y106_romanpsf"
+        with profiled("cprofile", prefix):
+            _busy(0.2)
+        stats = pstats.Stats(str(prefix) + "_profile.pstats")
+        assert any(function[2] == "_busy" for function in stats.stats)
+        with open(str(prefix) + "_profile.collapsed") as f:
+            lines = f.read().splitlines()
+        # Almost all the time is in _busy, under test_profiled.
+        stack, weight = lines[0].rsplit(" ", 1)
+        assert "test_profiled (test_campari.py" in stack
+        assert stack.split(";")[-1].startswith("_busy (test_campari.py")
+        assert int(weight) == pytest.approx(2e5, rel=0.5)
+
+        with profiled("sample", prefix, interval=0.001):
+            _busy(0.2)
+        with open(str(prefix) + "_profile.collapsed") as f:
+            stacks = dict(line.rsplit(" ", 1) for line in f)
+        busy = sum(int(n) for stack, n in stacks.items()
+                   if stack.split(";")[-1].startswith("_busy"))
+        assert busy > 0.5 * sum(int(n) for n in stacks.values())
+
+        with pytest.raises(ValueError, match="profile must be one of"):
+            with profiled("perf", prefix):
+                pass
+
+
+def test_batch_metrics():
+    def report(solve, itn, hits):
+        return {"stages": {"solve": solve, "psfs": 1.0},
+                "counters": {"lsqr_iterations": itn, "psf_draws": 100},
+                "caches": {"get_psf_object": {"hits": hits, "misses": 1}}}
+    summaries = [
+        {"ID": 1, "status": "succeeded", "report": report(10.0, 50, 3),
+         "pid": 11, "max_rss_mb": 500},
+        {"ID": 2, "status": "succeeded", "report": report(30.0, 150, 1),
+         "pid": 11, "max_rss_mb": 700},
+        {"ID": 3, "status": "succeeded", "report": report(20.0, 100, 0),
+         "pid": 12, "max_rss_mb": 600},
+        {"ID": 4, "status": "failed", "seconds": None},
+    ]
+    metrics = batch_metrics(summaries, 3600, "Y106", workers=2)
+    assert metrics["objects_succeeded"] == 3
+    assert metrics["objects_failed"] == 1
+    assert metrics["objects_per_hour"] == 4
+    assert metrics["stage_seconds"]["solve"]["quantiles"]["0.5"] == 20
+    assert metrics["stage_seconds"]["solve"]["sum"] == 60
+    assert metrics["lsqr_iterations"]["quantiles"]["0.9"] == \
+        pytest.approx(140)
+    assert metrics["psf_draws"] == 300
+    assert metrics["caches"]["get_psf_object"]["hit_rate"] == \
+        pytest.approx(4 / 7)
+    assert metrics["worker_max_rss_mb"] == {"11": 700, "12": 600}
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        prefix = pathlib.Path(output_dir) / "campari_metrics_Y106"
+        write_metrics(metrics, prefix)
+        with open(str(prefix) + ".json") as f:
+            assert json.load(f)["objects_failed"] == 1
+        with open(str(prefix) + ".prom") as f:
+            prom = f.read().splitlines()
+    assert 'campari_objects_total{band="Y106",status="failed"} 1' in prom
+    assert 'campari_stage_seconds{band="Y106",stage="solve",quantile="0.5"} 20' \
+        in prom
+    assert 'campari_stage_seconds_count{band="Y106",stage="solve"} 3' in prom
+    assert "# TYPE campari_lsqr_iterations summary" in prom
+    assert 'campari_worker_max_rss_bytes{band="Y106",pid="11"} 734003200' \
+        in prom
+
+    # Nothing finished yet.
+    empty = batch_metrics([], 10, "Y106")
+    assert empty["lsqr_iterations"]["count"] == 0
+    assert "campari_lsqr_iterations_count" in prometheus_text(empty)
+
+
+def test_metrics_writer():
+    with tempfile.TemporaryDirectory() as output_dir:
+        prefix = pathlib.Path(output_dir) / "campari_metrics_Y106"
+        writer = MetricsWriter(prefix, 0.05, "Y106")
+        writer.start()
+        # Written on the interval, before any object has finished.
+        deadline = time.time() + 10
+        while not os.path.exists(str(prefix) + ".json"):
+            assert time.time() < deadline
+            time.sleep(0.01)
+        writer.add({"ID": 1, "status": "failed", "seconds": None})
+        writer.stop()
+        assert not writer.is_alive()
+        with open(str(prefix) + ".json") as f:
+            assert json.load(f)["objects_failed"] == 1
+
+
+def test_process_object_up_to_date(monkeypatch):
+    # An incremental fit with no new exposures is neither a failure nor
+    # retried.
+    def run_one_object(ID, **kwargs):
+        raise NoNewExposures("No new exposures found, the saved state is "
+                             "up to date.")
+    monkeypatch.setattr("campari.RomanASP.run_one_object", run_one_object)
+    summary = RomanASP.process_object(
+        40120913, {"band": "Y106", "use_real_images": True, "use_roman": True})
+    assert summary["status"] == "up_to_date"
+    assert summary["error"] is None
+
+
+def test_process_object_stops_recording(monkeypatch):
+    # A fit that raises does not leave the recording on for the next object.
+    cfg = Config.get()
+
+    class InstrumentedConfig:
+        def value(self, key):
+            if key == "photometry.campari.instrument":
+                return True
+            return cfg.value(key)
+
+    def run_one_object(ID, **kwargs):
+        assert recording()
+        raise RuntimeError("The fit fell over.")
+    monkeypatch.setattr("campari.RomanASP.Config.get",
+                        lambda: InstrumentedConfig())
+    monkeypatch.setattr("campari.RomanASP.run_one_object", run_one_object)
+    with pytest.raises(RuntimeError, match="fell over"):
+        RomanASP.process_object(
+            40120913, {"band": "Y106", "use_real_images": True,
+                       "use_roman": True})
+    assert not recording()
+
+
+def test_fit_request_keeps_callers_recording(monkeypatch):
+    # fit_request only stops the recording it started.
+    cfg = Config.get()
+
+    class InstrumentedConfig:
+        def value(self, key):
+            if key == "photometry.campari.instrument":
+                return True
+            return cfg.value(key)
+
+    def run_one_object(ID, **kwargs):
+        assert recording()
+        raise NoNewExposures("No new exposures found, the saved state is "
+                             "up to date.")
+    monkeypatch.setattr("campari.RomanASP.Config.get",
+                        lambda: InstrumentedConfig())
+    monkeypatch.setattr("campari.RomanASP.run_one_object", run_one_object)
+    run_kwargs = {"band": "Y106"}
+    reply = RomanASP.fit_request({"ID": 40120913}, run_kwargs)
+    assert reply["status"] == "up_to_date"
+    assert reply["report"] is not None
+    assert not recording()
+
+    start_recording()
+    try:
+        reply = RomanASP.fit_request({"ID": 40120913}, run_kwargs)
+        assert reply["report"] is None
+        assert recording()
+    finally:
+        stop_recording()